@@ -15,11 +15,20 @@ whole, or GROMACS is installed and available via gmx command.
 For details on NMRPCA, see `DatabankLib/analyze_nmrpca.py`.
 """
 
-from DatabankLib.utils import run_analysis
+from functools import partial
+from DatabankLib.utils import run_analysis, analysis_parser, parse_analysis_args
 from DatabankLib.analyze import computeNMRPCA
 import logging
 
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
-    run_analysis(computeNMRPCA, logger)
+    parser = analysis_parser(__doc__)
+    parser.add_argument('--no-cache', action='store_true',
+                        help="recompute all systems without reusing stored "
+                        "PCA artifacts (NMRPCA_<lipid>.npz)")
+    run_opts, opts = parse_analysis_args(parser)
+    method = computeNMRPCA
+    if opts['no_cache']:
+        method = partial(computeNMRPCA, recompute=True, use_cache=False)
+    run_analysis(method, logger, **run_opts)
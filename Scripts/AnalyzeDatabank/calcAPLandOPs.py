@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from functools import partial
+from DatabankLib.utils import run_analysis, analysis_parser, parse_analysis_args
+from DatabankLib.analyze import computeFused
+import logging
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    run_opts, opts = parse_analysis_args(
+        analysis_parser(__doc__, frame_workers=True))
+    run_analysis(partial(computeFused, **opts), logger, **run_opts)
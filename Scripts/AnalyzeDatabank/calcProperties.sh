@@ -1,5 +1,5 @@
-python calcOrderParameters.py
-python calcAPL.py
+python ../BuildDatabank/compileMappings.py
+python calcAPLandOPs.py
 python calc_FormFactors.py
 python calc_thickness.py
 python NMRPCA_timerelax.py
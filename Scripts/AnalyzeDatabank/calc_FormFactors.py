@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 # coding: utf-8
+"""
+:program: calc_FormFactors.py
+:description: Compute density profiles and form factors of all systems.
+"""
 
-from DatabankLib.utils import run_analysis
+from functools import partial
+from DatabankLib.utils import run_analysis, analysis_parser, parse_analysis_args
 from DatabankLib.analyze import computeFF
 import logging
 
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
-    run_analysis(computeFF, logger)
+    parser = analysis_parser(__doc__, frame_workers=True)
+    parser.add_argument('--block-frames', type=int, default=None,
+                        help="also write form factors of blocks of this many frames "
+                        "and convergence metrics (FormFactorBlocks.json)")
+    run_opts, opts = parse_analysis_args(parser)
+    run_analysis(partial(computeFF, **opts), logger, **run_opts)
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from DatabankLib.utils import run_analysis
+from DatabankLib.utils import run_analysis, analysis_parser
 from DatabankLib.analyze import computeTH
 import logging
 
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
-    run_analysis(computeTH, logger)
+    opts = analysis_parser(__doc__).parse_args()
+    run_analysis(computeTH, logger, **vars(opts))
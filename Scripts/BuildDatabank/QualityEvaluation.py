@@ -49,14 +49,15 @@ if __name__ == "__main__":
             fragment_qual_dict = {}
             data_dict = {}
 
+            # fragments of the molecule are the same for all experiments
+            mapping_file = simulation.readme['COMPOSITION'][lipid1]['MAPPING']
+            fragments = qq.getFragments(mapping_file)
+
             for doi, path in \
                     simulation.readme['EXPERIMENT']['ORDERPARAMETER'][lipid1].items():
                 print(f"Evaluating {lipid1} lipid using experimental data from"
                       f"{doi} in {NMLDB_EXP_PATH}/OrderParameters/{path}")
 
-                # load mapping file
-                mapping_file = simulation.readme['COMPOSITION'][lipid1]['MAPPING']
-
                 print(doi)
                 OP_qual_data = {}
                 # get readme file of the experiment
@@ -107,7 +108,6 @@ if __name__ == "__main__":
                 data_dict[doi] = OP_qual_data
 
                 # calculate quality for molecule fragments headgroup, sn-1, sn-2
-                fragments = qq.getFragments(mapping_file)
                 fragment_qual_dict[doi] = qq.fragmentQuality(
                     fragments, lipidExpOPdata, OP_data_lipid)
 
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+:program: compileMappings.py
+:description: Precompiles all mapping files into a binary store, so that
+              analyses don't parse YAML mapping files. Rerun it after mapping
+              files are added or updated (outdated entries are detected and
+              parsed from YAML anyway).
+"""
+
+import argparse
+
+from DatabankLib.databankLibrary import compileMappingFiles
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mapping-dir', default=None,
+                        help="folder with mapping files (default: databank mappings)")
+    args = parser.parse_args()
+    print("Mapping store written:", compileMappingFiles(args.mapping_dir))
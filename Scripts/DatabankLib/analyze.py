@@ -7,15 +7,13 @@
 import json
 import os
 import sys
-import re
 import traceback
 from logging import Logger
 from DatabankLib.settings.engines import get_struc_top_traj_fnames
 import buildh
 import urllib.request
 import socket
-from tqdm import tqdm
-import numpy as np
+import MDAnalysis as mda
 import gc
 
 from DatabankLib import (
@@ -23,21 +21,30 @@ from DatabankLib import (
     RCODE_ERROR, RCODE_SKIPPED, RCODE_COMPUTED)
 from DatabankLib.settings.molecules import lipids_dict
 from DatabankLib.databankLibrary import (
-    GetNlipids, loadMappingFile, system2MDanalysisUniverse)
+    GetNlipids, loadMapping, loadMappingFile, system2MDanalysisUniverse)
 from DatabankLib.jsonEncoders import CompactJSONEncoder
 from DatabankLib.databankio import resolve_download_file_url
-from DatabankLib.databankop import find_OP
-from DatabankLib.form_factor import FormFactor
+from DatabankLib.databankop import find_OP, parse_op_input, OPKernel
+from DatabankLib.trajdriver import TrajectoryDriver, APLKernel
+from DatabankLib.form_factor import (
+    FormFactor, DensityHistograms, HISTOGRAMS_FILE, membraneThickness)
 from DatabankLib import analyze_nmrpca as nmrpca
 
 
-def computeNMRPCA(system: dict, logger: Logger, recompute: bool = False) -> int:
+def computeNMRPCA(system: dict, logger: Logger, recompute: bool = False,
+                  use_cache: bool = True) -> int:
     """Compute eq_times.json using NMR PCA analysis.
 
+    PCA results of every lipid (average structure, principal components, PC1
+    projections and autocorrelations) are stored in ``NMRPCA_<lipid>.npz``
+    files. If they are found, the equilibration time is estimated from them
+    without reading the trajectory.
+
     Args:
         system (dict): one of systems of the Databank
         recompute (bool, optional): Delete previous apl.json and recompute it if True.
         Defaults to False.
+        use_cache (bool, optional): Reuse stored PCA results. Defaults to True.
     Returns:
         int success code (RCODE_...)
     """
@@ -79,30 +86,48 @@ def computeNMRPCA(system: dict, logger: Logger, recompute: bool = False) -> int:
         sys.stderr.write("TPR is required for NMRPCA analysis!")
         return RCODE_ERROR
 
-    # Download files
-    parser.downloadTraj()
-    # Prepare trajectory
-    parser.prepareTraj()
-    # Concatenate trajectory
-    parser.concatenateTraj()
+    # Reuse stored PCA results of lipids
+    pcas = {}
+    if use_cache:
+        for lipid in parser.pcaLipids():
+            pca_runner = nmrpca.PCA.load(parser.artifactsPath(lipid),
+                                         parser.artifactsKey(lipid))
+            if pca_runner is not None:
+                print(f"Main: found PCA artifacts of lipid {lipid}")
+                pcas[lipid] = pca_runner
+    missing = [lipid for lipid in parser.pcaLipids() if lipid not in pcas]
+
+    if missing:
+        # Download files
+        parser.downloadTraj()
+        # Prepare trajectory
+        parser.prepareTraj()
+        # Concatenate trajectory
+        parser.concatenateTraj(missing)
+        # Iterate over trajectories for different lipids
+        for traj in parser.concatenated_trajs:
+            print(f"Main: parsing lipid {traj[4]}")
+            # Creat PCA for trajectory
+            pca_runner = nmrpca.PCA(traj[0], traj[1], traj[2], traj[3], parser.trjLen)
+            # Run PCA
+            pca_runner.PCA()
+            print("Main: PCA: done")
+            # Project trajectory on PC1
+            pca_runner.get_proj()
+            print("Main: Projections: done")
+            # Calculate autocorrelations
+            pca_runner.get_autocorrelations()
+            print("Main: Autocorrelations: done")
+            pca_runner.save(parser.artifactsPath(traj[4]), parser.artifactsKey(traj[4]))
+            pca_runner.aligned_traj = None
+            pcas[traj[4]] = pca_runner
+        parser.concatenated_trajs = []
+
     equilibration_times = {}
-    # Iterate over trajectories for different lipids
-    for traj in parser.concatenated_trajs:
-        print(f"Main: parsing lipid {traj[4]}")
-        # Creat PCA for trajectory
-        pca_runner = nmrpca.PCA(traj[0], traj[1], traj[2], traj[3], parser.trjLen)
-        # Run PCA
-        data = pca_runner.PCA()
-        print("Main: PCA: done")
-        # Project trajectory on PC1
-        pca_runner.get_proj(data)
-        print("Main: Projections: done")
-        # Calculate autocorrelations
-        pca_runner.get_autocorrelations()
-        print("Main: Autocorrelations: done")
+    for lipid in parser.pcaLipids():
         # Estimate equilibration time
-        te2 = nmrpca.TimeEstimator(pca_runner.autocorrelation).calculate_time()
-        equilibration_times[traj[4]] = te2 / parser.trjLen
+        te2 = nmrpca.TimeEstimator(pcas[lipid].autocorrelation).calculate_time()
+        equilibration_times[lipid] = te2 / parser.trjLen
         print("Main: EQ time: done")
 
         print(te2 / parser.trjLen)
@@ -150,15 +175,11 @@ def computeAPL(system: dict, logger: Logger, recompute: bool = False) -> int:
 
     # this calculates the area per lipid as a function of time and stores it
     # in the databank
-    apl = {}
-    for ts in tqdm(u.trajectory, desc='Scanning the trajectory'):
-        if u.trajectory.time >= system['TIMELEFTOUT']*1000:
-            dims = u.dimensions
-            aplFrame = dims[0]*dims[1]*2/Nlipid
-            apl[u.trajectory.time] = aplFrame
+    kernel = APLKernel(Nlipid, system['TIMELEFTOUT']*1000)
+    TrajectoryDriver(u, [kernel]).run()
 
     with open(outfilename, 'w') as f:
-        json.dump(apl, f, cls=CompactJSONEncoder)
+        json.dump(kernel.apl, f, cls=CompactJSONEncoder)
 
     return RCODE_COMPUTED
 
@@ -173,21 +194,20 @@ def computeTH(system: dict, logger: Logger, recompute: bool = False) -> int:
         NMLDB_SIMU_PATH, system['path'], 'WaterDensity.json')
     LipidDensity_name = os.path.join(
         NMLDB_SIMU_PATH, system['path'], 'LipidDensity.json')
-    print(LipidDensity_name)
+    histograms_name = os.path.join(
+        NMLDB_SIMU_PATH, system['path'], HISTOGRAMS_FILE)
     try:
-        with open(WaterDensity_name) as f:
-            WaterDensity = json.load(f)
-        with open(LipidDensity_name) as f:
-            LipidDensity = json.load(f)
-        wd = np.array(WaterDensity)
-        ld = np.array(LipidDensity)
-        idx = np.argwhere(np.diff(np.sign(wd[:, 1] - ld[:, 1]))).flatten()
-        if len(idx) < 2:
-            print("Dehydrated sample! Standard thickness rule doesn't work."
-                  " Will extract boxZ.")
-            thickness = wd[-1, 0] - wd[0, 0]
+        if os.path.isfile(histograms_name):
+            # raw histograms written by newer FormFactor runs
+            print(histograms_name)
+            thickness = DensityHistograms.load(histograms_name).thickness()
         else:
-            thickness = wd[idx[1], 0] - wd[idx[0], 0]
+            print(LipidDensity_name)
+            with open(WaterDensity_name) as f:
+                WaterDensity = json.load(f)
+            with open(LipidDensity_name) as f:
+                LipidDensity = json.load(f)
+            thickness = membraneThickness(WaterDensity, LipidDensity)
         with open(thickFN, 'w') as f:
             json.dump(thickness, f)
     except Exception as e:
@@ -200,12 +220,20 @@ def computeTH(system: dict, logger: Logger, recompute: bool = False) -> int:
 
 
 # TODO: implement onlyLipid
-def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
+def computeOP(system: dict, logger: Logger, recompute: bool = False,
+              n_workers: int = 1) -> int:
     """_summary_
 
+    For every OP, OrderParameters.json stores ``[average, std, stem]`` followed
+    by ``{BLOCK_SE, BLOCKS}`` block statistics. United-atom systems are
+    processed by buildH, which reports only time averages, so their files
+    contain no block statistics.
+
     Args:
         system (dict): _description_
         recompute (bool, optional): _description_. Defaults to False.
+        n_workers (int, optional): number of processes reading frame chunks of
+            the trajectory. Defaults to 1.
 
     Returns:
         int: _description_
@@ -242,9 +270,8 @@ def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
     # here but this script downloads the data)
     _ = system2MDanalysisUniverse(system)
 
-    # Software and time for equilibration period
+    # Software
     software = system['SOFTWARE']
-    EQtime = float(system['TIMELEFTOUT'])*1000
 
     # Check if all or united atom simulation
     try:
@@ -276,24 +303,10 @@ def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
             if top_fname is None:
                 raise ValueError("TPR is required for OP calculations!")
 
-            xtcwhole = os.path.join(NMLDB_SIMU_PATH, path, 'whole.xtc')
-            if (not os.path.isfile(xtcwhole)):
-                execStr = (
-                    f"echo System | {trjconvCOMMAND} -f {trj_fname} "
-                    f"-s {top_fname} -o {xtcwhole} -pbc mol -b {str(EQtime)}"
-                )
-                print("Make molecules whole in the trajectory")
-                if unitedAtom and system['TRAJECTORY_SIZE'] > 15e9:
-                    print("United atom trajectry larger than 15 Gb. "
-                          "Using only every third frame to reduce memory usage.")
-                    execStr += " -skip 3"
-                rCode = os.system(execStr)
-                if (rCode != 0):
-                    raise RuntimeError("trjconv exited with error (see above)")
+            xtcwhole = _whole_trajectory(system, top_fname, trj_fname,
+                                         trjconvCOMMAND, bool(unitedAtom))
         elif 'openMM' in software or 'NAMD' in software:
-            if (not os.path.isfile(struc_fname)):
-                pdb_url = resolve_download_file_url(system.get('DOI'), struc_fname)
-                _ = urllib.request.urlretrieve(pdb_url, struc_fname)
+            _download_structure(system, struc_fname)
         else:
             print("Order parameter calculation for other than gromacs, "
                   "openMM and NAMD are yet to be implemented.")
@@ -321,36 +334,18 @@ def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
             for key in system['UNITEDATOM_DICT']:
                 # construct order parameter definition file for CH bonds from
                 # mapping file
-                mapping_file = system['COMPOSITION'][key]['MAPPING']
-                mapping_dict = loadMappingFile(mapping_file)
+                mapping = loadMapping(system['COMPOSITION'][key]['MAPPING'])
 
                 def_fileNAME = os.path.join(NMLDB_SIMU_PATH, path, key + '.def')
                 def_file = open(def_fileNAME, 'w')
 
                 previous_line = ""
 
-                regexp1_H = re.compile(r'M_[A-Z0-9]*C[0-9]*H[0-9]*_M')
-                regexp2_H = re.compile(r'M_G[0-9]*H[0-9]*_M')
-                regexp1_C = re.compile(r'M_[A-Z0-9]*C[0-9]*_M')
-                regexp2_C = re.compile(r'M_G[0-9]_M')
-
-                for mapping_key in mapping_dict.keys():
-                    if regexp1_C.search(mapping_key) or regexp2_C.search(mapping_key):
-                        atomC = [mapping_key, mapping_dict[mapping_key]['ATOMNAME']]
-                        atomH = []
-                    elif regexp1_H.search(mapping_key) or regexp2_H.search(mapping_key):
-                        atomH = [mapping_key, mapping_dict[mapping_key]['ATOMNAME']]
-                    else:
-                        atomC = []
-                        atomH = []
-
-                    if atomH:
-                        items = [atomC[1], atomH[1], atomC[0], atomH[0]]
-                        def_line = (items[2] + "&" + items[3] + " " +
-                                    key + " " + items[0] + " " + items[1] + "\n")
-                        if def_line != previous_line:
-                            def_file.write(def_line)
-                            previous_line = def_line
+                for uC, uH, atC, atH, _ in mapping.ch_pairs:
+                    def_line = uC + "&" + uH + " " + key + " " + atC + " " + atH + "\n"
+                    if def_line != previous_line:
+                        def_file.write(def_line)
+                        previous_line = def_line
                 def_file.close()
 
                 # Add hydrogens to trajectory and calculate order parameters with buildH
@@ -408,18 +403,7 @@ def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
         # not united-atom cases
         else:
             if 'gromacs' in software:
-                gro = os.path.join(NMLDB_SIMU_PATH, path, 'conf.gro')
-
-                print("\n Making gro file")
-                if g3switch:
-                    rCode = os.system(f'echo System | editconf -f {top_fname} -o {gro}')
-                    if (rCode != 0):
-                        raise RuntimeError("editconf exited with error (see above)")
-                else:
-                    rCode = os.system(f"echo System | gmx trjconv "
-                                      f"-f {trj_fname} -s {top_fname} -dump 0 -o {gro}")
-                    if (rCode != 0):
-                        raise RuntimeError("trjconv exited with error (see above)")
+                gro = _dump_gro(system, top_fname, trj_fname, g3switch)
 
             for key in system['COMPOSITION']:
 
@@ -448,34 +432,188 @@ def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
                     if 'gromacs' in software:
                         try:
                             OrdParam = find_OP(mapping_file, top_fname,
-                                               xtcwhole, resname)
+                                               xtcwhole, resname, n_workers)
                         except Exception as e:
                             logger.warning(f"We got this exception: \n    {e}")
                             logger.warning("But we will try rebuild the Universe "
                                            "from GROM if using tpr did not work!")
-                            OrdParam = find_OP(mapping_file, gro, xtcwhole, resname)
+                            OrdParam = find_OP(mapping_file, gro, xtcwhole, resname,
+                                               n_workers)
 
                     if 'openMM' in software or 'NAMD' in software:
                         OrdParam = find_OP(mapping_file, struc_fname, trj_fname,
-                                           resname)
+                                           resname, n_workers)
+
+                    _write_OPs(OrdParam, outfilename, outfilename2)
+
+        print("Order parameters calculated and saved to ", path)
+
+    except Exception as e:
+        print('Calculation failed for ' + system['path'])
+        print(str(e))
+        print(traceback.format_exc())
+        return RCODE_ERROR
+
+    return RCODE_COMPUTED
+
 
-                    data = {}
+def _whole_trajectory(system: dict, top_fname: str, trj_fname: str,
+                      trjconvCOMMAND: str, unitedAtom: bool = False) -> str:
+    """Make molecules whole in GROMACS trajectory starting from TIMELEFTOUT.
 
-                    with open(outfilename, 'w') as outfile:
-                        outfile.write("Atom     Average OP     OP stem\n")
+    Returns:
+        str: name of the whole trajectory (created only if it doesn't exist)
+    """
+    EQtime = float(system['TIMELEFTOUT'])*1000
+    xtcwhole = os.path.join(NMLDB_SIMU_PATH, system['path'], 'whole.xtc')
+    if (not os.path.isfile(xtcwhole)):
+        execStr = (
+            f"echo System | {trjconvCOMMAND} -f {trj_fname} "
+            f"-s {top_fname} -o {xtcwhole} -pbc mol -b {str(EQtime)}"
+        )
+        print("Make molecules whole in the trajectory")
+        if unitedAtom and system['TRAJECTORY_SIZE'] > 15e9:
+            print("United atom trajectry larger than 15 Gb. "
+                  "Using only every third frame to reduce memory usage.")
+            execStr += " -skip 3"
+        rCode = os.system(execStr)
+        if (rCode != 0):
+            raise RuntimeError("trjconv exited with error (see above)")
+    return xtcwhole
+
+
+def _download_structure(system: dict, struc_fname: str):
+    """Download structure file of openMM/NAMD system if it is absent."""
+    if (not os.path.isfile(struc_fname)):
+        pdb_url = resolve_download_file_url(system.get('DOI'), struc_fname)
+        _ = urllib.request.urlretrieve(pdb_url, struc_fname)
+
+
+def _dump_gro(system: dict, top_fname: str, trj_fname: str, g3switch: bool) -> str:
+    """Write conf.gro of GROMACS system from TPR (for MDAnalysis fallback)."""
+    gro = os.path.join(NMLDB_SIMU_PATH, system['path'], 'conf.gro')
+
+    print("\n Making gro file")
+    if g3switch:
+        rCode = os.system(f'echo System | editconf -f {top_fname} -o {gro}')
+        if (rCode != 0):
+            raise RuntimeError("editconf exited with error (see above)")
+    else:
+        rCode = os.system(f"echo System | gmx trjconv "
+                          f"-f {trj_fname} -s {top_fname} -dump 0 -o {gro}")
+        if (rCode != 0):
+            raise RuntimeError("trjconv exited with error (see above)")
+    return gro
 
-                        for i, op in enumerate(OrdParam):
-                            (op.avg, op.std, op.stem) = op.get_avg_std_stem_OP
-                            outfile.write(f'{op.name} {str(op.avg)} {str(op.stem)}\n')
 
-                            data[str(op.name)] = []
-                            data[str(op.name)].append(op.get_avg_std_stem_OP)
+def _write_OPs(OrdParam: list, outfilename: str, outfilename2: str):
+    """Write computed order parameters into .dat and .json files."""
+    data = {}
 
-                    with open(outfilename2, 'w') as f:
-                        json.dump(data, f, cls=CompactJSONEncoder)
+    with open(outfilename, 'w') as outfile:
+        outfile.write("Atom     Average OP     OP stem\n")
 
-        print("Order parameters calculated and saved to ", path)
+        for i, op in enumerate(OrdParam):
+            (op.avg, op.std, op.stem) = op.get_avg_std_stem_OP
+            outfile.write(f'{op.name} {str(op.avg)} {str(op.stem)}\n')
+
+            data[str(op.name)] = []
+            data[str(op.name)].append(op.get_avg_std_stem_OP)
+            data[str(op.name)].append(op.get_block_stats)
 
+    with open(outfilename2, 'w') as f:
+        json.dump(data, f, cls=CompactJSONEncoder)
+
+
+def computeFused(system: dict, logger: Logger, recompute: bool = False,
+                 n_workers: int = 1) -> int:
+    """Compute apl.json and order parameters reading the trajectory only once.
+
+    All missing analyses are registered as kernels of one
+    :class:`DatabankLib.trajdriver.TrajectoryDriver` pass over the trajectory used
+    for OPs (``whole.xtc`` for GROMACS). United-atom systems, whose OPs are
+    computed by buildH, are processed by :func:`computeAPL` and :func:`computeOP`.
+    With ``n_workers > 1``, OPs are computed by :func:`computeOP` from frame
+    chunks read in parallel, and APL in a separate (cheap) pass.
+
+    Args:
+        system (dict): one of systems of the Databank
+        recompute (bool, optional): recompute existing results. Defaults to False.
+        n_workers (int, optional): number of processes reading frame chunks of
+            the trajectory. Defaults to 1.
+    Returns:
+        int success code (RCODE_...)
+    """
+    software = system['SOFTWARE']
+    if n_workers > 1 or system.get('UNITEDATOM_DICT') or not (
+            'gromacs' in software or 'openMM' in software or 'NAMD' in software):
+        return max(computeAPL(system, logger, recompute),
+                   computeOP(system, logger, recompute, n_workers))
+
+    path = system['path']
+    curPath = os.path.join(NMLDB_SIMU_PATH, path)
+    aplFN = os.path.join(curPath, 'apl.json')
+    doAPL = recompute or not os.path.isfile(aplFN)
+
+    sysWarnings = system.get('WARNINGS')
+    if type(sysWarnings) is not dict:
+        sysWarnings = {}
+    opLipids = [
+        key for key in system['COMPOSITION']
+        if key in lipids_dict and
+        key not in sysWarnings.get('AMBIGUOUS_ATOMNAMES', []) and
+        (recompute or not os.path.isfile(
+            os.path.join(curPath, key + 'OrderParameters.json')))]
+
+    if not doAPL and not opLipids:
+        return RCODE_SKIPPED
+
+    print('Analyzing: ', path)
+    try:
+        # downloads the data
+        _ = system2MDanalysisUniverse(system)
+        struc_fname, top_fname, trj_fname = get_struc_top_traj_fnames(
+            system, joinPath=curPath)
+
+        if 'gromacs' in software:
+            if top_fname is None:
+                raise ValueError("TPR is required for OP calculations!")
+            g3switch = sysWarnings.get('GROMACS_VERSION') == 'gromacs3'
+            trjconvCOMMAND = 'trjconv' if g3switch else 'gmx trjconv'
+            xtcwhole = _whole_trajectory(system, top_fname, trj_fname,
+                                         trjconvCOMMAND)
+            gro = _dump_gro(system, top_fname, trj_fname, g3switch)
+            try:
+                u = mda.Universe(top_fname, xtcwhole)
+            except Exception as e:
+                logger.warning(f"We got this exception: \n    {e}")
+                logger.warning("But we will try rebuild the Universe "
+                               "from GROM if using tpr did not work!")
+                u = mda.Universe(gro, xtcwhole)
+        else:
+            _download_structure(system, struc_fname)
+            u = mda.Universe(struc_fname, trj_fname)
+
+        driver = TrajectoryDriver(u)
+        if doAPL:
+            aplKernel = driver.add(
+                APLKernel(GetNlipids(system), system['TIMELEFTOUT']*1000))
+        ordPars = {}
+        for key in opLipids:
+            print('Calculating ', key, ' order parameters')
+            ordPars[key] = parse_op_input(system['COMPOSITION'][key]['MAPPING'],
+                                          system['COMPOSITION'][key]['NAME'])
+            driver.add(OPKernel(ordPars[key]))
+        driver.run()
+
+        if doAPL:
+            with open(aplFN, 'w') as f:
+                json.dump(aplKernel.apl, f, cls=CompactJSONEncoder)
+        for key, OrdParam in ordPars.items():
+            _write_OPs(OrdParam,
+                       os.path.join(curPath, key + 'OrderParameters.dat'),
+                       os.path.join(curPath, key + 'OrderParameters.json'))
+        print("Fused analyses calculated and saved to ", path)
     except Exception as e:
         print('Calculation failed for ' + system['path'])
         print(str(e))
@@ -485,7 +623,8 @@ def computeOP(system: dict, logger: Logger, recompute: bool = False) -> int:
     return RCODE_COMPUTED
 
 
-def computeFF(system: dict, logger: Logger, recompute: bool = False) -> int:
+def computeFF(system: dict, logger: Logger, recompute: bool = False,
+              n_workers: int = 1, block_frames: int = None) -> int:
     logger.info("System title: " + system['SYSTEM'])
     logger.info("System path: " + system['path'])
     software = system['SOFTWARE']
@@ -691,10 +830,12 @@ def computeFF(system: dict, logger: Logger, recompute: bool = False) -> int:
             try:
                 if 'gromacs' in system['SOFTWARE']:
                     FormFactor(system_path, tpr_name, xtccentered, 200,
-                               output_name, system)
+                               output_name, system, n_workers=n_workers,
+                               block_frames=block_frames)
                 if 'openMM' in system['SOFTWARE'] or 'NAMD' in system['SOFTWARE']:
                     FormFactor(system_path, struc_name, trj_name, 200,
-                               output_name, system)
+                               output_name, system, n_workers=n_workers,
+                               block_frames=block_frames)
             except ValueError as e:
                 # Here it was expected to have allow_pickle-type errors.
                 # but I suppose, we cannot simply ignore them because it means that the
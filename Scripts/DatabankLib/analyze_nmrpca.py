@@ -35,19 +35,17 @@ Alexander Kuzmin
 """
 
 import os
+import sys
 import json
+import hashlib
+import tempfile
 import numpy as np
-from scipy import signal
+from scipy import fft
 import MDAnalysis as mda
 
 from DatabankLib.databankLibrary import lipids_dict, loadMappingFile
 from DatabankLib.databankio import resolve_download_file_url, download_resource_from_uri
-
-from MDAnalysis.analysis.base import AnalysisFromFunction
-import warnings
-# suppress some MDAnalysis warnings issued from mda.analysis.align
-warnings.filterwarnings('ignore')
-from MDAnalysis.analysis import align  # noqa
+from DatabankLib.trajdriver import FrameKernel, TrajectoryDriver
 
 # TODO: now there are only regular phospholipids.
 # The list should be verified by method authors.
@@ -61,6 +59,32 @@ ALLOWLIPIDS = [
 mergeCutoff = 2.0
 trjSizeCutoff = 5000000000
 
+SCRATCH_DIR = os.environ.get("NMLDB_SCRATCH_DIR")
+"""
+Directory for memory-mapped concatenated trajectories (environment variable
+NMLDB_SCRATCH_DIR). If not set, they are created next to the trajectory, since
+the system temporary directory is often a RAM-backed tmpfs.
+"""
+
+CONCAT_CHUNK_FRAMES = 100
+""" Number of frames buffered before writing into the concatenated trajectory """
+
+ALIGN_CHUNK_FRAMES = 10000
+""" Number of frames of the concatenated trajectory superimposed at once """
+
+PCA_CHUNK_FRAMES = 10000
+""" Number of frames of the aligned trajectory processed at once by PCA """
+
+ARTIFACTS_VERSION = 1
+"""
+Version of stored NMR-PCA artifacts; artifacts of other versions are recomputed.
+It must be bumped whenever numerics of Concatenator, PCA or autocorrelations
+change, otherwise stale results are reused.
+"""
+
+ARTIFACTS_TOP_K = 10
+""" Number of principal components stored in NMR-PCA artifacts """
+
 TAILSN1 = "sn-1"
 TAILSN2 = "sn-2"
 HEADGRP = "headgroup"
@@ -267,16 +291,38 @@ class Parser:
         else:
             self.prepareGMXTraj()
 
-    def concatenateTraj(self):
+    def pcaLipids(self):
+        """
+        Lipids of the system analyzed by NMR-PCA
+        """
+        # We do not treat cholesterols
+        return [lipid for lipid in self.lipids if lipid in ALLOWLIPIDS]
+
+    def artifactsPath(self, lipid):
+        """
+        Path of stored NMR-PCA artifacts of the lipid
+        """
+        return os.path.join(self.indexingPath, f"NMRPCA_{lipid}.npz")
+
+    def artifactsKey(self, lipid):
+        """
+        Hash identifying inputs of NMR-PCA of the lipid: trajectory, its
+        length, lipid entry of the composition and frame skipping.
+        """
+        inputs = [ARTIFACTS_VERSION, self.trj, self.size, self.trjLen,
+                  self.composition[lipid], self.size > trjSizeCutoff]
+        return hashlib.sha1(
+            json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def concatenateTraj(self, lipids=None):
         """
         Create Concatenator and corresponding concatenated trajectories for
-        all lipids available for the trajectory.
+        all lipids available for the trajectory (or only for given lipids).
         """
 
         self.concatenated_trajs = []
-        for lipid in self.lipids:
-            if lipid not in ALLOWLIPIDS:
-                # We do not treat cholesterols
+        for lipid in self.pcaLipids():
+            if lipids is not None and lipid not in lipids:
                 continue
             topology = Topology(
                 self.FF,
@@ -287,7 +333,8 @@ class Parser:
             concatenator = Concatenator(topology,
                                         self.traj,
                                         lipid,
-                                        self.composition[lipid]["NAME"])
+                                        self.composition[lipid]["NAME"],
+                                        SCRATCH_DIR or self.indexingPath)
             self.concatenated_trajs.append(concatenator.concatenate())
 
     def dumpData(self, data):
@@ -460,18 +507,22 @@ class Concatenator:
     4. The enveloping concatenate method
     """
 
-    def __init__(self, topology, traj, lipid_name, lipid_resname):
+    def __init__(self, topology, traj, lipid_name, lipid_resname,
+                 scratch_dir=None):
         """
         Constructor for Concatenator:
             topology      - topology for lipid
             traj          - MDAnalysis trajectory
             lipid_name    - lipid name in the databank
             lipid_resname - lipid resname in the trajectory
+            scratch_dir   - directory for the memory-mapped concatenated
+                            trajectory (default: system temporary directory)
         """
         self.topology = topology
         self.traj = traj
         self.lipid_name = lipid_name
         self.lipid_resname = lipid_resname
+        self.scratch_dir = scratch_dir
 
         if self.topology.isMergeNeeded():
             self.headlist, self.tail1list, self.tail2list = \
@@ -488,7 +539,8 @@ class Concatenator:
         coordinates from trajectory, next, it reshapes the coordinate array, swaps
         time and resid axes to obtain continuous trajectories of individual lipids
         (this is needed for autocorrelation time analysis), and finally merges
-        individual lipid trajectories.
+        individual lipid trajectories. Coordinates are streamed into a
+        memory-mapped array (see streamConcatenated).
         """
         traj = self.traj.trajectory
         n_frames = len(traj)
@@ -503,28 +555,8 @@ class Concatenator:
         if n_lipid * n_atoms_lipid != heavy_atoms_topology.n_atoms:
             n_lipid = heavy_atoms_topology.n_atoms // n_atoms_lipid
 
-        # Get all coordinates n_frames, n_lipid * n_atoms_lipid
-        coords = (
-            AnalysisFromFunction(lambda ag: ag.positions.copy(),
-                                 heavy_atoms_topology)
-            .run()
-            .results["timeseries"]
-        )
-        # Adding axis to separate individual lipid trajectories
-        coords = coords.reshape((n_frames, n_lipid, n_atoms_lipid, 3))
-        # Swapping time frame with lipid axis
-        # Now we have continuous lipid trajectory
-        coords = np.swapaxes(coords, 0, 1)
-        # Reshaping to desired shape
-        coords = coords.reshape((n_frames * n_lipid, n_atoms_lipid, 3))
-
-        # Creating new Universe from the concatenated coordinates
-        atom_resindex = np.repeat(0, n_atoms_lipid)
-        concatenated_traj = mda.Universe.empty(
-            n_atoms_lipid, 1, atom_resindex=atom_resindex, trajectory=True
-        )
-        concatenated_traj.add_TopologyAttr("resname", [self.lipid_resname])
-        concatenated_traj.load_new(coords, in_memory=False)
+        concatenated_traj = self.streamConcatenated(
+            heavy_atoms_topology, n_lipid, n_atoms_lipid)
 
         return concatenated_traj, n_lipid, n_frames * n_lipid
 
@@ -536,6 +568,8 @@ class Concatenator:
         the coordinate array, swaps time and resid axes to obtain continuous
         trajectories of individual lipids (this is needed for autocorrelation
         time analysis), and finally merges individual lipid trajectories.
+        Coordinates are streamed into a memory-mapped array (see
+        streamConcatenated).
         """
         traj = self.traj.trajectory
         n_frames = len(traj)
@@ -557,51 +591,40 @@ class Concatenator:
         # TODO: add check
         # n_atoms_lipid == heavy_atoms_topology.n_atoms
 
-        # Get all coordinates n_frames, n_lipid * n_atoms_lipid
-        coords = (
-            AnalysisFromFunction(lambda ag: ag.positions.copy(),
-                                 heavy_atoms_topology)
-            .run()
-            .results["timeseries"]
-        )
-        # Adding axis to separate individual lipid trajectories
-        coords = coords.reshape((n_frames, n_lipid, n_atoms_lipid, 3))
-        # Swapping time frame with lipid axis
-        # Now we have continuous lipid trajectory
-        coords = np.swapaxes(coords, 0, 1)
-        # Reshaping to desired shape
-        coords = coords.reshape((n_frames * n_lipid, n_atoms_lipid, 3))
-
-        # Creating new Universe from the concatenated coordinates
-        atom_resindex = np.repeat(0, n_atoms_lipid)
-        concatenated_traj = mda.Universe.empty(
-            n_atoms_lipid, 1, atom_resindex=atom_resindex, trajectory=True
-        )
-        concatenated_traj.add_TopologyAttr("resname", [self.lipid_resname])
-        concatenated_traj.load_new(coords, in_memory=False)
+        concatenated_traj = self.streamConcatenated(
+            heavy_atoms_topology, n_lipid, n_atoms_lipid)
 
         return concatenated_traj, n_lipid, n_frames * n_lipid
 
+    def streamConcatenated(self, atoms, n_lipid, n_atoms_lipid):
+        """
+        streamConcatenated reads the trajectory once and writes coordinates of
+        atoms directly into a memory-mapped array in lipid-major order, so that
+        the concatenated trajectory doesn't have to fit into RAM. Returns the
+        array of shape (n_lipid * n_frames, n_atoms_lipid, 3).
+        """
+        n_frames = len(self.traj.trajectory)
+        kernel = ConcatenationKernel(atoms, n_lipid, n_atoms_lipid, n_frames,
+                                     self.scratch_dir)
+        TrajectoryDriver(self.traj, [kernel]).run(progress=False)
+        return kernel.coords
+
     """
     alignTraj alignes the concatenated trajectory in two steps: (1) it computes
     average structure after alignment to the first frame, and (2) it alignes
-    the structure to the calculated average structure in (1).
+    the structure to the calculated average structure in (1). The trajectory is
+    aligned in place.
     """
-    def alignTraj(self, concatenated_traj):
+    @staticmethod
+    def alignTraj(concatenated_traj):
+        n_frames = len(concatenated_traj)
         # Compute average structure after alignment to the first frame
-        av = align.AverageStructure(concatenated_traj, ref_frame=0).run()
+        av = superimpose(concatenated_traj, concatenated_traj[0]) / n_frames
         # Align to average structure
-        align.AlignTraj(concatenated_traj, av.results.universe).run()
-        # Compute average structure after second alignment
-        coords = (
-            AnalysisFromFunction(
-                lambda ag: ag.positions.copy(),
-                concatenated_traj.select_atoms("all")
-            )
-            .run()
-            .results["timeseries"]
-        )
-        return coords.reshape(-1, 3), coords.mean(axis=0).reshape(1, -1)
+        total = superimpose(concatenated_traj, av, out=concatenated_traj)
+        # Average structure after second alignment
+        return (concatenated_traj.reshape(-1, 3),
+                (total / n_frames).reshape(1, -1))
 
     """
     Simple enveloping function to perform concatenation
@@ -619,19 +642,159 @@ class Concatenator:
         return aligned_traj, av_pos, n_lipid, n_frames, self.lipid_name
 
 
+def superimpose(coords, ref, out=None):
+    """
+    Batched Kabsch superposition minimizing unweighted RMSD of every frame of
+    coords (n_frames, n_atoms, 3) to ref (n_atoms, 3). Frames are processed in
+    chunks of ALIGN_CHUNK_FRAMES in double precision, so coords may be a
+    memory-mapped array. Aligned frames are centered at the center of ref and
+    written to out (which can be coords itself) if it is given.
+    Returns the sum of aligned frames.
+    """
+    ref = np.asarray(ref, dtype=np.float64)
+    ref_center = ref.mean(axis=0)
+    ref = ref - ref_center
+    total = np.zeros_like(ref)
+    for start in range(0, len(coords), ALIGN_CHUNK_FRAMES):
+        chunk = np.array(coords[start:start + ALIGN_CHUNK_FRAMES],
+                         dtype=np.float64)
+        chunk -= chunk.mean(axis=1, keepdims=True)
+        # SVD of correlation matrices of all frames at once
+        u, _, vt = np.linalg.svd(np.einsum("fai,aj->fij", chunk, ref))
+        # Avoid reflections
+        u[:, :, 2] *= np.where(np.linalg.det(u @ vt) < 0, -1.0, 1.0)[:, None]
+        chunk = chunk @ (u @ vt)
+        chunk += ref_center
+        total += chunk.sum(axis=0)
+        if out is not None:
+            out[start:start + len(chunk)] = chunk
+    return total
+
+
+def scratch_array(shape, dtype=np.float32, directory=None):
+    """
+    Writable array memory-mapped to an anonymous temporary file in directory
+    (default: system temporary directory). The file is deleted as soon as the
+    array is released.
+    """
+    with tempfile.TemporaryFile(dir=directory) as f:
+        return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+
+class ConcatenationKernel(FrameKernel):
+    """
+    Class ConcatenationKernel writes coordinates of n_lipid lipids with
+    n_atoms_lipid atoms each into the array coords of shape
+    (n_lipid * n_frames, n_atoms_lipid, 3), where frames of every lipid
+    form a continuous trajectory. Frames are buffered and written in blocks of
+    CONCAT_CHUNK_FRAMES frames.
+    """
+
+    def __init__(self, atoms, n_lipid, n_atoms_lipid, n_frames, scratch_dir=None):
+        """
+        Constructor for ConcatenationKernel:
+            atoms         - AtomGroup ordered lipid by lipid
+            n_lipid       - number of lipids
+            n_atoms_lipid - number of atoms in a lipid
+            n_frames      - number of frames in the trajectory
+            scratch_dir   - directory for the memory-mapped array
+        """
+        self.atoms = atoms
+        self.coords = scratch_array((n_lipid * n_frames, n_atoms_lipid, 3),
+                                    directory=scratch_dir)
+        self._lipids = self.coords.reshape(n_lipid, n_frames, n_atoms_lipid, 3)
+        self._buffer = np.empty(
+            (min(CONCAT_CHUNK_FRAMES, n_frames), n_lipid, n_atoms_lipid, 3),
+            dtype=np.float32)
+        self._idx = np.zeros(0, dtype=np.intp)
+        self._nbuf = 0
+        self._frame = 0
+
+    def setup(self, u):
+        self._idx = self.atoms.indices
+        self._nbuf = 0
+        self._frame = 0
+
+    def add_timestep(self, ts):
+        self._buffer[self._nbuf] = ts.positions[self._idx].reshape(
+            self._buffer.shape[1:])
+        self._nbuf += 1
+        if self._nbuf == len(self._buffer):
+            self._flush()
+
+    def _flush(self):
+        # Swapping time frame with lipid axis
+        start = self._frame
+        self._lipids[:, start:start + self._nbuf] = \
+            self._buffer[:self._nbuf].swapaxes(0, 1)
+        self._frame += self._nbuf
+        self._nbuf = 0
+
+    def finish(self):
+        self._flush()
+
+
+class CovarianceAccumulator:
+    """
+    Class CovarianceAccumulator computes covariance matrix of a data stream. It
+    keeps the number of samples, the sum and the sum of outer products of samples
+    in double precision. Accumulators of parts of data (e.g. from parallel
+    workers) can be merged.
+    """
+
+    def __init__(self, n_features):
+        """
+        Constructor for CovarianceAccumulator:
+            n_features - dimension of samples
+        """
+        self.n = 0
+        self.sum = np.zeros(n_features)
+        self.outer = np.zeros((n_features, n_features))
+
+    def add(self, X):
+        """
+        Add samples X of shape (n_samples, n_features)
+        """
+        X = np.asarray(X, dtype=np.float64)
+        self.n += len(X)
+        self.sum += X.sum(axis=0)
+        self.outer += X.T @ X
+        return self
+
+    def merge(self, other):
+        """
+        Add statistics of other accumulator
+        """
+        self.n += other.n
+        self.sum += other.sum
+        self.outer += other.outer
+        return self
+
+    def mean(self):
+        """
+        Mean of samples
+        """
+        return self.sum / self.n
+
+    def covariance(self):
+        """
+        Sample covariance matrix (normalized by n - 1)
+        """
+        return (self.outer - np.outer(self.sum, self.sum) / self.n) / (self.n - 1)
+
+
 class PCA:
     """
     Class PCA is a class that actually performs PCA. It has the following methods:
     1. Simple constructor, which sets the aligned trajtory, average coordinates,
     number of lipids, number of frames in the concatenated trajectory and
     trajectory length in ns
-    2. PCA prepares the trajectory coordinates for analysis and calculates
-    principal components
+    2. PCA streams centered trajectory coordinates and calculates principal
+    components
     3. get_proj projects the trajectory on principal components
-    4. get_lipid_autocorrelation calculates the autocorrelation timeseries for
-    individual lipid
-    5. get_autocorrelations calculates the autocorrelation timeseries for
-    trajectory
+    4. get_autocorrelations calculates the autocorrelation timeseries of
+    individual lipids and averages them
+    5. save and load store and restore the results (artifacts)
     """
 
     def __init__(self, aligned_traj, av_pos, n_lipid, n_frames, traj_time):
@@ -650,70 +813,104 @@ class PCA:
         self.n_frames = n_frames
         self.traj_time = traj_time
 
+    def chunks(self):
+        """
+        Generator of centered coordinates of the aligned trajectory in chunks of
+        PCA_CHUNK_FRAMES frames, shape (frames, 3 * atoms), double precision.
+        """
+        X = self.aligned_traj.reshape(self.n_frames, self.av_pos.shape[1])
+        for start in range(0, self.n_frames, PCA_CHUNK_FRAMES):
+            # centering of positions relative to the origin
+            yield X[start:start + PCA_CHUNK_FRAMES].astype(np.float64) \
+                - self.av_pos
+
     def PCA(self):
         """
-        PCA calculates the PCA. First the data is centered and then covariance
-        matrix is calculated manually.
-        """
-        # centering of positions relative to the origin
-        X = self.aligned_traj.astype(np.float64)
-        X = X.reshape(self.n_frames, self.av_pos.shape[1]) - self.av_pos
-        # the sum of all coordinates (to calculate mean)
-        X_1 = X.sum(axis=0)
-        # production of X and X^T
-        X_X = np.tensordot(X, X, axes=(0, 0))
-        # covariance matrix calculation
-        cov_mat = (
-            X_X
-            - np.dot(X_1.reshape(len(X_1), 1), (X_1.reshape(len(X_1), 1)).T)
-            / self.n_frames
-        ) / (self.n_frames - 1)
+        PCA calculates the PCA. The data is centered and the covariance matrix
+        is accumulated chunk by chunk, so memory doesn't depend on the
+        trajectory length.
+        """
+        cov = CovarianceAccumulator(self.av_pos.shape[1])
+        for X in self.chunks():
+            cov.add(X)
         # eigenvalues and eigenvectors calculation
-        eig_vals, eig_vecs = np.linalg.eigh(cov_mat)
+        eig_vals, eig_vecs = np.linalg.eigh(cov.covariance())
+        self.eig_vals = np.flip(eig_vals)
         self.eig_vecs = np.flip(eig_vecs, axis=1).T
 
-        return X
-
-    def get_proj(self, cdata):
+    def get_proj(self, cdata=None):
         """
-        Projecting the trajectory on the 1st principal component
+        Projecting the trajectory on the 1st principal component. The centered
+        data are taken chunk by chunk from the aligned trajectory if cdata is
+        not given.
         """
+        if cdata is None:
+            cdata = self.chunks()
+        else:
+            cdata = [cdata]
         # projection on PC1
-        proj = np.tensordot(cdata, self.eig_vecs[0:1], axes=(1, 1)).T
-        proj = np.concatenate(np.array(proj), axis=None)
-
-        self.proj = proj
+        self.proj = np.concatenate([X @ self.eig_vecs[0] for X in cdata])
 
-    def get_lipid_autocorrelation(self, data, variance, mean):
+    def save(self, fname, key, k=ARTIFACTS_TOP_K):
         """
-        Autocorrelation calculation for individual lipid.
+        Atomically store the average structure, top-k eigenvalues and
+        eigenvectors, PC1 projections and autocorrelation into a compressed
+        .npz file. key identifies the inputs (see Parser.artifactsKey).
+        Failing to write is not an error: the file is just a cache.
         """
-        # Centering the data
-        data -= mean
-        # Convolve the data
-        r = signal.fftconvolve(data, data[::-1], mode="full")[-len(data):]
-        # Weight the correlation to get the result in range -1 to 1
-        return r / (variance * (np.arange(len(data), 0, -1)))
+        tmpname = f"{fname}.{os.getpid()}.tmp"
+        try:
+            with open(tmpname, "wb") as f:
+                np.savez_compressed(
+                    f, key=np.array(key), av_pos=self.av_pos,
+                    eig_vals=self.eig_vals[:k], eig_vecs=self.eig_vecs[:k],
+                    proj=self.proj, autocorrelation=self.autocorrelation,
+                    n_lipid=self.n_lipid, n_frames=self.n_frames,
+                    traj_time=self.traj_time)
+            os.replace(tmpname, fname)
+        except OSError as e:
+            print(f"PCA: WARNING: cannot write artifacts ({e})", file=sys.stderr)
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+
+    @classmethod
+    def load(cls, fname, key):
+        """
+        Load PCA results stored by save. Returns None if there is no file, or
+        it was computed for other inputs (key). The aligned trajectory is not
+        stored.
+        """
+        try:
+            with np.load(fname) as data:
+                if str(data["key"]) != key:
+                    return None
+                pca = cls(None, data["av_pos"], int(data["n_lipid"]),
+                          int(data["n_frames"]), float(data["traj_time"]))
+                pca.eig_vals = data["eig_vals"]
+                pca.eig_vecs = data["eig_vecs"]
+                pca.proj = data["proj"]
+                pca.autocorrelation = data["autocorrelation"]
+                return pca
+        except (OSError, KeyError, ValueError):
+            return None
 
-    def get_autocorrelations(self):
+    def get_autocorrelations(self, dtype=np.float64):
         """
-        Autocorrelation calculation for the trajectory.
+        Autocorrelation calculation for the trajectory. Autocorrelations of all
+        lipids are calculated at once with zero-padded FFT along the time axis.
+        dtype=np.float32 halves the memory for very long trajectories.
         """
         variance = self.proj.var()
         mean = self.proj.mean()
         # extract the trajectories for individual lipids
-        separate_projs = [
-            self.proj[
-                len(self.proj) * i // self.n_lipid:len(self.proj)
-                * (i + 1) // self.n_lipid]
-            for i in range(self.n_lipid)
-        ]
+        separate_projs = (self.proj - mean).astype(dtype).reshape(self.n_lipid, -1)
+        n = separate_projs.shape[1]
+        nfft = fft.next_fast_len(2 * n - 1, real=True)
         # calculate autocorrelations for individual lipids
-        R = np.array(
-            [self.get_lipid_autocorrelation(x, variance, mean)
-                for x in separate_projs]
-        )
-        R = R.mean(axis=0)
+        F = fft.rfft(separate_projs, n=nfft, axis=1)
+        R = fft.irfft(F * F.conj(), n=nfft, axis=1)[:, :n]
+        # Weight the correlation to get the result in range -1 to 1
+        R = R.mean(axis=0) / (variance * np.arange(n, 0, -1))
         T = np.arange(len(R)) * self.traj_time / len(R)
         self.autocorrelation = np.array([T, R]).T
 
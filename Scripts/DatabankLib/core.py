@@ -5,17 +5,75 @@ Can be imported without additional libraries to scan Databank system file tree!
 """
 
 import os
+import re
+import sys
 import yaml
+import pickle
+import collections
 import collections.abc
+from concurrent.futures import ProcessPoolExecutor
 from DatabankLib import NMLDB_SIMU_PATH
 
+INDEX_VERSION: int = 2
+""" Version of the on-disk README index format. Bump it on format changes. """
+
+PARALLEL_PARSE_MIN: int = 64
+""" Minimal number of README files to parse in a process pool instead of serially """
+
+INDEXED_FIELDS = ['COMPOSITION', 'FF', 'SOFTWARE', 'DOI', 'EXPERIMENT']
+""" README fields for which SystemsCollection maintains inverted indexes """
+
+# libyaml-based FullLoader is ~6 times faster than the pure-Python one
+_YamlLoader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+
+def _index_keys(system: dict, field: str) -> list:
+    """
+    Keys under which ``system`` is put into the inverted index of ``field``:
+    molecule names for COMPOSITION, experiment paths relative to the experiments
+    folder for EXPERIMENT, and the value itself for other fields.
+    """
+    if field == 'COMPOSITION':
+        return list(system.get('COMPOSITION') or {})
+    if field == 'EXPERIMENT':
+        keys = []
+        exps = system.get('EXPERIMENT') or {}
+        for dois in (exps.get('ORDERPARAMETER') or {}).values():
+            for path in (dois or {}).values():
+                keys.append(os.path.join('OrderParameters', path))
+        if isinstance(exps.get('FORMFACTOR'), str):
+            keys.append(os.path.join('FormFactors', exps['FORMFACTOR']))
+        return keys
+    value = system.get(field)
+    if value is None or not isinstance(value, collections.abc.Hashable):
+        return []
+    return [value]
+
+
+def _gen_secondary_indexes(systems) -> dict:
+    """ Build {field: {key: [positions]}} inverted indexes over ``systems`` """
+    indexes = {field: {} for field in INDEXED_FIELDS}
+    for i, system in enumerate(systems):
+        for field in INDEXED_FIELDS:
+            for key in _index_keys(system, field):
+                positions = indexes[field].setdefault(key, [])
+                if not positions or positions[-1] != i:
+                    positions.append(i)
+    return indexes
+
 
 class SystemsCollection(collections.abc.Sequence):
-    """Immutable collection of system dicts. Can be accessed by ID using loc()."""
+    """
+    Immutable collection of system dicts. Can be accessed by ID using loc() and
+    by values of :data:`INDEXED_FIELDS` using lookup(). Inverted indexes are
+    built on first access unless they are given.
+    """
 
-    def __init__(self, iterable=[]):
+    def __init__(self, iterable=[], indexes: dict = None):
         self.data = iterable
+        self._table = None
         self.__genIndexByID()
+        self._sidx = indexes
 
     def __genIndexByID(self):
         self._idx = dict()
@@ -32,6 +90,141 @@ class SystemsCollection(collections.abc.Sequence):
     def loc(self, id: int):
         return self.data[self._idx[id]]
 
+    @property
+    def indexes(self) -> dict:
+        """ Inverted indexes {field: {key: [positions]}}. Built on first access. """
+        if self._sidx is None:
+            self._sidx = _gen_secondary_indexes(self)
+        return self._sidx
+
+    def lookup(self, field: str, key):
+        """
+        Return the collection of systems having ``key`` in the ``field``, e.g.
+        ``lookup('COMPOSITION', 'POPC')``, ``lookup('SOFTWARE', 'gromacs')`` or
+        ``lookup('EXPERIMENT', 'OrderParameters/10.1039/c2cp42738a/1')``.
+
+        :param field: one of :data:`INDEXED_FIELDS`
+        :param key: value (molecule name, experiment path, ...) to look up
+        """
+        if field not in INDEXED_FIELDS:
+            raise KeyError(f"There is no index for the field '{field}'")
+        positions = self.indexes[field].get(key, [])
+        return SystemsCollection([self[i] for i in positions])
+
+    @property
+    def table(self):
+        """
+        Columnar view of the collection (:class:`DatabankLib.query.SystemsTable`).
+        Built on first access. Requires numpy.
+        """
+        if self._table is None:
+            from DatabankLib.query import SystemsTable
+            self._table = SystemsTable(self)
+        return self._table
+
+    def filter(self, mask=None, **conditions):
+        """
+        Return a new collection of systems matching boolean ``mask`` (array aligned
+        with the collection) and column ``conditions`` (see
+        :meth:`DatabankLib.query.SystemsTable.mask`).
+        """
+        m = self.table.mask(**conditions)
+        if mask is not None:
+            m &= mask
+        return SystemsCollection([self[int(i)] for i in m.nonzero()[0]])
+
+    def select(self, *names, mask=None, **conditions) -> dict:
+        """
+        Return columns ``names`` for systems matching ``mask`` and ``conditions``
+        as a dictionary of numpy arrays.
+        """
+        m = self.table.mask(**conditions)
+        if mask is not None:
+            m &= mask
+        return self.table.select(*names, mask=m)
+
+
+class LazySystemsCollection(SystemsCollection):
+    """
+    Collection of systems which knows only IDs and paths up front. README.yaml of
+    a system is parsed on first access and kept in an LRU cache of ``cache_size``
+    parsed dicts.
+
+    NOTE: evicted dicts are re-read from disk, so in-place modifications of system
+    dicts are not preserved. Use the regular collection for that.
+    """
+
+    def __init__(self, root: str, paths: list, ids: list, cache_size: int = 128):
+        self.root = root
+        self.paths = paths
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._table = None
+        self._sidx = None
+        self._idx = {sid: i for i, sid in enumerate(ids) if sid is not None}
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("SystemsCollection index out of range")
+        try:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        except KeyError:
+            pass
+        content = _load_readme(os.path.join(self.root, self.paths[i], 'README.yaml'))
+        content["path"] = self.paths[i]
+        self._cache[i] = content
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return content
+
+    def __len__(self):
+        return len(self.paths)
+
+    def loc(self, id: int):
+        return self[self._idx[id]]
+
+
+def _load_readme(filepath: str) -> dict:
+    """ Parse single README.yaml file """
+    with open(filepath) as yaml_file:
+        content = yaml.load(yaml_file, Loader=_YamlLoader)
+    return content
+
+
+def _load_readmes(filepaths: list, nproc: int = None) -> list:
+    """
+    Parse many README.yaml files. Large batches are distributed over a process
+    pool. Results are returned in the order of ``filepaths``.
+    """
+    if nproc is None:
+        nproc = os.cpu_count() or 1
+    nproc = min(nproc, len(filepaths) // (PARALLEL_PARSE_MIN // 2))
+    if nproc > 1 and len(filepaths) >= PARALLEL_PARSE_MIN:
+        chunksize = max(1, len(filepaths) // (4 * nproc))
+        try:
+            with ProcessPoolExecutor(max_workers=nproc) as executor:
+                return list(executor.map(_load_readme, filepaths,
+                                         chunksize=chunksize))
+        except (OSError, RuntimeError) as e:
+            # e.g. process spawning is not permitted; go serial
+            print(f"WARNING: parallel README parsing failed ({e})", file=sys.stderr)
+    return [_load_readme(fp) for fp in filepaths]
+
+
+_readme_id_re = re.compile(r'^ID:\s*(\d+)\s*$', re.MULTILINE)
+
+
+def _scan_readme_id(filepath: str):
+    """ Get system ID from README.yaml without parsing it. Returns None if absent. """
+    with open(filepath) as f:
+        m = _readme_id_re.search(f.read())
+    return None if m is None else int(m.group(1))
+
 
 class databank:
     """ :meta private:
@@ -48,39 +241,139 @@ class databank:
                 print(system)
     """
 
-    def __init__(self):
+    def __init__(self, use_index: bool = True, lazy: bool = False, nproc: int = None):
         self.path = NMLDB_SIMU_PATH
-        __systems = self.__load_systems__()
-        self._systems = SystemsCollection(__systems)
+        self.use_index = use_index
+        self.nproc = nproc
+        if lazy:
+            self._systems = self.__scan_systems__()
+        else:
+            __systems, __indexes = self.__load_systems__()
+            self._systems = SystemsCollection(__systems, __indexes)
         print('Databank initialized from the folder:', os.path.realpath(self.path))
 
+    @property
+    def index_path(self) -> str:
+        """ Location of the README index file (next to the simulations folder). """
+        rpath = os.path.realpath(self.path)
+        return os.path.join(os.path.dirname(rpath),
+                            '.' + os.path.basename(rpath) + '_index.pkl')
+
+    def __read_index__(self) -> dict:
+        """
+        Read the README index from disk. Returns empty dict if the index is absent,
+        corrupted or has an outdated format. Otherwise, returns dict with
+        'entries' (README relpath -> (stamp, content)) and 'secondary' (inverted
+        indexes over entries in their order).
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"WARNING: README index is unreadable and will be rebuilt ({e})",
+                  file=sys.stderr)
+            return {}
+        if not isinstance(index, dict) or index.get('version') != INDEX_VERSION:
+            return {}
+        return index
+
+    def __write_index__(self, entries: dict, secondary: dict):
+        """
+        Atomically write the README index. Failing to write (e.g. read-only
+        Databank folder) is not an error: the index is just a cache.
+        """
+        tmpname = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmpname, 'wb') as f:
+                pickle.dump({'version': INDEX_VERSION, 'entries': entries,
+                             'secondary': secondary},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self.index_path)
+        except OSError as e:
+            print(f"WARNING: cannot write README index ({e})", file=sys.stderr)
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+
+    def __scan_systems__(self) -> LazySystemsCollection:
+        """
+        Collect paths and IDs of all systems without parsing README files.
+        """
+        rpath = os.path.realpath(self.path)
+        paths = []
+        ids = []
+        for subdir, dirs, files in os.walk(rpath):
+            if "README.yaml" in files:
+                filepath = os.path.join(subdir, "README.yaml")
+                paths.append(os.path.relpath(filepath, rpath)[:-11])
+                ids.append(_scan_readme_id(filepath))
+        return LazySystemsCollection(rpath, paths, ids)
+
     def __load_systems__(self):
-        systems = []
+        """
+        Collect README.yaml contents of all systems. README files are stat-ed and
+        compared (mtime, size) against the on-disk index; only new or modified
+        READMEs are parsed (in parallel if there are many of them). The order of
+        systems is the order of the folder walk.
+
+        :return: (list of systems, secondary indexes or None if not known)
+        """
         rpath = os.path.realpath(self.path)
+        index = self.__read_index__() if self.use_index else {}
+        stored = index.get('entries', {})
+        entries = {}
+        toparse = []
         for subdir, dirs, files in os.walk(rpath):
             for filename in files:
+                if filename != "README.yaml":
+                    continue
                 filepath = os.path.join(subdir, filename)
-                if filename == "README.yaml":
-                    with open(filepath) as yaml_file:
-                        content = yaml.load(yaml_file, Loader=yaml.FullLoader)
-                        relpath = os.path.relpath(filepath, rpath)
-                        content["path"] = relpath[:-11]
-                        systems.append(content)
-        return systems
+                relpath = os.path.relpath(filepath, rpath)
+                st = os.stat(filepath)
+                stamp = (st.st_mtime_ns, st.st_size)
+                cached = stored.get(relpath)
+                if cached is not None and cached[0] == stamp:
+                    entries[relpath] = cached
+                else:
+                    entries[relpath] = (stamp, None)
+                    toparse.append(relpath)
+
+        contents = _load_readmes([os.path.join(rpath, rp) for rp in toparse],
+                                 self.nproc)
+        for relpath, content in zip(toparse, contents):
+            entries[relpath] = (entries[relpath][0], content)
+
+        systems = []
+        for relpath, (stamp, content) in entries.items():
+            content["path"] = relpath[:-11]
+            systems.append(content)
+        if not self.use_index:
+            return systems, None
+        if not toparse and list(entries) == list(stored):
+            return systems, index['secondary']
+        secondary = _gen_secondary_indexes(systems)
+        self.__write_index__(entries, secondary)
+        return systems, secondary
 
     def get_systems(self):
         """ Returns a list of all systems in the NMRlipids databank """
         return self._systems
 
 
-def initialize_databank():
+def initialize_databank(use_index: bool = True, lazy: bool = False):
     """
     Intializes the NMRlipids databank.
 
+    :param use_index: use (and update) the on-disk README index instead of parsing
+                      all README.yaml files.
+    :param lazy: only collect IDs and paths, README.yaml files are parsed on
+                 first access (see :class:`LazySystemsCollection`).
+
     :return: list of dictionaries that contain the content of README.yaml files for
              each system.
     """
-    db_data = databank()
+    db_data = databank(use_index, lazy)
     return db_data.get_systems()
 
 
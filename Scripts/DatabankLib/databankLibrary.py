@@ -14,6 +14,8 @@ import json
 import yaml
 import os
 import sys
+import pickle
+import types
 import numpy as np
 import math
 import MDAnalysis as mda
@@ -22,9 +24,17 @@ from DatabankLib import NMLDB_SIMU_PATH, NMLDB_ROOT_PATH
 from DatabankLib.settings.molecules import (
     lipids_dict, molecules_dict, molecule_ff_dict)
 from DatabankLib.databankio import resolve_download_file_url
+from DatabankLib.mapping import Mapping
+from DatabankLib.trajdriver import TrajectoryDriver, PNAngleKernel
 
 logger = logging.getLogger(__name__)
 
+MAPPING_DIR = os.path.join(NMLDB_ROOT_PATH, 'Scripts', 'DatabankLib', 'mapping_files')
+""" Folder with mapping files """
+
+MAPPING_STORE_VERSION: int = 1
+""" Format version of the precompiled mapping store """
+
 
 def CalcAreaPerMolecule(system):
     """
@@ -119,12 +129,10 @@ def getLipids(system, molecules=lipids_dict.keys()):
     resSet = set()
     for key in system['COMPOSITION'].keys():
         if key in molecules:
-            m_file = system['COMPOSITION'][key]['MAPPING']
-            mapping_dict = loadMappingFile(m_file)
-            try:
-                for atom in mapping_dict:
-                    resSet.add(mapping_dict[atom]['RESIDUE'])
-            except (KeyError, TypeError):
+            mapping = loadMapping(system['COMPOSITION'][key]['MAPPING'])
+            if mapping.multiresidue:
+                resSet.update(mapping.residues)
+            else:
                 resSet.add(system['COMPOSITION'][key]['NAME'])
 
     lipids = 'resname ' + ' or resname '.join(sorted(list(resSet)))
@@ -143,14 +151,14 @@ def simulation2universal_atomnames(system, molecule, atom):
     :return: force field specific atom name
     """
     try:
-        mapping = loadMappingFile(system['COMPOSITION'][molecule]['MAPPING'])
+        mapping = loadMapping(system['COMPOSITION'][molecule]['MAPPING'])
     except Exception:
         sys.stderr.write('Mapping file was not found!\n')
         return None
 
     try:
-        m_atom1 = mapping[atom]["ATOMNAME"]
-    except (KeyError, TypeError):
+        m_atom1 = mapping.atomname(atom)
+    except KeyError:
         sys.stderr.write(
             f"{atom} was not found from {system['COMPOSITION'][molecule]['MAPPING']}!")
         return None
@@ -158,22 +166,132 @@ def simulation2universal_atomnames(system, molecule, atom):
     return m_atom1
 
 
+def _freeze(obj):
+    """ Recursively convert dicts to read-only mappings and lists to tuples """
+    if isinstance(obj, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def _mapping_stamp(path: str) -> tuple:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def mappingStorePath(mapping_dir: str = None) -> str:
+    """ Path of the precompiled mapping store (next to the mapping folder) """
+    mapping_dir = os.path.normpath(mapping_dir or MAPPING_DIR)
+    return os.path.join(os.path.dirname(mapping_dir),
+                        '.' + os.path.basename(mapping_dir) + '_index.pkl')
+
+
+# process-wide cache: mapping file path -> (stamp, frozen mapping)
+_mapping_cache = {}
+# compiled mappings: mapping file path -> (frozen mapping, Mapping)
+_compiled_cache = {}
+# precompiled store: mapping file name -> (stamp, mapping dict); None = not read yet
+_mapping_store = None
+
+
+def _read_mapping_store() -> dict:
+    global _mapping_store
+    if _mapping_store is None:
+        _mapping_store = {}
+        try:
+            with open(mappingStorePath(), 'rb') as f:
+                store = pickle.load(f)
+            if store.get('version') == MAPPING_STORE_VERSION:
+                _mapping_store = store['entries']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Precompiled mapping store is not readable: {e}")
+    return _mapping_store
+
+
+def compileMappingFiles(mapping_dir: str = None) -> str:
+    """
+    Parse all mapping files of ``mapping_dir`` and store them in a binary file
+    which is then used by :func:`loadMappingFile` instead of parsing YAML. Entries
+    are validated by modification time and size of the mapping file, so
+    the store doesn't need to be rebuilt after every change of mapping files.
+
+    :param mapping_dir: folder with mapping files (default: :data:`MAPPING_DIR`)
+
+    :return: path of the written store
+    """
+    global _mapping_store
+    mapping_dir = mapping_dir or MAPPING_DIR
+    entries = {}
+    for fname in sorted(os.listdir(mapping_dir)):
+        fpath = os.path.join(mapping_dir, fname)
+        if not fname.endswith('.yaml') or not os.path.isfile(fpath):
+            continue
+        stamp = _mapping_stamp(fpath)
+        with open(fpath, "r") as yaml_file:
+            entries[fname] = (stamp, yaml.load(yaml_file, Loader=yaml.FullLoader))
+    spath = mappingStorePath(mapping_dir)
+    tmppath = f"{spath}.{os.getpid()}.tmp"
+    with open(tmppath, 'wb') as f:
+        pickle.dump({'version': MAPPING_STORE_VERSION, 'entries': entries},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath, spath)
+    _mapping_store = None
+    return spath
+
+
 def loadMappingFile(mapping_file):
     """
-    Load mapping file into a dictionary
+    Load mapping file into a dictionary.
+
+    Parsed mappings are cached for the whole process and re-read only if the file
+    was modified. If the precompiled store (see :func:`compileMappingFiles`) is
+    present and up to date, YAML is not parsed at all. The returned mapping is
+    shared between callers and therefore read-only.
 
     :param: name of the mapping file
 
-    :return: mapping dictionary
+    :return: mapping dictionary (read-only)
     """
-    mapping_file_path = os.path.join(
-        NMLDB_ROOT_PATH, 'Scripts', 'DatabankLib', 'mapping_files', mapping_file)
-    mapping_dict = {}
-    with open(mapping_file_path, "r") as yaml_file:
-        mapping_dict = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    mapping_file_path = os.path.join(MAPPING_DIR, mapping_file)
+    stamp = _mapping_stamp(mapping_file_path)
+    cached = _mapping_cache.get(mapping_file_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    stored = _read_mapping_store().get(mapping_file)
+    if stored is not None and stored[0] == stamp:
+        mapping_dict = stored[1]
+    else:
+        with open(mapping_file_path, "r") as yaml_file:
+            mapping_dict = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    mapping_dict = _freeze(mapping_dict)
+    _mapping_cache[mapping_file_path] = (stamp, mapping_dict)
     return mapping_dict
 
 
+def loadMapping(mapping_file) -> Mapping:
+    """
+    Load mapping file as a compiled :class:`DatabankLib.mapping.Mapping` object
+    providing O(1) forward and reverse atom name lookups. Objects are cached
+    in the same way as in :func:`loadMappingFile`.
+
+    :param: name of the mapping file
+
+    :return: Mapping object
+    """
+    mapping_dict = loadMappingFile(mapping_file)
+    key = os.path.join(MAPPING_DIR, mapping_file)
+    cached = _compiled_cache.get(key)
+    if cached is not None and cached[0] is mapping_dict:
+        return cached[1]
+    mapping = Mapping(mapping_dict or {}, mapping_file)
+    _compiled_cache[key] = (mapping_dict, mapping)
+    return mapping
+
+
 def getAtoms(system, lipid):
     """
     Return system specific atom names of a lipid
@@ -184,11 +302,8 @@ def getAtoms(system, lipid):
     :return: string of system specific atom names
     """
 
-    atoms = ""
-    path_to_mapping_file = system['COMPOSITION'][lipid]['MAPPING']
-    mapping_dict = loadMappingFile(path_to_mapping_file)
-    for key in mapping_dict:
-        atoms = atoms + ' ' + mapping_dict[key]['ATOMNAME']
+    mapping = loadMapping(system['COMPOSITION'][lipid]['MAPPING'])
+    atoms = ''.join(' ' + mapping.atomname(key) for key in mapping)
 
     return atoms
 
@@ -210,12 +325,9 @@ def getUniversalAtomName(system: dict, atomName: str, lipid: str):
         sys.stderr.write('Mapping file was not found!\n')
         return None
 
-    mappingDict = loadMappingFile(mappingFile)
-
-    for universalName in mappingDict:
-        simName = mappingDict[universalName]['ATOMNAME']
-        if simName == atomName:
-            return universalName
+    universalName = loadMapping(mappingFile).universal(atomName)
+    if universalName is not None:
+        return universalName
 
     sys.stderr.write('Atom was not found!\n')
     return None
@@ -379,28 +491,14 @@ def read_trj_PN_angles(molname: str, atom1: str, atom2: str, MDAuniverse: mda.Un
                     the average angle over time and molecules,
                     the error of the mean calculated over molecules)
     """
-    mol = MDAuniverse
-    selection = mol.select_atoms(
-        "resname " + molname + " and (name " + atom1 + ")",
-        "resname " + molname + " and (name " + atom2 + ")",
-    ).atoms.split("residue")
-    com = mol.select_atoms(
-        "resname " + molname + " and (name " + atom1 + " or name " + atom2 + ")"
-    ).center_of_mass()
-
-    Nres = len(selection)
-    Nframes = len(mol.trajectory)
-    angles = np.zeros((Nres, Nframes))
+    kernel = PNAngleKernel(molname, atom1, atom2)
+    TrajectoryDriver(MDAuniverse, [kernel]).run(progress=False)
+    angles = kernel.angles
+    Nres, Nframes = angles.shape
 
     resAverageAngles = [0] * Nres
     resSTDerror = [0] * Nres
-    j = 0
 
-    for frame in mol.trajectory:
-        for i in range(0, Nres):
-            residue = selection[i]
-            angles[i, j] = calc_angle(residue, com[2])
-        j = j + 1
     for i in range(0, Nres):
         resAverageAngles[i] = sum(angles[i, :]) / Nframes
         resSTDerror[i] = np.std(angles[i, :])
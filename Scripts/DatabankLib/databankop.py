@@ -14,17 +14,27 @@
 """
 
 import sys
-import re
+from concurrent.futures import ProcessPoolExecutor
 import MDAnalysis as mda
 import numpy as np
 import warnings  # TODO: should we change to NMRlipids' logger?
 from tqdm import tqdm
 
-from DatabankLib.databankLibrary import loadMappingFile
+from DatabankLib.databankLibrary import loadMapping
+from DatabankLib.trajdriver import FrameKernel
 
 bond_len_max = 1.5  # in A, max distance between atoms for reasonable OP calculation
 bond_len_max_sq = bond_len_max**2
 
+OP_CHUNK_FRAMES = 100
+"""
+Trajectory is processed in chunks of this many frames. Partial statistics of chunks
+are reduced in chunk order, so the result does not depend on the number of workers.
+"""
+
+OP_N_BLOCKS = 10
+""" Number of time blocks used for block averaging of OPs """
+
 
 class OrderParameter:
     """
@@ -79,6 +89,8 @@ class OrderParameter:
                 f" Args: {args}\nWrong file format?"
             )
         self.traj = []  # for storing OPs
+        self.traj_std = []  # time fluctuations of OPs
+        self.blocks = []  # OP averaged over residues in every time block
         self.selection = []
 
     @staticmethod
@@ -121,6 +133,24 @@ class OrderParameter:
         # convert to numpy array
         return (np.mean(self.traj), std, std / np.sqrt(len(self.traj) - 1))
 
+    @property
+    def get_block_se(self):
+        """
+        Provides block-averaged standard error of OP (None if less than 2 blocks,
+        so that it is written as JSON null)
+        """
+        if len(self.blocks) < 2:
+            return None
+        return np.std(self.blocks, ddof=1) / np.sqrt(len(self.blocks))
+
+    @property
+    def get_block_stats(self):
+        """
+        Provides dictionary with block-averaged standard error and per-block
+        time series of OP
+        """
+        return {'BLOCK_SE': self.get_block_se, 'BLOCKS': list(self.blocks)}
+
     @property
     def get_op_res(self):
         """
@@ -131,7 +161,69 @@ class OrderParameter:
         return self.traj
 
 
-def read_trajs_calc_OPs(ordPars, top, trajs):
+class OPAccumulator:
+    """
+    :meta private:
+
+    Online (Welford) accumulator of OP values of atom pairs in time blocks.
+    Keeps frame count, mean and sum of squared deviations of every pair in every
+    block, so memory is O(pairs x blocks). Accumulators of different frame ranges
+    are combined with :meth:`merge`.
+    """
+
+    def __init__(self, npairs: int, nframes: int, nblocks: int = None):
+        self.nframes = nframes
+        self.nblocks = max(1, min(nblocks or OP_N_BLOCKS, nframes))
+        self.count = np.zeros(self.nblocks, dtype=np.int64)
+        self.mean = np.zeros((self.nblocks, npairs))
+        self.m2 = np.zeros((self.nblocks, npairs))
+
+    def add(self, frame: int, S: np.ndarray):
+        """ Add OP values ``S`` of all pairs in the trajectory frame ``frame`` """
+        b = frame * self.nblocks // self.nframes
+        self.count[b] += 1
+        delta = S - self.mean[b]
+        self.mean[b] += delta / self.count[b]
+        self.m2[b] += delta * (S - self.mean[b])
+
+    @staticmethod
+    def _combine(na, ma, m2a, nb, mb, m2b):
+        """ Chan et al. pairwise combination of (count, mean, M2) """
+        n = na + nb
+        if np.ndim(n) == 0:
+            if n == 0:
+                return n, ma, m2a
+            delta = mb - ma
+            return n, ma + delta * (nb / n), m2a + m2b + delta**2 * (na * nb / n)
+        nz = n > 0
+        wb = np.zeros(n.shape)
+        wab = np.zeros(n.shape)
+        wb[nz] = nb[nz] / n[nz]
+        wab[nz] = na[nz] * nb[nz] / n[nz]
+        delta = mb - ma
+        return (n, ma + delta * wb[:, None],
+                m2a + m2b + delta**2 * wab[:, None])
+
+    def merge(self, other: 'OPAccumulator'):
+        """ Add statistics of ``other`` accumulated over different frames """
+        self.count, self.mean, self.m2 = OPAccumulator._combine(
+            self.count, self.mean, self.m2, other.count, other.mean, other.m2)
+
+    def total(self):
+        """
+        Statistics over all frames.
+
+        Returns:
+            (mean, std): per-pair mean and standard deviation over time
+        """
+        n, mean, m2 = 0, np.zeros(self.mean.shape[1]), np.zeros(self.mean.shape[1])
+        for b in range(self.nblocks):
+            n, mean, m2 = OPAccumulator._combine(
+                n, mean, m2, self.count[b], self.mean[b], self.m2[b])
+        return mean, np.sqrt(m2 / max(n, 1))
+
+
+def read_trajs_calc_OPs(ordPars, top, trajs, n_workers: int = 1):
     """
     :meta private:
 
@@ -147,10 +239,49 @@ def read_trajs_calc_OPs(ordPars, top, trajs):
         filename of a top file (e.g. conf.gro)
     trajs : list of strings
         filenames of trajectories
+    n_workers : int
+        number of worker processes reading frame chunks of the trajectory, each
+        with its own Universe. Results are identical to a serial run.
     """
     # read-in topology and trajectory
     mol = mda.Universe(top, trajs)
 
+    _select_OPs(mol, ordPars)
+
+    # all C-H pairs of all OPs are gathered into two index arrays; pairs of
+    # op number k occupy the slice bounds[k]:bounds[k+1]
+    idxA, idxB, bounds = _op_index_arrays(ordPars)
+
+    # go through trajectory chunk-by-chunk
+    Nframes = len(mol.trajectory)
+    chunks = [(start, min(start + OP_CHUNK_FRAMES, Nframes))
+              for start in range(0, Nframes, OP_CHUNK_FRAMES)]
+    acc = OPAccumulator(len(idxA), Nframes)
+    with tqdm(total=Nframes) as pbar:
+        if n_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(
+                    max_workers=min(n_workers, len(chunks)),
+                    initializer=_init_OP_worker,
+                    initargs=(top, trajs, idxA, idxB, acc.nblocks)) as executor:
+                for (start, stop), part in zip(
+                        chunks, executor.map(_OP_chunk_worker, chunks)):
+                    acc.merge(part)
+                    pbar.update(stop - start)
+        else:
+            for start, stop in chunks:
+                acc.merge(_accumulate_OPs(mol, idxA, idxB, acc.nblocks, start, stop))
+                pbar.update(stop - start)
+
+    _store_OPs(ordPars, acc, bounds)
+
+
+def _select_OPs(mol, ordPars):
+    """
+    :meta private:
+
+    Select atom pairs of every OP (stored as ``op.selection``) in Universe
+    ``mol``. OPs with improper selections are removed from ``ordPars``.
+    """
     # make atom selections for each OP and store it as its attribute for later use
     # in trajectory
     c = -1
@@ -179,7 +310,7 @@ def read_trajs_calc_OPs(ordPars, top, trajs):
                     f"Selection >> name {atA} {atB} << "
                     f"contains {nat} atoms, but should contain exactly 2!")
                 improperOPs.append(c)
-                continue
+                break
 
         op.selection = selection
 
@@ -188,20 +319,114 @@ def read_trajs_calc_OPs(ordPars, top, trajs):
     for i in improperOPs:
         del ordPars[i]
 
-    # go through trajectory frame-by-frame
-    Nframes = len(mol.trajectory)
-    for op in ordPars:
-        # print(op.selection)
-        Nres = len(op.selection)
-        op.traj = [0] * Nres
 
-    for frame in tqdm(mol.trajectory):
-        for op in ordPars:  # .values():
-            Nres = len(op.selection)
-            for i in range(0, Nres):
-                residue = op.selection[i]
-                S = OrderParameter.calc_OP(residue)
-                op.traj[i] = op.traj[i] + S / Nframes
+def _store_OPs(ordPars, acc, bounds):
+    """
+    :meta private:
+
+    Store statistics of the accumulator in OrderParameter instances.
+    """
+    means, stds = acc.total()
+    for k, op in enumerate(ordPars):
+        op.traj = means[bounds[k]:bounds[k + 1]].tolist()
+        # standard deviation of OP of every residue over time
+        op.traj_std = stds[bounds[k]:bounds[k + 1]].tolist()
+        op.blocks = acc.mean[:, bounds[k]:bounds[k + 1]].mean(axis=1).tolist()
+
+
+class OPKernel(FrameKernel):
+    """
+    :meta private:
+
+    Trajectory driver kernel (see :mod:`DatabankLib.trajdriver`) accumulating OPs
+    of ``ordPars``. Results are stored in the OrderParameter instances after the
+    pass, as in :func:`read_trajs_calc_OPs`.
+    """
+
+    def __init__(self, ordPars, nblocks: int = None):
+        self.ordPars = ordPars
+        self.nblocks = nblocks
+
+    def setup(self, u):
+        self.mol = u
+        _select_OPs(u, self.ordPars)
+        self.idxA, self.idxB, self.bounds = _op_index_arrays(self.ordPars)
+        self.acc = OPAccumulator(len(self.idxA), len(u.trajectory), self.nblocks)
+
+    def add_timestep(self, ts):
+        self.acc.add(ts.frame, _frame_OPs(self.mol, self.idxA, self.idxB, ts))
+
+    def finish(self):
+        _store_OPs(self.ordPars, self.acc, self.bounds)
+
+
+# per-process state of OP workers: (Universe, idxA, idxB, nblocks)
+_OP_worker = None
+
+
+def _init_OP_worker(top, trajs, idxA, idxB, nblocks):
+    global _OP_worker
+    _OP_worker = (mda.Universe(top, trajs), idxA, idxB, nblocks)
+
+
+def _OP_chunk_worker(chunk):
+    return _accumulate_OPs(*_OP_worker, *chunk)
+
+
+def _op_index_arrays(ordPars):
+    """
+    :meta private:
+
+    Concatenate atom indices of all residue selections of all OPs.
+
+    Returns:
+        (idxA, idxB, bounds): indices of the first and the second atoms of every
+        pair and offsets of every OP in these arrays
+    """
+    pairs = [res.ix for op in ordPars for res in op.selection]
+    pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+    bounds = np.cumsum([0] + [len(op.selection) for op in ordPars])
+    return pairs[:, 0], pairs[:, 1], bounds
+
+
+def _accumulate_OPs(mol, idxA, idxB, nblocks, start, stop):
+    """
+    :meta private:
+
+    Evaluate S = 1/2 * (3*cos(theta)^2 - 1) of every atom pair in trajectory
+    frames [start:stop]. All pairs are evaluated in one array expression per frame.
+
+    Returns:
+        OPAccumulator with statistics of the frames
+    """
+    acc = OPAccumulator(len(idxA), len(mol.trajectory), nblocks)
+    for ts in mol.trajectory[start:stop]:
+        acc.add(ts.frame, _frame_OPs(mol, idxA, idxB, ts))
+    return acc
+
+
+def _frame_OPs(mol, idxA, idxB, ts):
+    """
+    :meta private:
+
+    S of every atom pair in the frame ``ts``
+    """
+    vec = ts.positions[idxB].astype(np.float64) - ts.positions[idxA]
+    d2 = np.einsum('ij,ij->i', vec, vec)
+    if (d2 > bond_len_max_sq).any():
+        _warn_long_bonds(mol, idxA, idxB, d2)
+    return 1.5 * np.square(vec[:, 2]) / d2 - 0.5
+
+
+def _warn_long_bonds(mol, idxA, idxB, d2):
+    for i in np.flatnonzero(d2 > bond_len_max_sq):
+        at1 = mol.atoms[idxA[i]]
+        at2 = mol.atoms[idxB[i]]
+        warnings.warn(
+            f"Atomic distance for atoms"
+            f"{at1.name} and {at2.name} in residue no. {at1.resid} is suspiciously "
+            f"long: {np.sqrt(d2[i])}!\nPBC removed???"
+        )
 
 
 def parse_op_input(mapping_file: str, lipid_name: str):
@@ -215,53 +440,13 @@ def parse_op_input(mapping_file: str, lipid_name: str):
         array: List of OrderParameter instances
     """
     ordPars = []
-    atomC = []
-    atomH = []
-    resname = lipid_name
-    mapping_dict = loadMappingFile(mapping_file)
-
-    regexp1_H = re.compile(r"M_[A-Z0-9]*C[0-9]*H[0-9]*_M")
-    regexp2_H = re.compile(r"M_G[0-9]*H[0-9]*_M")
-    regexp3_H = re.compile(r"M_C[0-9]*H[0-9]*_M")
-    regexp1_C = re.compile(r"M_[A-Z0-9]*C[0-9]*_M")
-    regexp2_C = re.compile(r"M_G[0-9]{1,2}_M")
-    regexp3_C = re.compile(r"M_C[0-9]{1,2}_M")
-
-    for mapping_key in mapping_dict.keys():
-        if (
-            regexp1_C.search(mapping_key)
-            or regexp2_C.search(mapping_key)
-            or regexp3_C.search(mapping_key)
-        ):
-            atomC = [mapping_key, mapping_dict[mapping_key]["ATOMNAME"]]
-            try:
-                resname = mapping_dict[mapping_key]["RESIDUE"]
-            except (KeyError, TypeError):
-                pass
-            atomH = []
-        elif (
-            regexp1_H.search(mapping_key)
-            or regexp2_H.search(mapping_key)
-            or regexp3_H.search(mapping_key)
-        ):
-            atomH = [mapping_key, mapping_dict[mapping_key]["ATOMNAME"]]
-        else:
-            atomC = []
-            atomH = []
-
-        if atomH and not len(atomC):
-            print(
-                f"Cannot define carbon for the hydrogen {atomH[0]} ({atomH[1]})",
-                file=sys.stderr)
-            continue
-        if atomH and len(atomC):
-            items = [atomC[1], atomH[1], atomC[0], atomH[0]]
-            op = OrderParameter(resname, items[0], items[1], items[2], items[3])
-            ordPars.append(op)
+    for uC, uH, atC, atH, resname in loadMapping(mapping_file).ch_pairs:
+        ordPars.append(OrderParameter(resname or lipid_name, atC, atH, uC, uH))
     return ordPars
 
 
-def find_OP(inp_fname: str, top_fname: str, traj_fname: str, lipid_name: str):
+def find_OP(inp_fname: str, top_fname: str, traj_fname: str, lipid_name: str,
+            n_workers: int = 1):
     """Externally used funcion for computing OP values.
 
     Args:
@@ -269,10 +454,11 @@ def find_OP(inp_fname: str, top_fname: str, traj_fname: str, lipid_name: str):
         top_fname (_type_): TPR file
         traj_fname (_type_): TRAJ file
         lipid_name (_type_): lipid name (residue name)
+        n_workers (int): number of processes reading the trajectory in parallel
 
     Returns:
         ordPars: list of OrderParameter instances
     """
     ordPars = parse_op_input(inp_fname, lipid_name)
-    read_trajs_calc_OPs(ordPars, top_fname, traj_fname)
+    read_trajs_calc_OPs(ordPars, top_fname, traj_fname, n_workers)
     return ordPars
@@ -5,10 +5,14 @@ Module form_factor serves for bilayer form factor calculations.
 import sys
 import os
 import re
+import collections
 import MDAnalysis as mda
+from MDAnalysis.lib.mdamath import triclinic_vectors
 import numpy as np
 import json
 import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 from tqdm import tqdm
 
@@ -17,9 +21,22 @@ from tqdm import tqdm
 # the universal mapping file
 import periodictable
 
-from DatabankLib.databankLibrary import lipids_dict, loadMappingFile, getLipids
+from DatabankLib.databankLibrary import lipids_dict, loadMapping, getLipids, MAPPING_DIR
 from DatabankLib.jsonEncoders import CompactJSONEncoder
 from DatabankLib import NMLDB_ROOT_PATH
+from DatabankLib.trajdriver import FrameKernel
+
+FF_CHUNK_FRAMES = 100
+"""
+Trajectory is processed in chunks of this many frames. Partial histograms of chunks
+are reduced in chunk order, so the result does not depend on the number of workers.
+"""
+
+HISTOGRAMS_FILE = "DensityHistograms.npz"
+""" Raw density histograms written by FormFactor (see DensityHistograms) """
+
+WEIGHTS_CACHE_VERSION = 1
+""" Version of per-system weights cache files; bump to invalidate old caches """
 
 
 # To write data in numpy arrays into json file, we inherit compact JSON
@@ -32,6 +49,506 @@ class NumpyArrayEncoder(CompactJSONEncoder):
             return CompactJSONEncoder.encode(self, o)
 
 
+class DensityKernel(FrameKernel):
+    """
+    Fused per-frame density kernel.
+
+    Every frame, the system is centered on the center of mass of lipids and
+    wrapped along z arithmetically (the Universe is not modified). Then all density
+    groups -- total (centered), lipids (not centered), lipids and waters (centered)
+    -- are binned by one ``np.bincount`` over concatenated bin indices. All work
+    arrays are allocated once.
+
+    Accumulated histograms are divided by the bin volume of every frame, but not
+    by the number of frames. If ``block_frames`` is given, histograms of every block
+    of that many consecutive frames are accumulated separately as well.
+    """
+
+    GROUPS = ('total', 'lipids_no_center', 'lipids', 'waters')
+
+    def __init__(self, weights, lipid_idx, water_idx, lipid_masses, nbin, boxH,
+                 block_frames=None):
+        """
+        :param weights: weights (electrons, masses, ...) of all atoms
+        :param lipid_idx: indices of lipid atoms (the centering group)
+        :param water_idx: indices of water atoms
+        :param lipid_masses: masses of lipid atoms
+        :param nbin: number of bins
+        :param boxH: length of the histogram range (nm)
+        :param block_frames: number of frames in a block (None: no blocks)
+        """
+        n, nl, nw = len(weights), len(lipid_idx), len(water_idx)
+        self.nbin = nbin
+        self.boxH = boxH
+        self.lipid_idx = np.asarray(lipid_idx, dtype=np.intp)
+        self.water_idx = np.asarray(water_idx, dtype=np.intp)
+        self.mfrac = np.asarray(lipid_masses, dtype=np.float64)
+        self.mfrac = self.mfrac / self.mfrac.sum()
+        weights = np.asarray(weights, dtype=np.float64)
+        self.weights = np.concatenate((weights, weights[self.lipid_idx],
+                                       weights[self.lipid_idx],
+                                       weights[self.water_idx]))
+        # z coordinates of all groups; slices are views of the same buffer
+        self._z = np.empty(len(self.weights))
+        self._zall = self._z[:n]
+        self._zl = self._z[n:n+nl]
+        self._zlc = self._z[n+nl:n+2*nl]
+        self._zwc = self._z[n+2*nl:]
+        # lower edge of histogram range and bin offset of every element
+        self._lo = np.full(len(self.weights), -boxH/2)
+        self._lo[n:n+nl] = 0
+        self._offset = np.repeat(
+            np.arange(len(self.GROUPS), dtype=np.intp) * nbin, [n, nl, nl, nw])
+        self.dump = len(self.GROUPS) * nbin  # bin for out-of-range values
+        self._tmp = np.empty(n)
+        self._bf = np.empty(len(self.weights))
+        self._bi = np.empty(len(self.weights), dtype=np.intp)
+        self._mask = np.empty(len(self.weights), dtype=bool)
+        self._mask2 = np.empty(len(self.weights), dtype=bool)
+
+        self.hist = np.zeros(len(self.GROUPS) * nbin)
+        self.nframes = 0
+        self.min_z = np.inf
+        self.box_z = []  # box z of every frame (nm)
+        self.block_frames = block_frames
+        self.blocks = {}  # block index -> [histograms, number of frames]
+
+    def add_frame(self, positions, dimensions, frame=None):
+        """
+        Add one frame.
+
+        :param positions: (n_atoms, 3) coordinates (A)
+        :param dimensions: box ``[lx, ly, lz, alpha, beta, gamma]``
+        :param frame: index of the frame in the trajectory (defines the block;
+                      default: number of frames added so far)
+        """
+        if frame is None:
+            frame = self.nframes
+        box_z = dimensions[2]
+        self.min_z = min(self.min_z, box_z/10)
+        self.box_z.append(float(box_z)/10)
+        self.nframes += 1
+        # box height used for wrapping (differs from box_z for triclinic boxes)
+        cz = triclinic_vectors(dimensions)[2, 2]
+
+        zall = self._zall
+        np.copyto(zall, positions[:, 2])
+        np.take(zall, self.lipid_idx, out=self._zl)
+        ctom = self._zl @ self.mfrac
+        # not centered lipids (nm)
+        self._zl *= 0.1
+
+        # move the center of mass of lipids to box/2 and put atoms into the box
+        zall += box_z/2 - ctom
+        np.divide(zall, cz, out=self._tmp)
+        np.floor(self._tmp, out=self._tmp)
+        self._tmp *= cz
+        zall -= self._tmp
+        # center of the box to 0 (nm)
+        zall -= box_z/2
+        zall *= 0.1
+        np.take(zall, self.lipid_idx, out=self._zlc)
+        np.take(zall, self.water_idx, out=self._zwc)
+
+        # bin indices; the upper edge belongs to the last bin as in np.histogram
+        bf = self._bf
+        np.subtract(self._z, self._lo, out=bf)
+        bf *= self.nbin / self.boxH
+        np.equal(bf, self.nbin, out=self._mask)
+        np.putmask(bf, self._mask, self.nbin - 1)
+        np.clip(bf, -1, self.nbin, out=bf)
+        np.floor(bf, out=bf)
+        np.equal(bf, -1, out=self._mask)
+        np.equal(bf, self.nbin, out=self._mask2)
+        np.logical_or(self._mask, self._mask2, out=self._mask)
+        np.copyto(self._bi, bf, casting='unsafe')
+        self._bi += self._offset
+        np.putmask(self._bi, self._mask, self.dump)
+
+        # volume of the bin in nm^3
+        vbin = self.boxH / self.nbin * dimensions[0] * dimensions[1] / 100
+        counts = np.bincount(self._bi, weights=self.weights, minlength=self.dump + 1)
+        counts = counts[:self.dump] / vbin
+        self.hist += counts
+        if self.block_frames:
+            block = self.blocks.setdefault(frame // self.block_frames,
+                                           [np.zeros_like(self.hist), 0])
+            block[0] += counts
+            block[1] += 1
+
+    def add_timestep(self, ts):
+        """ Add frame ``ts`` (see :mod:`DatabankLib.trajdriver`) """
+        self.add_frame(ts.positions, ts.dimensions, ts.frame)
+
+    def reset(self):
+        """ Clear accumulated histograms """
+        self.hist[:] = 0
+        self.nframes = 0
+        self.min_z = np.inf
+        self.box_z = []
+        self.blocks = {}
+
+    def partial(self) -> tuple:
+        """
+        Accumulated state as (histograms, number of frames, minimal box z,
+        box z of every frame, block histograms)
+        """
+        blocks = {b: [h.copy(), nf] for b, (h, nf) in self.blocks.items()}
+        return self.hist.copy(), self.nframes, self.min_z, list(self.box_z), blocks
+
+    def merge(self, partial: tuple):
+        """ Add the state returned by :meth:`partial` of another kernel """
+        hist, nframes, min_z, box_z, blocks = partial
+        self.hist += hist
+        self.nframes += nframes
+        self.min_z = min(self.min_z, min_z)
+        self.box_z.extend(box_z)
+        for b, (h, nf) in blocks.items():
+            block = self.blocks.setdefault(b, [np.zeros_like(self.hist), 0])
+            block[0] += h
+            block[1] += nf
+
+    def profiles(self):
+        """ Frame-averaged density profiles, shape (len(GROUPS), nbin) """
+        return self.hist.reshape(len(self.GROUPS), self.nbin) / self.nframes
+
+
+class DensityHistograms:
+    """
+    Un-cropped density histograms accumulated over the whole trajectory together
+    with box z of every frame. They are stored by :class:`FormFactor` in
+    :data:`HISTOGRAMS_FILE`, so that density profiles, form factors (with other
+    q ranges, coarser bins or bulk windows) and thickness can be recomputed
+    without the trajectory.
+
+    Optionally, histograms of consecutive blocks of frames are stored as well; they
+    give block-resolved form factors and convergence metrics (see
+    :meth:`convergence`).
+    """
+
+    def __init__(self, hist, nframes, box_z, boxH, groups=DensityKernel.GROUPS,
+                 block_hist=None, block_nframes=None, block_frames=None):
+        """
+        :param hist: histograms summed over frames, shape (len(groups), nbin)
+        :param nframes: number of frames
+        :param box_z: box z of every frame (nm)
+        :param boxH: length of the histogram range (nm)
+        :param groups: names of density groups
+        :param block_hist: histograms summed over frames of every block,
+                           shape (nblocks, len(groups), nbin)
+        :param block_nframes: number of frames in every block
+        :param block_frames: nominal number of frames in a block
+        """
+        self.groups = tuple(groups)
+        self.hist = np.asarray(hist, dtype=np.float64).reshape(len(self.groups), -1)
+        self.nframes = int(nframes)
+        self.box_z = np.asarray(box_z, dtype=np.float64)
+        self.boxH = float(boxH)
+        nbin = self.hist.shape[1]
+        if block_hist is None:
+            block_hist = np.zeros((0, len(self.groups), nbin))
+            block_nframes = []
+        self.block_hist = np.asarray(block_hist, dtype=np.float64).reshape(
+            -1, len(self.groups), nbin)
+        self.block_nframes = np.asarray(block_nframes, dtype=np.int64)
+        self.block_frames = int(block_frames or 0)
+
+    @property
+    def nblocks(self) -> int:
+        return len(self.block_nframes)
+
+    @property
+    def nbin(self) -> int:
+        return self.hist.shape[1]
+
+    @classmethod
+    def from_kernel(cls, kernel: DensityKernel):
+        blocks = [kernel.blocks[b] for b in sorted(kernel.blocks)]
+        return cls(kernel.hist, kernel.nframes, kernel.box_z, kernel.boxH,
+                   kernel.GROUPS,
+                   block_hist=[h for h, _ in blocks] if blocks else None,
+                   block_nframes=[nf for _, nf in blocks],
+                   block_frames=kernel.block_frames)
+
+    def save(self, fname: str):
+        """ Write histograms into compressed ``.npz`` file """
+        with open(fname, 'wb') as f:
+            np.savez_compressed(f, hist=self.hist, nframes=self.nframes,
+                                box_z=self.box_z,
+                                boxH=self.boxH, groups=np.array(self.groups),
+                                block_hist=self.block_hist,
+                                block_nframes=self.block_nframes,
+                                block_frames=self.block_frames)
+
+    @classmethod
+    def load(cls, fname: str):
+        with np.load(fname) as data:
+            blocks = {}
+            if 'block_hist' in data:
+                blocks = {k: data[k] for k in
+                          ('block_hist', 'block_nframes', 'block_frames')}
+            return cls(data['hist'], data['nframes'], data['box_z'],
+                       data['boxH'], [str(g) for g in data['groups']], **blocks)
+
+    def _average(self, hist, nframes, nbin):
+        """ Frame-average histograms ``(..., nbin)`` merging adjacent bins """
+        if nbin is None or nbin == self.nbin:
+            nbin, dens = self.nbin, hist / nframes
+        elif self.nbin % nbin:
+            raise ValueError(f"Cannot rebin {self.nbin} bins into {nbin}")
+        else:
+            factor = self.nbin // nbin
+            dens = hist.reshape(*hist.shape[:-1], nbin, factor).sum(axis=-1)
+            dens /= factor * nframes
+        d = self.boxH / nbin
+        x = np.linspace(-self.boxH/2, self.boxH/2, nbin+1)[:-1] + d/2
+        return x, dens
+
+    def profiles(self, nbin: int = None) -> tuple:
+        """
+        Frame-averaged density profiles of all groups on the full histogram range.
+
+        :param nbin: number of bins; must divide the stored number of bins
+                     (adjacent bins are merged). Default: stored bins.
+
+        :return: (bin centers, profiles of shape (len(groups), nbin))
+        """
+        return self._average(self.hist, self.nframes, nbin)
+
+    def block_profiles(self, nbin: int = None) -> tuple:
+        """
+        Density profiles averaged within every block.
+
+        :return: (bin centers, profiles of shape (nblocks, len(groups), nbin))
+        """
+        return self._average(self.block_hist,
+                             self.block_nframes[:, None, None], nbin)
+
+    def crop(self, nbin: int = None) -> tuple:
+        """
+        Indices (start, end) of the bins where all frames contribute, i.e. the
+        bins inside the smallest box of the simulation.
+        """
+        nbin = nbin or self.nbin
+        d = self.boxH / nbin
+        min_z = self.box_z.min()
+        return (int(np.round(nbin/2 - min_z/d/2)) + 1,
+                int(np.round(nbin/2 + min_z/d/2)) - 1)
+
+    def density(self, group: str, nbin: int = None) -> np.ndarray:
+        """ Cropped profile of the density group as (nbins, 2) array ``[x, rho]`` """
+        x, dens = self.profiles(nbin)
+        start, end = self.crop(len(x))
+        data = np.vstack((x, dens[self.groups.index(group)])).transpose()
+        return data[start+1:end-1, :]
+
+    def _absFourier(self, x, total, FF_range, bulk_width):
+        """ |F(q)| of total density profile(s) cropped to the smallest box """
+        start, end = self.crop(len(x))
+        fa, fb = FormFactor.fourier(total[..., start:end], x[end] - x[start],
+                                    FF_range, x[1] - x[0], bulk_width)
+        return np.sqrt(np.multiply(fa, fa) + np.multiply(fb, fb))
+
+    def formFactor(self, FF_range=None, nbin: int = None, bulk_width: float = 0.33):
+        """
+        Form factor of the total (centered) density within the smallest box.
+
+        :param FF_range: q grid in units of 0.01 nm^-1 (default: 0..999)
+        :param nbin: number of bins (see :meth:`profiles`)
+        :param bulk_width: width of the bulk region at profile ends (nm)
+
+        :return: (nq, 2) array ``[q (A^-1), |F(q)|]``
+        """
+        if FF_range is None:
+            FF_range = np.linspace(0, 999, 1000)
+        x, dens = self.profiles(nbin)
+        fourrier_result = self._absFourier(x, dens[0], FF_range, bulk_width)
+        return np.vstack((FF_range*0.1*0.01, fourrier_result)).transpose()
+
+    def blockFormFactors(self, FF_range=None, nbin: int = None,
+                         bulk_width: float = 0.33) -> np.ndarray:
+        """
+        Form factors of the total density of every block (batched Fourier
+        transform). All blocks are cropped to the smallest box of the whole
+        trajectory, so they are directly comparable with :meth:`formFactor`.
+
+        :return: array of |F(q)|, shape (nblocks, nq)
+        """
+        if FF_range is None:
+            FF_range = np.linspace(0, 999, 1000)
+        x, dens = self.block_profiles(nbin)
+        return self._absFourier(x, dens[:, 0], FF_range, bulk_width)
+
+    def convergence(self, FF_range=None, nbin: int = None,
+                    bulk_width: float = 0.33) -> dict:
+        """
+        Convergence metrics of the form factor computed from blocks:
+
+        - ``FF_BLOCK_SE`` -- standard error of |F(q)| over blocks;
+        - ``FF_BLOCK_DEVIATION`` -- RMS deviation of every block form factor from
+          the form factor of the whole trajectory, relative to its RMS;
+        - ``FF_CUMULATIVE_DEVIATION`` -- the same for form factors of the first
+          1, 2, ..., nblocks blocks (the running average converges to 0).
+
+        :return: dictionary of metrics (empty if there are less than 2 blocks)
+        """
+        if self.nblocks < 2:
+            return {}
+        if FF_range is None:
+            FF_range = np.linspace(0, 999, 1000)
+        ff = self.formFactor(FF_range, nbin, bulk_width)[:, 1]
+        ffb = self.blockFormFactors(FF_range, nbin, bulk_width)
+        # form factors of the running averages over blocks
+        x, dens = self._average(np.cumsum(self.block_hist, axis=0),
+                                np.cumsum(self.block_nframes)[:, None, None], nbin)
+        ffc = self._absFourier(x, dens[:, 0], FF_range, bulk_width)
+        norm = np.sqrt(np.mean(ff**2))
+
+        return {
+            'NBLOCKS': self.nblocks,
+            'BLOCK_FRAMES': self.block_frames,
+            'FF_BLOCK_SE': np.std(ffb, axis=0, ddof=1) / np.sqrt(self.nblocks),
+            'FF_BLOCK_DEVIATION': np.sqrt(np.mean((ffb - ff)**2, axis=1)) / norm,
+            'FF_CUMULATIVE_DEVIATION': np.sqrt(np.mean((ffc - ff)**2, axis=1)) / norm,
+        }
+
+    def thickness(self, nbin: int = None) -> float:
+        """ Membrane thickness, see :func:`membraneThickness` """
+        return membraneThickness(self.density('waters', nbin),
+                                 self.density('lipids', nbin))
+
+
+def membraneThickness(wd, ld) -> float:
+    """
+    Membrane thickness defined as the distance between the points where water
+    and lipid densities cross. If there are less than two crossings (dehydrated
+    sample), the length of the profile is returned.
+
+    :param wd: water density profile, (nbins, 2) array ``[x, rho]``
+    :param ld: lipid density profile on the same bins
+
+    :return: thickness (nm)
+    """
+    wd = np.asarray(wd)
+    ld = np.asarray(ld)
+    idx = np.argwhere(np.diff(np.sign(wd[:, 1] - ld[:, 1]))).flatten()
+    if len(idx) < 2:
+        print("Dehydrated sample! Standard thickness rule doesn't work."
+              " Will extract boxZ.")
+        return wd[-1, 0] - wd[0, 0]
+    return wd[idx[1], 0] - wd[idx[0], 0]
+
+
+def _density_chunk(u, kernel, start, stop):
+    """ Accumulate density of frames [start:stop] from scratch """
+    kernel.reset()
+    for ts in u.trajectory[start:stop]:
+        kernel.add_timestep(ts)
+    return kernel.partial()
+
+
+# per-process state of density workers: (Universe, DensityKernel)
+_FF_worker = None
+
+
+def _init_FF_worker(conf, traj, kernel):
+    global _FF_worker
+    _FF_worker = (mda.Universe(conf, traj), kernel)
+
+
+def _FF_chunk_worker(chunk):
+    return _density_chunk(*_FF_worker, *chunk)
+
+
+def accumulate_density(kernel, u, conf, traj, n_workers=1):
+    """
+    Accumulate densities of all frames of the trajectory into ``kernel``.
+
+    Frames are processed in chunks of :data:`FF_CHUNK_FRAMES`; with
+    ``n_workers > 1`` chunks are distributed over processes each opening its own
+    Universe from ``conf`` and ``traj``. Partial histograms are reduced in chunk
+    order, so the result is bit-identical to a serial run.
+
+    :param kernel: DensityKernel
+    :param u: Universe of the trajectory (used in serial mode)
+    :param conf: structure/topology file name
+    :param traj: trajectory file name
+    :param n_workers: number of worker processes
+    """
+    Nframes = len(u.trajectory)
+    chunks = [(start, min(start + FF_CHUNK_FRAMES, Nframes))
+              for start in range(0, Nframes, FF_CHUNK_FRAMES)]
+    partials = []
+    with tqdm(total=Nframes, desc="Iterating over trajectory") as pbar:
+        if n_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(
+                    max_workers=min(n_workers, len(chunks)),
+                    initializer=_init_FF_worker,
+                    initargs=(conf, traj, kernel)) as executor:
+                for (start, stop), part in zip(
+                        chunks, executor.map(_FF_chunk_worker, chunks)):
+                    partials.append(part)
+                    pbar.update(stop - start)
+        else:
+            for start, stop in chunks:
+                partials.append(_density_chunk(u, kernel, start, stop))
+                pbar.update(stop - start)
+    kernel.reset()
+    for part in partials:
+        kernel.merge(part)
+
+
+def weightsCachePath(path: str, kind: str = 'electron') -> str:
+    """ Path of the cached per-atom weights of type ``kind`` in the system folder """
+    return os.path.join(path, f'.{kind}_weights.npz')
+
+
+def weightsKey(files, extra=None) -> str:
+    """
+    Hash identifying per-atom weights: contents of the files they were derived
+    from (topology, mapping files, ...) and a JSON-serializable ``extra`` object.
+    """
+    h = hashlib.sha1(str(WEIGHTS_CACHE_VERSION).encode())
+    for fname in files:
+        h.update(os.path.basename(fname).encode())
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(json.dumps(extra, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def loadWeights(path: str, key: str, n_atoms: int, kind: str = 'electron'):
+    """
+    Load cached per-atom weights of the system. Returns None if there is no cache,
+    or it was computed for other inputs (``key``) or other number of atoms.
+    """
+    try:
+        with np.load(weightsCachePath(path, kind)) as data:
+            if str(data['key']) != key or len(data['weights']) != n_atoms:
+                return None
+            return data['weights']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def saveWeights(path: str, key: str, weights, kind: str = 'electron'):
+    """
+    Atomically store per-atom weights of the system. Failing to write (e.g.
+    read-only folder) is not an error: the file is just a cache.
+    """
+    fname = weightsCachePath(path, kind)
+    tmpname = f"{fname}.{os.getpid()}.tmp"
+    try:
+        with open(tmpname, 'wb') as f:
+            np.savez(f, key=np.array(key), weights=np.asarray(weights))
+        os.replace(tmpname, fname)
+    except OSError as e:
+        print(f"WARNING: cannot write weights cache ({e})", file=sys.stderr)
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+
+
 class FormFactor:
     """
     Calculates form factors from density profiles.
@@ -49,27 +566,16 @@ class FormFactor:
     # Group of static private helper methods
 
     @staticmethod
-    def __listNamePairs(mapping_dict, molecule):
-        pairs_dictionary = {}
-        residues = [mv['RESIDUE']
-                    for _, mv in mapping_dict.items()
-                    if 'RESIDUE' in mv]
-
-        if residues:
-            pairs_dictionary = dict.fromkeys(residues)
-            print(pairs_dictionary.keys())
-            for res in pairs_dictionary.keys():
-                pairs_dictionary[res] = [
-                    [mk, mv['ATOMNAME']]
-                    for mk, mv in mapping_dict.items()
-                    if res == mv['RESIDUE']
-                    ]
-        else:
-            pairs_dictionary = {
-                molecule: [[mn, mv['ATOMNAME']] for mn, mv in mapping_dict.items()]
-            }
-
-        return pairs_dictionary
+    def __matchMappingName(pairs, res, atom):
+        """
+        Find universal name for the force-field atom name ``atom`` of residue
+        ``res``: atom names from the mapping are tried as regular expressions in
+        the mapping order and the first match is returned.
+        """
+        for _un, _an in pairs:
+            if re.match(_an.replace('+', '\\+'), atom):
+                return _un
+        raise ValueError(f"Atom was not found: {res}:{atom}")
 
     @staticmethod
     def __filterHbonds(mapping_names):
@@ -83,8 +589,13 @@ class FormFactor:
 
     # -- regular methods --
 
-    def __init__(self, path, conf, traj, nbin, output, readme, density_type="electron"):
+    def __init__(self, path, conf, traj, nbin, output, readme, density_type="electron",
+                 n_workers=1, block_frames=None):
         self.path = path
+        # number of processes reading frame chunks of the trajectory
+        self.n_workers = n_workers
+        # if set, densities of blocks of this many frames are accumulated as well
+        self.block_frames = block_frames
         self.conf = conf
         self.traj = traj
         self.readme = readme
@@ -127,11 +638,10 @@ class FormFactor:
 
             key2 = self.readme["COMPOSITION"][key1]["NAME"]
             mapping_file = self.readme["COMPOSITION"][key1]["MAPPING"]
-            mapping_dict = loadMappingFile(mapping_file)
 
             # put mapping files into a larger dictionary where molecule name is key and
-            # the dictionary in the correponding mapping file is the value
-            mapping_dictionary[key2] = mapping_dict  # try if this works
+            # the compiled mapping is the value
+            mapping_dictionary[key2] = loadMapping(mapping_file)
 
         return mapping_dictionary
 
@@ -179,8 +689,8 @@ class FormFactor:
         # get the name of molecule used in simulation files
         molname = self.readme['COMPOSITION'][molecule]['NAME']
 
-        pairs_residue = FormFactor.__listNamePairs(
-            self.system_mapping[molname], molname)
+        mapping = self.system_mapping[molname]
+        pairs_residue = mapping.residue_pairs(molname)
 
         # if lipid is split to multiple residues
         selection_txt = ""
@@ -201,25 +711,18 @@ class FormFactor:
             # which PA or PL belongs to POPG or POPE
             selection_txt = selection_txt + "resname " + res
             # explicit atoms of the residue
-            explicit_atoms = list(self.u.select_atoms(selection_txt).atoms.names)
+            explicit_atoms = self.u.select_atoms(selection_txt).atoms.names
+            # electrons of every distinct atom name are found only once
+            res_electrons = {}
             for atom in explicit_atoms:
-                # find generic mapping name matching to forcefield atom name
-                atom_i1 = None
-                for i in range(len(pairs_residue[res])):
-                    _cm = pairs_residue[res][i]  # [UNIQUE_NAME, NAME] pair
-                    if re.match(_cm[1].replace('+', '\\+'), atom):
-                        atom_i1 = i
-                        break
-                if atom_i1 is None:
-                    raise ValueError(f"Atom was not found: {res}:{atom}")
-                # # find mapping name
-                # index_list = [atom in pairs for pairs in pairs_residue[res]]
-                # print (atom, pairs_residue[res])
-                # atom_i1 = index_list.index(True)
-
-                mapping_name = pairs_residue[res][atom_i1][0]
-                # get number of electrons in an atom i of residue
-                e_atom_i = self.getElectrons(mapping_name)
+                e_atom_i = res_electrons.get(atom)
+                if e_atom_i is None:
+                    # find generic mapping name matching to forcefield atom name
+                    mapping_name = FormFactor.__matchMappingName(
+                        pairs_residue[res], res, atom)
+                    # get number of electrons in an atom i of residue
+                    e_atom_i = self.getElectrons(mapping_name)
+                    res_electrons[atom] = e_atom_i
                 electrons.append(e_atom_i)
 
         return electrons
@@ -245,33 +748,35 @@ class FormFactor:
                     molecule2 = self.readme['COMPOSITION'][molecule1]['NAME']
                     electrons = []
 
-                    pairs_residue = FormFactor.__listNamePairs(
-                        self.system_mapping[molecule2], molecule2)
-                    atomsH = FormFactor.__filterHbonds(
-                        self.system_mapping[molecule2].keys())  # list of hydrogen atoms
+                    mapping = self.system_mapping[molecule2]
+                    pairs_residue = mapping.residue_pairs(molecule2)
+                    # how many H are bound to every heavy atom
+                    numbersH = collections.Counter(
+                        re.sub(r'H[1-4]_M', '', atomH)
+                        for atomH in FormFactor.__filterHbonds(mapping.keys()))
 
                     # extract explicit atoms and get the mapping names
                     for res in pairs_residue.keys():
                         # explicit atoms of the residue
-                        explicit_atoms = list(self.u.select_atoms(
-                            "resname " + res).atoms.names)
+                        explicit_atoms = self.u.select_atoms(
+                            "resname " + res).atoms.names
+                        res_electrons = {}
                         for atom in explicit_atoms:
-                            # print(atom)
-                            # find generic mapping name matching to forcefield atom name
-                            index_list = [atom in pairs for pairs in pairs_residue[res]]
-                            atom_i1 = index_list.index(True)
-                            mapping_name = pairs_residue[res][atom_i1][0]
-                            # remove _M from the end of mapping name
-                            name1 = re.sub(r'_M', '', mapping_name[::1])
-
-                            # count how many times name1 occurs in atomsH i.e. how
-                            # many H are bound to it
-                            numberH = sum(
-                                1 for atomH in atomsH
-                                if name1 == re.sub(r'H[1-4]_M', '', atomH[::1])
-                                )
-                            number_e = self.getElectrons(mapping_name)
-                            e_atom_i = number_e + numberH
+                            e_atom_i = res_electrons.get(atom)
+                            if e_atom_i is None:
+                                # find generic mapping name matching to forcefield
+                                # atom name
+                                mapping_name = (mapping.universal(atom, res)
+                                                if mapping.multiresidue
+                                                else mapping.universal(atom))
+                                if mapping_name is None:
+                                    raise ValueError(
+                                        f"Atom was not found: {res}:{atom}")
+                                # remove _M from the end of mapping name
+                                name1 = re.sub(r'_M', '', mapping_name)
+                                number_e = self.getElectrons(mapping_name)
+                                e_atom_i = number_e + numbersH[name1]
+                                res_electrons[atom] = e_atom_i
                             electrons.append(e_atom_i)
 
                     weights.extend(electrons)
@@ -303,6 +808,7 @@ class FormFactor:
            loaded form an external file --> in the future it backmaps
                                             the atom names to mapping files
                                             and automaticaly assigns # of electrons
+         - weights are cached in the system folder (see systemElectronWeights)
 
         Number densities:
          - all weights are 1
@@ -313,8 +819,10 @@ class FormFactor:
         start_time = time.time()
         if self.density_type == "electron":
             # calc weights to calculate the electron density
-            # with the function that maps the electrons to atoms
-            self.wght, self.lipid_wght, self.water_wght = self.assignElectrons()
+            # with the function that maps the electrons to atoms (cached)
+            self.wght = self.systemElectronWeights()
+            self.lipid_wght = self.wght[self.u.select_atoms(self.lipids).indices]
+            self.water_wght = self.wght[self.u.select_atoms(self.waters).indices]
             print("lenght of wght: " + str(len(self.wght)))
             print("lenght of lipid_wght: " + str(len(self.lipid_wght)))
             print("atoms in system: " + str(len(self.u.atoms.names)))
@@ -342,41 +850,29 @@ class FormFactor:
         print("Creating the electron mapping dictonary takes {:10.6f} s"
               .format(time.time()-start_time))
 
-    def calculate_density(self):
-        c = self.u.select_atoms(self.lipids)
-        print(c)  # TODO: remove excessive debug printing!
-
-        box_z = self.u.dimensions[2]  # + 10 if fails
-        print(box_z)
-        d = box_z/10 / self.nbin  # bin width
-        boxH = box_z/10
-        print(boxH)
-        x = np.linspace(-boxH/2, boxH/2, self.nbin+1)[:-1] + d/2
-        density_z_centered = np.zeros(self.nbin)
-        density_z_no_center = np.zeros(self.nbin)
-        density_lipids_center = np.zeros(self.nbin)
-        density_waters_center = np.zeros(self.nbin)
-
-        # Calculte density profiles and FF from individual frames
-        start_time = time.time()
-        min_z = 10000000
-        frame = 0
-
+    def electronNumbers(self):
+        """
+        Return dictionary ``{residue name: {atom name: number of electrons}}`` for
+        all molecules of the system. In united-atom lipids, electrons of implicit
+        hydrogens (according to the buildH JSON of the lipid) are added to
+        the carbons.
+        """
         ElectronNumbers = {}
-
-        try:
-            UA = self.readme['UNITEDATOM_DICT']
-        except KeyError:
-            UA = False
-        else:
-            if self.readme['UNITEDATOM_DICT'] is None:
-                UA = False
-            else:
-                UA = True
+        UA = bool(self.readme.get('UNITEDATOM_DICT'))
 
         for key1 in self.readme['COMPOSITION'].keys():
             mol = self.readme['COMPOSITION'][key1]['NAME']
             print(mol)
+
+            UAlipidjson = None
+            if UA and key1 in lipids_dict:
+                UAlipidjsonNAME = os.path.join(
+                    NMLDB_ROOT_PATH, 'Scripts', 'DatabankLib',
+                    'lipid_json_buildH',
+                    self.readme['UNITEDATOM_DICT'][key1] + '.json')
+                with open(UAlipidjsonNAME) as json_file:
+                    UAlipidjson = json.load(json_file)
+
             for universalAN in self.system_mapping[mol]:
                 AtomName = self.system_mapping[mol][universalAN]['ATOMNAME']
                 try:
@@ -387,126 +883,113 @@ class FormFactor:
                 if ResName not in ElectronNumbers.keys():
                     ElectronNumbers[ResName] = {}
 
-                if UA and key1 in lipids_dict:
-                    UAlipidjsonNAME = os.path.join(
-                        NMLDB_ROOT_PATH, 'Scripts', 'DatabankLib',
-                        'lipid_json_buildH',
-                        self.readme['UNITEDATOM_DICT'][key1] + '.json')
-
-                    with open(UAlipidjsonNAME) as json_file:
-                        UAlipidjson = json.load(json_file)
-
-                    numberH = 0
+                numberH = 0
+                if UAlipidjson is not None:
                     try:
-                        if UAlipidjson[AtomName][0] == "CH":
-                            numberH = 1
-                        if UAlipidjson[AtomName][0] == "CH2":
-                            numberH = 2
-                        if UAlipidjson[AtomName][0] == "CH3":
-                            numberH = 3
+                        numberH = {"CH": 1, "CH2": 2, "CH3": 3}.get(
+                            UAlipidjson[AtomName][0], 0)
                     except (KeyError, TypeError):
                         pass
 
-                    ElectronNumbers[ResName][AtomName] = \
-                        self.getElectrons(universalAN) + numberH
+                ElectronNumbers[ResName][AtomName] = \
+                    self.getElectrons(universalAN) + numberH
 
-                else:
-                    ElectronNumbers[ResName][AtomName] = self.getElectrons(universalAN)
+        return ElectronNumbers
 
+    def electronWeights(self, ElectronNumbers):
+        """
+        Return array of electron numbers of all atoms of the universe (0 for atoms
+        not found in ``ElectronNumbers``). The ``(residue name, atom name)`` pairs
+        are looked up once per distinct pair using topology arrays.
+        """
+        atoms = self.u.atoms
+        rnames, rcodes = np.unique(self.u.residues.resnames, return_inverse=True)
+        anames, acodes = np.unique(atoms.names, return_inverse=True)
+        # distinct (residue name, atom name) pairs of the system
+        pairs = rcodes[atoms.resindices] * len(anames) + acodes.ravel()
+        upairs, inverse = np.unique(pairs, return_inverse=True)
+
+        table = np.zeros(len(upairs))
+        for i, pair in enumerate(upairs):
+            rname = rnames[pair // len(anames)]
+            aname = anames[pair % len(anames)]
+            table[i] = ElectronNumbers.get(rname, {}).get(aname, 0)
+
+        return table[inverse.ravel()]
+
+    def weightsInputs(self) -> list:
+        """
+        Files electron weights are derived from: topology, mapping files and
+        buildH JSONs of united-atom lipids.
+        """
+        files = [self.conf]
+        UA = self.readme.get('UNITEDATOM_DICT') or {}
+        for key1 in sorted(self.readme['COMPOSITION']):
+            files.append(os.path.join(
+                MAPPING_DIR, self.readme['COMPOSITION'][key1]['MAPPING']))
+            if key1 in lipids_dict and UA.get(key1):
+                files.append(os.path.join(
+                    NMLDB_ROOT_PATH, 'Scripts', 'DatabankLib', 'lipid_json_buildH',
+                    UA[key1] + '.json'))
+        return files
+
+    def systemElectronWeights(self):
+        """
+        Electron weights of all atoms. They are cached in the system folder and
+        recomputed only if topology, mappings or ``UNITEDATOM_DICT`` change.
+        """
+        extra = {'COMPOSITION': {k: [v['NAME'], v['MAPPING']]
+                                 for k, v in self.readme['COMPOSITION'].items()},
+                 'UNITEDATOM_DICT': self.readme.get('UNITEDATOM_DICT')}
+        key = weightsKey(self.weightsInputs(), extra)
+        weights = loadWeights(self.path, key, self.u.atoms.n_atoms)
+        if weights is not None:
+            print("Electron weights are loaded from", weightsCachePath(self.path))
+            return weights
+
+        ElectronNumbers = self.electronNumbers()
         print("ElectronNumbers dictionary: ")
         pprint(ElectronNumbers)
 
-        # define selections and dictionaries for profile calculations
-        clipids = self.u.select_atoms(self.lipids)
-        cwaters = self.u.select_atoms(self.waters)
-
         print("Generating final electron arrays from frame #1..", end='')
-        weightsALL = np.zeros(self.u.atoms.n_atoms)
+        weights = self.electronWeights(ElectronNumbers)
+        print("done.")
+        saveWeights(self.path, key, weights)
+        return weights
 
-        for rname, AName2Enum in ElectronNumbers.items():
-            for aname, enum in AName2Enum.items():
-                # all
-                cSel = self.u.select_atoms(f"resname {rname} and name {aname}")
-                weightsALL[[_a.index for _a in cSel]] = enum
+    def calculate_density(self):
+        c = self.u.select_atoms(self.lipids)
+        print(c)  # TODO: remove excessive debug printing!
 
-        weightsLIPIDS = weightsALL[[_a.index for _a in clipids]]
-        weightsWATERS = weightsALL[[_a.index for _a in cwaters]]
-        print("done.")
+        box_z = self.u.dimensions[2]  # + 10 if fails
+        print(box_z)
+        boxH = box_z/10
+        print(boxH)
+
+        # Calculte density profiles and FF from individual frames
+        start_time = time.time()
+
+        if self.density_type == "electron":
+            weightsALL = self.wght
+        else:
+            weightsALL = self.systemElectronWeights()
+
+        # define selections and dictionaries for profile calculations
+        clipids = self.u.select_atoms(self.lipids)
+        cwaters = self.u.select_atoms(self.waters)
 
-        for ts in tqdm(self.u.trajectory, desc="Iterating over trajectory"):
-            # count the index of the frame, numbered from 0, used to be used for the
-            # density profile averaging
-            # -- posible not needed now
-            frame += 1  # ts.frame
-
-            # reads the dimension in z-direction
-            box_z = ts.dimensions[2]
-            if box_z/10 < min_z:
-                min_z = box_z/10
-
-            # reads the coordinates of all of the atoms
-            crds = self.u.atoms.positions
-
-            crds_no_center = c.atoms.positions[:, 2]/10
-
-            # calculates the center of mass of the selected atoms that the density
-            # should be centered around and takes the z-coordinate value
-            ctom = c.atoms.center_of_mass()[2]
-
-            # moves the center of mass of the selected centering group into box/2
-            crds[:, 2] += box_z/2 - ctom
-
-            # shifts the coordinates in the universe by the value of
-            # the center of mass
-            self.u.atoms.positions = crds
-
-            # puts the atoms back to the original box dimension; it possibly does not
-            # take PBC into account, therefore it may brake some of the water molecules;
-            # -- try it, come to the issue later
-            self.u.atoms.pack_into_box()
-
-            # shif the coordinates so that the center in z-dimention is in 0;
-            # divide by 10 to get the coordinates in nm, since now the crds are
-            # only the z coordinates
-            crds = (self.u.atoms.positions[:, 2] - box_z/2)/10
-            clipids_center = (clipids.atoms.positions[:, 2] - box_z/2)/10
-            cwaters_center = (cwaters.atoms.positions[:, 2] - box_z/2)/10
-
-            # calculates the volume of the bin; d- the "height" of a bin;
-            # assumes in [nm]
-            # ts.dimension[0], ts.dimension[1] - the x and y dimension;
-            # in [A] --> devides by 100
-            vbin = d*np.prod(ts.dimensions[:2])/100  # needed for density, correct!
-
-            # calculates the total density profile; keep for now
-            density_z_centered += np.histogram(
-                crds, bins=self.nbin, range=(-boxH/2, boxH/2),
-                weights=weightsALL / vbin,
-            )[0]
-            density_z_no_center += np.histogram(
-                crds_no_center, bins=self.nbin, range=(0, boxH),
-                weights=weightsLIPIDS / vbin,
-            )[0]
-            # ELECTRON WEIGHTS
-            density_lipids_center += np.histogram(
-                clipids_center, bins=self.nbin, range=(-boxH/2, boxH/2),
-                weights=weightsLIPIDS / vbin,
-            )[0]
-            # ELECTRON WEIGHTS
-            density_waters_center += np.histogram(
-                cwaters_center, bins=self.nbin, range=(-boxH/2, boxH/2),
-                weights=weightsWATERS / vbin,
-            )[
-                0
-            ]
+        kernel = DensityKernel(weightsALL, clipids.indices, cwaters.indices,
+                               clipids.masses, self.nbin, boxH, self.block_frames)
+        accumulate_density(kernel, self.u, self.conf, self.traj, self.n_workers)
 
         print("Calculating the density takes {:10.6f} s".format(time.time()-start_time))
 
+        hists = DensityHistograms.from_kernel(kernel)
+        hists.save(str(self.output) + HISTOGRAMS_FILE)
+
         """ Normalizing the profiles """
-        density_z_centered /= (frame)
-        density_z_no_center /= frame
-        density_lipids_center /= frame
-        density_waters_center /= frame
+        x, (density_z_centered, density_z_no_center,
+            density_lipids_center, density_waters_center) = hists.profiles()
 
         # Post-processign data and writing to file
         density_data = np.vstack((x, density_z_centered)).transpose()
@@ -516,21 +999,9 @@ class FormFactor:
 
         # Get the indexes of the final density data where all the time steps contribute
         # In other words, take the coordinates of the smalest box from the simulation
-        final_FF_start = int(np.round(self.nbin/2 - min_z/d/2)) + 1
-        final_FF_end = int(np.round(self.nbin/2 + min_z/d/2)) - 1
-
-        FF_range = np.linspace(0, 999, 1000)
-        fa_aver, fb_aver = self.fourier(
-            density_data[final_FF_start:final_FF_end, 1],
-            density_data[final_FF_end, 0] - density_data[final_FF_start, 0],
-            FF_range,
-            density_data[1, 0] - density_data[0, 0],
-        )
-
-        # Plot density profiles from the average density with minimal box
-        fourrier_result2 = np.sqrt(np.multiply(fa_aver, fa_aver) +
-                                   np.multiply(fb_aver, fb_aver))
-        fourrier_data2 = np.vstack((FF_range*0.1*0.01, fourrier_result2)).transpose()
+        final_FF_start, final_FF_end = hists.crop()
+
+        fourrier_data2 = hists.formFactor()
 
         # Save data into files
         # minimum box size density
@@ -570,41 +1041,56 @@ class FormFactor:
 
         with open(str(self.output)+"FormFactor.json", 'w') as f:
             json.dump(fourrier_data2, f, cls=NumpyArrayEncoder)
+
+        if hists.nblocks:
+            blocks = {'Q': fourrier_data2[:, 0],
+                      'BLOCK_NFRAMES': hists.block_nframes,
+                      'FF': hists.blockFormFactors(),
+                      'CONVERGENCE': hists.convergence()}
+            with open(str(self.output)+"FormFactorBlocks.json", 'w') as f:
+                json.dump(blocks, f, cls=NumpyArrayEncoder)
     # end calculate_density
 
-    def fourier(self, ff_density, box_z, FF_range, d_ff):
+    @staticmethod
+    def fourier(ff_density, box_z, FF_range, d_ff, bulk_width=0.33):
         """Calculates fourier transform of ff_density in the FF_range.
         It calculates a "height" of a bin for FF puroposes; in this case the number of
         bins is constant and the bin width changes.
 
+        The transform is evaluated as a matrix product, so arbitrary (non-uniform)
+        q grids and batches of density profiles are processed at once. The method is
+        static and can be applied to stored densities without trajectory.
+
         Args:
-            ff_density (_type_): TODO: fill
-            box_z (_type_): TODO: fill
-            FF_range (_type_): TODO: fill
-            d_ff (_type_): TODO: fill
+            ff_density (np.ndarray): density profile(s), shape (nbin,) or
+                (nprofiles, nbin)
+            box_z (float): length of the profile (nm)
+            FF_range (np.ndarray): q grid, in units of 0.01 nm^-1
+            d_ff (float): bin width (nm)
+            bulk_width (float): width of the bulk (water) region at both ends
+                of the profile (nm)
 
         Returns:
-            _type_: TODO: fill
+            (fa, fb): cosine and sine parts, shape (nq,) or (nprofiles, nq)
         """
+        ff_density = np.asarray(ff_density, dtype=np.float64)
+        nbin = ff_density.shape[-1]
 
         # Creates the direct space coordinates
         # the calculations are stable with rounding (and others) errors in the direct
         # space coordinates
-        ff_x = np.linspace(-box_z/2, box_z/2, ff_density.shape[0]+1)[:-1] +\
-            box_z/2/ff_density.shape[0]
+        ff_x = np.linspace(-box_z/2, box_z/2, nbin+1)[:-1] + box_z/2/nbin
 
-        k = 0
-        bulk = 0
-        while k*d_ff < 0.33:
-            bulk += ff_density[k] + ff_density[-k-1]
+        # bulk (water) density is averaged over bulk_width at both ends of the profile
+        k = 1
+        while k*d_ff < bulk_width:
             k += 1
-        bulk /= (2*k)
-
-        fa = np.zeros(FF_range.shape[0])
-        fb = np.zeros(FF_range.shape[0])
+        bulk = (ff_density[..., :k].sum(axis=-1) +
+                ff_density[..., nbin-k:].sum(axis=-1)) / (2*k)
 
-        for j in range(0, ff_density.shape[0]):
-            fa += (ff_density[j]-bulk)*np.cos(FF_range*ff_x[j]*0.01)*d_ff
-            fb += (ff_density[j]-bulk)*np.sin(FF_range*ff_x[j]*0.01)*d_ff
+        phase = np.outer(ff_x, np.asarray(FF_range, dtype=np.float64)*0.01)
+        rho = (ff_density - bulk[..., None]) * d_ff
+        fa = rho @ np.cos(phase)
+        fb = rho @ np.sin(phase)
 
         return fa, fb
@@ -0,0 +1,136 @@
+"""
+:module: DatabankLib.mapping
+:description: compiled representation of a mapping file.
+
+Mapping file relates universal atom names (``M_G1C2_M``) to force-field specific
+atom names (``ATOMNAME``), residues (``RESIDUE``, for lipids split into several
+residues) and molecule fragments (``FRAGMENT``). :class:`Mapping` precomputes
+lookup tables over it, so that all queries are O(1).
+"""
+
+import re
+import sys
+import collections.abc
+
+# carbons and hydrogens participating in C-H order parameters
+_re_C = re.compile(r"M_[A-Z0-9]*C[0-9]*_M|M_G[0-9]{1,2}_M|M_C[0-9]{1,2}_M")
+_re_H = re.compile(r"M_[A-Z0-9]*C[0-9]*H[0-9]*_M|M_G[0-9]*H[0-9]*_M|M_C[0-9]*H[0-9]*_M")
+
+
+class Mapping(collections.abc.Mapping):
+    """
+    Read-only mapping ``universal name -> {ATOMNAME, FRAGMENT[, RESIDUE]}`` with
+    precomputed forward and reverse lookups. Entries keep the order of the
+    mapping file.
+
+    If the same force-field name occurs several times, reverse lookup returns
+    the first universal name (in the file order).
+    """
+
+    def __init__(self, mapping_dict, name: str = None):
+        """
+        :param mapping_dict: content of the mapping file
+        :param name: name of the mapping file (used in messages)
+        """
+        self.name = name
+        self._data = mapping_dict
+        self._atomnames = {}
+        self._reverse = {}
+        self._reverse_res = {}
+        self._fragments = {}
+        self._residues = {}
+        self.multiresidue = bool(mapping_dict) and all(
+            'RESIDUE' in mv for mv in mapping_dict.values())
+        for mk, mv in mapping_dict.items():
+            self._atomnames[mk] = mv['ATOMNAME']
+            self._reverse.setdefault(mv['ATOMNAME'], mk)
+            self._fragments.setdefault(mv.get('FRAGMENT'), []).append(mk)
+            if 'RESIDUE' in mv:
+                self._residues.setdefault(mv['RESIDUE'], []).append(mk)
+                self._reverse_res.setdefault(
+                    mv['RESIDUE'], {}).setdefault(mv['ATOMNAME'], mk)
+        self._fragments = {k: tuple(v) for k, v in self._fragments.items()}
+        self._residues = {k: tuple(v) for k, v in self._residues.items()}
+        self._atomsets = {res: frozenset(self._atomnames[mk] for mk in mks)
+                          for res, mks in self._residues.items()}
+        self.ch_pairs = self.__compile_ch_pairs()
+
+    def __getitem__(self, uname):
+        return self._data[uname]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def atomname(self, uname: str) -> str:
+        """ Force-field atom name of the universal atom name ``uname`` """
+        return self._atomnames[uname]
+
+    def universal(self, atomname: str, residue: str = None):
+        """
+        Universal atom name of the force-field atom name (None if not found).
+
+        :param atomname: force-field atom name
+        :param residue: look only among atoms of this residue
+        """
+        if residue is None:
+            return self._reverse.get(atomname)
+        return self._reverse_res.get(residue, {}).get(atomname)
+
+    @property
+    def residues(self) -> tuple:
+        """ Residue names in the order of the mapping file (empty if not split) """
+        return tuple(self._residues)
+
+    def residue_names(self, residue: str) -> tuple:
+        """ Universal names of atoms belonging to ``residue`` """
+        return self._residues.get(residue, ())
+
+    def residue_atoms(self, residue: str) -> frozenset:
+        """ Set of force-field atom names of ``residue`` """
+        return self._atomsets.get(residue, frozenset())
+
+    def residue_pairs(self, default: str) -> dict:
+        """
+        Dictionary ``residue -> [(universal name, atom name), ...]``. If the mapping
+        doesn't define residues, all atoms are assigned to residue ``default``.
+        """
+        if not self._residues:
+            return {default: [(mk, an) for mk, an in self._atomnames.items()]}
+        return {res: [(mk, self._atomnames[mk]) for mk in mks]
+                for res, mks in self._residues.items()}
+
+    @property
+    def fragments(self) -> dict:
+        """ Dictionary ``fragment -> tuple of universal names`` """
+        return self._fragments
+
+    def fragment(self, uname: str) -> str:
+        """ Fragment the universal atom name ``uname`` belongs to """
+        return self._data[uname].get('FRAGMENT')
+
+    def __compile_ch_pairs(self) -> tuple:
+        """
+        Every hydrogen is bound to the closest preceding carbon; the sequence is
+        broken by any other atom. Returns tuple of
+        ``(C universal, H universal, C atomname, H atomname, residue or None)``.
+        """
+        pairs = []
+        atomC = None
+        residue = None
+        for mk, mv in self._data.items():
+            if _re_C.search(mk):
+                atomC = mk
+                residue = mv.get('RESIDUE', residue)
+                continue
+            if not _re_H.search(mk):
+                atomC = None
+                continue
+            if atomC is None:
+                print(f"Cannot define carbon for the hydrogen {mk} "
+                      f"({mv['ATOMNAME']})", file=sys.stderr)
+                continue
+            pairs.append((atomC, mk, self._atomnames[atomC], mv['ATOMNAME'], residue))
+        return tuple(pairs)
@@ -6,7 +6,7 @@ TODO: remove code duplication and commented code
 
 from DatabankLib import NMLDB_SIMU_PATH
 from DatabankLib.core import initialize_databank
-from DatabankLib.databankLibrary import loadMappingFile, lipids_dict
+from DatabankLib.databankLibrary import loadMapping, lipids_dict
 
 import re
 import decimal as dc
@@ -89,13 +89,8 @@ def prob_S_in_g(OP_exp: float, exp_error: float,
 
 # quality of molecule fragments
 def getFragments(mapping_file):
-    mapping_dict = loadMappingFile(mapping_file)
-
-    fragments = {}
-
-    for key_m, value in mapping_dict.items():
-        key_f = value['FRAGMENT']
-        fragments.setdefault(key_f, []).append(key_m)
+    fragments = {key_f: list(names)
+                 for key_f, names in loadMapping(mapping_file).fragments.items()}
 
     # merge glycerol backbone fragment into headgroup fragment
     if 'glycerol backbone' in fragments.keys() and 'headgroup' in fragments.keys():
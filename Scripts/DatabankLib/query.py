@@ -0,0 +1,147 @@
+"""
+:module: DatabankLib.query
+:description: columnar (NumPy) view over a collection of systems and vectorized
+              queries on it.
+
+Example -- all POPC systems at 298-310 K with more than 50 mM of NaCl::
+
+    systems = initialize_databank()
+    t = systems.table
+    mask = ((t.count('POPC') > 0) & t.between('TEMPERATURE', 298, 310) &
+            (t.concentration('SOD') > 0.05) & (t.concentration('CLA') > 0.05))
+    selected = systems.filter(mask)
+"""
+
+import numpy as np
+
+from DatabankLib.settings.molecules import lipids_dict
+
+C_WATER = 55.5
+""" Molar concentration of pure water (mol/L) """
+
+NUMERIC_FIELDS = ['TEMPERATURE', 'TRAJECTORY_SIZE', 'TRJLENGTH',
+                  'NUMBER_OF_ATOMS', 'PREEQTIME', 'TIMELEFTOUT']
+""" README fields stored as float64 columns (NaN if absent) """
+
+STRING_FIELDS = ['path', 'SYSTEM', 'FF', 'SOFTWARE', 'DOI', 'TYPEOFSYSTEM']
+""" README fields stored as object columns (None if absent) """
+
+
+def _count(entry) -> int:
+    """ COUNT of a molecule is either a number or a list of per-leaflet numbers """
+    try:
+        return int(np.sum(entry['COUNT']))
+    except (KeyError, TypeError):
+        return 0
+
+
+class SystemsTable:
+    """
+    Columnar representation of a systems collection. Every column is a 1D numpy
+    array of length ``len(systems)`` aligned with the collection indices.
+
+    Molecule counts are stored in a single ``(n_systems, n_molecules)`` matrix;
+    molecule order is given by ``molecules``.
+    """
+
+    def __init__(self, systems):
+        n = len(systems)
+        self.columns = {}
+        self.columns['ID'] = np.full(n, -1, dtype=np.int64)
+        for fld in NUMERIC_FIELDS:
+            self.columns[fld] = np.full(n, np.nan)
+        for fld in STRING_FIELDS:
+            self.columns[fld] = np.full(n, None, dtype=object)
+
+        compositions = []
+        molecules = {}
+        for i, system in enumerate(systems):
+            if system.get('ID') is not None:
+                self.columns['ID'][i] = system['ID']
+            for fld in NUMERIC_FIELDS:
+                try:
+                    self.columns[fld][i] = float(system[fld])
+                except (KeyError, TypeError, ValueError):
+                    pass
+            for fld in STRING_FIELDS:
+                self.columns[fld][i] = system.get(fld)
+            comp = {}
+            for mol, entry in (system.get('COMPOSITION') or {}).items():
+                comp[mol] = _count(entry)
+                molecules.setdefault(mol, len(molecules))
+            compositions.append(comp)
+
+        self.molecules = list(molecules)
+        self.counts = np.zeros((n, len(self.molecules)), dtype=np.int64)
+        for i, comp in enumerate(compositions):
+            for mol, cnt in comp.items():
+                self.counts[i, molecules[mol]] = cnt
+
+        lipcols = [molecules[m] for m in self.molecules if m in lipids_dict]
+        self.columns['N_LIPIDS'] = self.counts[:, lipcols].sum(axis=1)
+        self.columns['N_WATER'] = self.count('SOL')
+
+    def __len__(self):
+        return len(self.columns['ID'])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def count(self, molecule: str) -> np.ndarray:
+        """ Number of molecules of type ``molecule`` in every system (0 if absent) """
+        try:
+            return self.counts[:, self.molecules.index(molecule)]
+        except ValueError:
+            return np.zeros(len(self), dtype=np.int64)
+
+    def molar_fraction(self, lipid: str) -> np.ndarray:
+        """ Molar fraction of ``lipid`` among all lipids (NaN if no lipids) """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self['N_LIPIDS'] > 0,
+                            self.count(lipid) / self['N_LIPIDS'], np.nan)
+
+    def concentration(self, molecule: str) -> np.ndarray:
+        """
+        Molar concentration (mol/L) of ``molecule`` with respect to water
+        (NaN if there is no water). Counter-ions are not subtracted.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self['N_WATER'] > 0,
+                            self.count(molecule) * C_WATER / self['N_WATER'], np.nan)
+
+    def hydration(self) -> np.ndarray:
+        """ Number of waters per lipid (NaN if no lipids) """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self['N_LIPIDS'] > 0,
+                            self['N_WATER'] / self['N_LIPIDS'], np.nan)
+
+    def between(self, name: str, lo, hi) -> np.ndarray:
+        """ Mask of ``lo <= column <= hi`` """
+        col = self[name]
+        return (col >= lo) & (col <= hi)
+
+    def mask(self, **conditions) -> np.ndarray:
+        """
+        Build a boolean mask from keyword conditions on columns:
+
+        - ``TEMPERATURE=(298, 310)`` -- inclusive range;
+        - ``FF=['CHARMM36', 'Slipids']`` -- membership (list or set);
+        - ``SOFTWARE='gromacs'`` -- equality.
+
+        Conditions are combined with logical AND.
+        """
+        m = np.ones(len(self), dtype=bool)
+        for name, cond in conditions.items():
+            if isinstance(cond, tuple):
+                m &= self.between(name, *cond)
+            elif isinstance(cond, (list, set, frozenset)):
+                m &= np.isin(self[name], list(cond))
+            else:
+                m &= (self[name] == cond)
+        return m
+
+    def select(self, *names, mask=None) -> dict:
+        """ Return dictionary of (masked) columns """
+        if mask is None:
+            return {nm: self[nm] for nm in names}
+        return {nm: self[nm][mask] for nm in names}
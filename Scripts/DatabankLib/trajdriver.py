@@ -0,0 +1,146 @@
+"""
+:module: DatabankLib.trajdriver
+:description: single-pass trajectory driver feeding every frame to several
+              analysis kernels.
+
+Reading a trajectory is usually more expensive than analyzing a frame, therefore
+analyses sharing the same trajectory should be done in one pass::
+
+    apl = APLKernel(nlipid, tmin=system['TIMELEFTOUT']*1000)
+    pn = PNAngleKernel('POPC', 'P', 'N')
+    TrajectoryDriver(u, [apl, pn]).run()
+    print(apl.apl, pn.angles.shape)
+
+Order parameters (:class:`DatabankLib.databankop.OPKernel`) and density
+histograms (:class:`DatabankLib.form_factor.DensityKernel`) are kernels as well.
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+from tqdm import tqdm
+
+
+class FrameKernel(ABC):
+    """
+    Base class of per-frame analysis kernels. :class:`TrajectoryDriver` calls
+    :meth:`setup` once before the pass, :meth:`add_timestep` for every frame
+    and :meth:`finish` after the pass.
+    """
+
+    def setup(self, u):
+        """ Prepare selections/buffers for Universe ``u`` (at its current frame) """
+        pass
+
+    @abstractmethod
+    def add_timestep(self, ts):
+        """ Analyze one frame (MDAnalysis Timestep) """
+
+    def finish(self):
+        """ Post-process accumulated data """
+        pass
+
+
+class TrajectoryDriver:
+    """
+    Reads frames of the Universe once and feeds every frame to all registered
+    kernels in the registration order.
+    """
+
+    def __init__(self, u, kernels=()):
+        self.u = u
+        self.kernels = list(kernels)
+
+    def add(self, kernel: FrameKernel) -> FrameKernel:
+        """ Register kernel; returns it for convenience """
+        self.kernels.append(kernel)
+        return kernel
+
+    def run(self, start=None, stop=None, step=None, progress: bool = True) -> list:
+        """
+        Make one pass over frames ``[start:stop:step]``.
+
+        :return: list of kernels
+        """
+        for kernel in self.kernels:
+            kernel.setup(self.u)
+        for ts in tqdm(self.u.trajectory[start:stop:step],
+                       desc='Scanning the trajectory', disable=not progress):
+            for kernel in self.kernels:
+                kernel.add_timestep(ts)
+        for kernel in self.kernels:
+            kernel.finish()
+        return self.kernels
+
+
+class APLKernel(FrameKernel):
+    """ Area per lipid from box dimensions; result is ``apl = {time: APL}`` """
+
+    def __init__(self, nlipid: int, tmin: float = 0):
+        """
+        :param nlipid: total number of lipids (in both leaflets)
+        :param tmin: frames before this time (ps) are skipped
+        """
+        self.nlipid = nlipid
+        self.tmin = tmin
+        self.apl = {}
+
+    def add_timestep(self, ts):
+        if ts.time >= self.tmin:
+            dims = ts.dimensions
+            self.apl[ts.time] = dims[0]*dims[1]*2/self.nlipid
+
+
+class PNAngleKernel(FrameKernel):
+    """
+    Angles between the vector connecting two atoms of a molecule (P-N vector of
+    headgroup) and the membrane normal. Values of the bottom leaflet are
+    inverted, so that both leaflets have the same nomenclature. Leaflets are
+    defined by the center of mass of the atoms at setup. No PBC check!
+
+    Result is ``angles`` of shape (n_molecules, n_frames) in degrees.
+    """
+
+    def __init__(self, molname: str, atom1: str, atom2: str):
+        """
+        :param molname: residue name of the molecule
+        :param atom1: name of the P atom in the simulation
+        :param atom2: name of the N atom in the simulation
+        """
+        self.molname = molname
+        self.atom1 = atom1
+        self.atom2 = atom2
+        self.idx0 = self.idx1 = np.zeros(0, dtype=np.intp)
+        self._angles = []
+
+    def setup(self, u):
+        sel1 = f"resname {self.molname} and (name {self.atom1})"
+        sel2 = f"resname {self.molname} and (name {self.atom2})"
+        residues = u.select_atoms(sel1, sel2).atoms.split("residue")
+        # the vector goes from the first to the second atom of the residue
+        self.idx0 = np.array([res[0].index for res in residues], dtype=np.intp)
+        self.idx1 = np.array([res[1].index for res in residues], dtype=np.intp)
+        self.com = u.select_atoms(
+            f"resname {self.molname} and "
+            f"(name {self.atom1} or name {self.atom2})").center_of_mass()
+        self._angles = []
+
+    def add_timestep(self, ts):
+        pos0 = ts.positions[self.idx0]
+        vec = ts.positions[self.idx1] - pos0
+        sq = np.square(vec)
+        d = np.sqrt((sq[:, 0] + sq[:, 1] + sq[:, 2]).astype(np.float64))
+        cos = vec[:, 2] / d
+        cos *= np.copysign(1.0, pos0[:, 2] - self.com[2])
+        if (np.abs(cos) > 1.0).any():
+            for c in cos[np.abs(cos) > 1.0]:
+                print("Cosine is too large = {} --> truncating it to +/-1.0".format(c))
+            np.clip(cos, -1.0, 1.0, out=cos)
+        self._angles.append(np.degrees(np.arccos(cos)))
+
+    @property
+    def angles(self) -> np.ndarray:
+        if not self._angles:
+            return np.zeros((len(self.idx0), 0))
+        return np.stack(self._angles, axis=1)
+
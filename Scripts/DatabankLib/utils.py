@@ -2,31 +2,357 @@ from DatabankLib import RCODE_COMPUTED, RCODE_ERROR, RCODE_SKIPPED
 from DatabankLib.core import initialize_databank
 
 
+import argparse
+import errno
+import json
+import math
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from logging import Logger
 from typing import Callable
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
-def run_analysis(method: Callable, logger: Logger):
+RCODE_NAMES = {
+    RCODE_COMPUTED: 'COMPUTED',
+    RCODE_SKIPPED: 'SKIPPED',
+    RCODE_ERROR: 'ERROR'}
+
+GB = 1024**3
+
+MEMORY_BASE = 1 * GB
+""" Memory of the interpreter with MDAnalysis and a small system (bytes) """
+
+MEMORY_MODEL = {
+    'computeAPL': (1000, 0.0),
+    'computeOP': (2000, 0.0),
+    'computeFused': (2000, 0.0),
+    'computeFF': (4000, 0.0),
+    'computeTH': (0, 0.0),
+    'computeNMRPCA': (2000, 0.0),
+}
+"""
+Peak memory model of analyses: ``(bytes per atom, bytes per byte of trajectory)``
+on top of :data:`MEMORY_BASE`. Streaming analyses depend only on the system size;
+analyses holding whole trajectories in memory scale with TRAJECTORY_SIZE.
+NMR-PCA keeps the concatenated trajectory in a memory-mapped file.
+"""
+
+MEMORY_MODEL_UNITEDATOM_OP = 1.0
+""" buildH keeps the trajectory in memory (bytes per byte of trajectory) """
+
+MEMORY_LIMIT_EXEMPT = ('computeNMRPCA',)
+"""
+Analyses run without the per-job memory limit: the limit caps address space,
+which includes memory-mapped scratch files of these analyses.
+"""
+
+
+def analysis_parser(description: str = None,
+                    frame_workers: bool = False) -> argparse.ArgumentParser:
+    """
+    Command line parser of analysis scripts with the options of
+    :func:`run_analysis`; ``vars(parser.parse_args())`` can be passed to it as
+    keyword arguments. Scripts can add their own options and split them off with
+    :func:`parse_analysis_args`. With ``frame_workers``, ``--frame-workers`` option
+    of analyses reading trajectory chunks in parallel is added.
+    """
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="number of systems analyzed in parallel")
+    parser.add_argument('--mem-limit', type=float, default=None,
+                        help="address space limit of every job (GB)")
+    parser.add_argument('--mem-budget', type=float, default=None,
+                        help="total memory (GB) of simultaneously running jobs "
+                        "(only with --jobs > 1)")
+    parser.add_argument('--report', default=None,
+                        help="write per-system timings into this JSON file")
+    if frame_workers:
+        parser.add_argument('--frame-workers', type=int, default=1,
+                            help="processes reading frame chunks of every "
+                            "trajectory (capped by number of CPUs divided by --jobs)")
+    return parser
+
+
+def parse_analysis_args(parser: argparse.ArgumentParser, args: list = None) -> tuple:
+    """
+    Parse command line of an analysis script.
+
+    Returns:
+        tuple: keyword arguments of :func:`run_analysis` and a dict of the
+        script's own options, where ``--frame-workers`` is resolved into
+        ``n_workers`` (see :func:`frame_workers`)
+    """
+    opts = vars(parser.parse_args(args))
+    run_opts = {k: opts.pop(k) for k in ('jobs', 'mem_limit', 'mem_budget', 'report')}
+    if 'frame_workers' in opts:
+        opts['n_workers'] = frame_workers(opts.pop('frame_workers'), run_opts['jobs'])
+    return run_opts, opts
+
+
+def frame_workers(requested: int, jobs: int = 1) -> int:
+    """
+    Number of processes reading frame chunks of a trajectory within every job,
+    capped so that ``jobs * frame_workers`` doesn't exceed the number of CPUs.
+    """
+    return max(1, min(requested, (os.cpu_count() or 1) // max(jobs, 1)))
+
+
+def _init_job(mem_limit: float):
+    """
+    Limit address space of the worker process to ``mem_limit`` GB. Note that
+    RLIMIT_AS is not a limit of resident memory: it also counts memory-mapped
+    files and is inherited by subprocesses (e.g. ``gmx trjconv``).
+    """
+    if mem_limit and resource is not None:
+        nbytes = int(mem_limit * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+
+
+def _is_memory_error(e: Exception) -> bool:
+    """ Allocation failure, including mmap failing under the address space limit """
+    return isinstance(e, MemoryError) or \
+        (isinstance(e, OSError) and e.errno == errno.ENOMEM)
+
+
+def _run_job(method: Callable, system: dict, logger: Logger) -> tuple:
+    """ Run analysis of one system; returns (RCODE, elapsed seconds) """
+    start = time.time()
+    try:
+        res = method(system, logger)
+    except Exception as e:
+        if _is_memory_error(e):
+            print(f"Memory limit exceeded for {system['path']}", file=sys.stderr)
+        else:
+            print(f"Analysis failed for {system['path']}", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+        res = RCODE_ERROR
+    return res, time.time() - start
+
+
+def _number(system: dict, field: str) -> float:
+    try:
+        return float(system[field])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def _by_trajectory_size(systems) -> list:
+    """ Systems sorted from the largest trajectory to the smallest """
+    return sorted(systems, key=lambda s: _number(s, 'TRAJECTORY_SIZE'), reverse=True)
+
+
+def _analysis_name(analysis) -> str:
+    """ Name of analysis function (also of functools.partial) or the name itself """
+    if isinstance(analysis, str):
+        return analysis
+    return getattr(analysis, 'func', analysis).__name__
+
+
+def estimate_memory(system: dict, analysis) -> float:
+    """Estimate peak memory of the analysis of the system.
+
+    The estimate uses :data:`MEMORY_MODEL` with NUMBER_OF_ATOMS and
+    TRAJECTORY_SIZE of the system. It reproduces the frame skipping of large
+    trajectories done by the analyses themselves.
+
+    Args:
+        system (dict): one of systems of the Databank
+        analysis: analysis function or its name (e.g. ``'computeOP'``)
+
+    Returns:
+        float: memory in bytes
+    """
+    name = _analysis_name(analysis)
+    per_atom, per_traj = MEMORY_MODEL.get(name, (4000, 1.0))
+    trj_size = _number(system, 'TRAJECTORY_SIZE')
+    if name in ('computeOP', 'computeFused') and system.get('UNITEDATOM_DICT'):
+        per_traj = MEMORY_MODEL_UNITEDATOM_OP
+        if trj_size > 15e9:
+            trj_size /= 3  # computeOP uses every third frame
+    return MEMORY_BASE + per_atom * _number(system, 'NUMBER_OF_ATOMS') + \
+        per_traj * trj_size
+
+
+def _schedule(executor, method, systems, logger, mem_budget, max_running=None):
+    """
+    Generator submitting jobs (largest first) so that estimated memory of running
+    jobs doesn't exceed ``mem_budget`` (bytes) and at most ``max_running`` jobs are
+    submitted at once. A job larger than the whole budget is run alone. Yields
+    ``(system, future)`` of finished jobs. If the pool is broken, submission stops
+    and only the already submitted jobs are yielded.
+    """
+    pending = [(estimate_memory(s, method), s) for s in _by_trajectory_size(systems)]
+    running = {}
+    used = 0.0
+    broken = False
+    while running or (pending and not broken):
+        # first-fit packing of pending jobs into the free memory
+        i = 0
+        while i < len(pending) and not broken and \
+                (max_running is None or len(running) < max_running):
+            mem, system = pending[i]
+            if used + mem <= mem_budget or not running:
+                if mem > mem_budget:
+                    logger.warning(f"Estimated memory {mem / GB:.1f} GB of "
+                                   f"{system['path']} exceeds the budget")
+                logger.info(f"Submitting system: {system['path']} "
+                            f"({mem / GB:.1f} GB)")
+                try:
+                    future = executor.submit(_run_job, method, system, logger)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+                running[future] = (mem, system)
+                used += mem
+                del pending[i]
+            else:
+                i += 1
+        if not running:
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            mem, system = running.pop(future)
+            used -= mem
+            yield system, future
+
+
+def _run_parallel(method, systems, logger, jobs, mem_limit, mem_budget):
+    """
+    Generator running jobs in a pool of ``jobs`` processes; yields
+    ``(system, RCODE, elapsed seconds)``.
+
+    If a worker dies (e.g. killed by the OOM killer), the pool is broken and all
+    its running jobs fail. These jobs are rerun one by one in separate pools, so
+    that only the job killing its worker gets ERROR code, and the remaining
+    systems are submitted to a new pool.
+    """
+    pending = list(systems)
+    while pending:
+        finished = set()
+        lost = []
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_job,
+                                 initargs=(mem_limit,)) as executor:
+            for system, future in _schedule(executor, method, pending, logger,
+                                            mem_budget, jobs):
+                finished.add(id(system))
+                try:
+                    res, elapsed = future.result()
+                except BrokenProcessPool:
+                    lost.append(system)
+                    continue
+                except Exception as e:
+                    print(f"Job failed for {system['path']}: {e}", file=sys.stderr)
+                    res, elapsed = RCODE_ERROR, float('nan')
+                yield system, res, elapsed
+        pending = [s for s in pending if id(s) not in finished]
+        if len(lost) == 1:
+            print(f"Job failed for {lost[0]['path']}: worker was killed",
+                  file=sys.stderr)
+            yield lost[0], RCODE_ERROR, float('nan')
+        else:
+            for system in lost:
+                yield from _run_parallel(method, [system], logger, 1,
+                                         mem_limit, mem_budget)
+
+
+def run_analysis(method: Callable, logger: Logger, jobs: int = 1,
+                 mem_limit: float = None, report: str = None,
+                 mem_budget: float = None) -> dict:
     """Apply analysis ``method`` to the entire databank.
 
+    With ``jobs > 1``, systems are dispatched to a pool of processes starting from
+    the largest trajectories, so that long jobs don't finish last. Analysis
+    scripts take these options from the command line (see :func:`analysis_parser`).
+
+    With ``mem_budget``, jobs are started only while the total estimated memory of
+    running jobs (see :func:`estimate_memory`) fits into the budget. If a worker
+    process is killed, only its job counts as ERROR and the others are resubmitted
+    to a new pool.
+
+    With ``jobs == 1``, systems are analyzed in the calling process and exceptions
+    propagate, unless ``mem_limit`` is given: then they are analyzed one by one in
+    a worker process, so that the limit doesn't stay on the calling process.
+    ``mem_budget`` is ignored (with a warning) when ``jobs == 1``.
+
     Args:
         method (Callable): will be called as ``fun(system, logger)``
         logger (Logger): reference to Logger initialized by the top script
+        jobs (int): number of systems analyzed in parallel
+        mem_limit (float): address space limit of every job in GB (jobs
+            exceeding it fail with ERROR code); ignored for
+            :data:`MEMORY_LIMIT_EXEMPT` analyses
+        report (str): name of JSON file for per-system timings
+        mem_budget (float): total memory of simultaneously running jobs in GB
+
+    Returns:
+        dict: counts of RCODE_* results
     """
+    if mem_limit and _analysis_name(method) in MEMORY_LIMIT_EXEMPT:
+        logger.warning(f"Memory limit is not applied to {_analysis_name(method)}")
+        mem_limit = None
+    if mem_budget and jobs <= 1:
+        logger.warning("Memory budget is ignored when jobs are not run in parallel")
+        mem_budget = None
+
     systems = initialize_databank()
     resDict = {
         RCODE_COMPUTED: 0,
         RCODE_SKIPPED: 0,
         RCODE_ERROR: 0}
+    timings = []
+
+    if jobs > 1 or mem_limit:
+        budget = mem_budget * GB if mem_budget else math.inf
+        for system, res, elapsed in _run_parallel(method, systems, logger,
+                                                  max(jobs, 1), mem_limit, budget):
+            resDict[res] += 1
+            timings.append((system['path'], res, elapsed))
+    else:
+        for system in systems:
+            logger.info("System title: " + system['SYSTEM'])
+            logger.info("System path: " + system['path'])
+            start = time.time()
+            res = method(system, logger)
+            resDict[res] += 1
+            timings.append((system['path'], res, time.time() - start))
+
+    print_summary(resDict, timings)
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump({'RESULTS': {RCODE_NAMES[k]: v for k, v in resDict.items()},
+                       'SYSTEMS': [{'path': p, 'RESULT': RCODE_NAMES[r], 'TIME': t}
+                                   for p, r, t in timings]}, f, indent=2)
+    return resDict
 
-    for system in systems:
-        logger.info("System title: " + system['SYSTEM'])
-        logger.info("System path: " + system['path'])
-        res = method(system, logger)
-        resDict[res] += 1
 
+def print_summary(resDict: dict, timings: list, nslowest: int = 10):
+    """Print RCODE counts and the slowest systems.
+
+    Args:
+        resDict (dict): counts of RCODE_* results
+        timings (list): tuples (system path, RCODE, seconds)
+        nslowest (int): number of the slowest systems to print
+    """
     print(f"""
     COMPUTED: {resDict[RCODE_COMPUTED]}
     SKIPPED: {resDict[RCODE_SKIPPED]}
     ERROR: {resDict[RCODE_ERROR]}
     """)
+    if not timings:
+        return
+    total = sum(t for _, _, t in timings if not math.isnan(t))
+    print(f"    TOTAL TIME: {total:.1f} s")
+    # killed jobs (NaN time) are listed first
+    slowest = sorted(timings, key=lambda x: -math.inf if math.isnan(x[2]) else -x[2])
+    for path, res, t in slowest[:nslowest]:
+        print(f"    {t:10.1f} s  {RCODE_NAMES[res]:8s}  {path}")
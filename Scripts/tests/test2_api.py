@@ -61,6 +61,48 @@ def test_initialize_n(systems):
     assert len(systems) == 5
 
 
+def test_databank_index(systems):
+    from DatabankLib.core import databank, initialize_databank
+    db = databank()
+    assert os.path.isfile(db.index_path)
+    # loading from the index gives the same content in the same order
+    s = initialize_databank()
+    assert [_s['ID'] for _s in s] == [_s['ID'] for _s in systems]
+    assert list(s) == list(initialize_databank(use_index=False))
+    # modified README is re-read
+    readme = os.path.join(db.path, systems[0]['path'], 'README.yaml')
+    st = os.stat(readme)
+    os.utime(readme, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    try:
+        assert initialize_databank().loc(systems[0]['ID']) == systems[0]
+    finally:
+        os.utime(readme, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def test_parallel_databank(systems):
+    import DatabankLib.core
+    from DatabankLib.core import databank
+    with mock.patch.object(DatabankLib.core, "PARALLEL_PARSE_MIN", 2):
+        s = databank(use_index=False, nproc=2).get_systems()
+    assert list(s) == list(systems)
+
+
+def test_lazy_databank(systems):
+    from DatabankLib.core import initialize_databank, LazySystemsCollection
+    s = initialize_databank(lazy=True)
+    assert isinstance(s, LazySystemsCollection)
+    assert len(s) == len(systems)
+    assert len(s._cache) == 0  # nothing is parsed yet
+    assert s.loc(243) == systems.loc(243)
+    assert len(s._cache) == 1
+    s.cache_size = 2
+    assert list(s) == list(systems)
+    assert len(s._cache) == 2
+    assert s[-1] == systems[-1]
+    with pytest.raises(KeyError):
+        s.loc(100500)
+
+
 def test_print_README(systems, capsys):
     from DatabankLib.core import print_README
     sys0 = systems[0]
@@ -137,6 +179,52 @@ def test_getHydrationLevel(systems, systemid, result):
     assert abs(hl - result) < 1e-4
 
 
+def test_systems_table(systems):
+    import numpy as np
+    from DatabankLib.databankLibrary import GetNlipids, getHydrationLevel
+    t = systems.table
+    assert len(t) == len(systems)
+    for i, s in enumerate(systems):
+        assert t['ID'][i] == s['ID']
+        assert t['N_LIPIDS'][i] == GetNlipids(s)
+        assert abs(t.hydration()[i] - getHydrationLevel(s)) < 1e-9
+    assert np.all(t.count('nonExisting') == 0)
+    np.testing.assert_allclose(t.molar_fraction('CHOL')[t['ID'] == 566], [.0625])
+    ids = sorted(s['ID'] for s in systems.filter(
+        t.count('POPC') > 0, TEMPERATURE=(298, 310)))
+    assert ids == [281, 566, 787]
+    assert list(systems.select('ID', SOFTWARE='gromacs', mask=t['ID'] > 500)['ID']) \
+        == [s['ID'] for s in systems if s['ID'] > 500]
+
+
+def test_secondary_indexes(systems):
+    from DatabankLib.core import databank, initialize_databank
+    for field, key in [('COMPOSITION', 'POPC'), ('SOFTWARE', 'gromacs'),
+                       ('FF', systems[0]['FF']), ('DOI', systems[0]['DOI'])]:
+        ids = [s['ID'] for s in systems.lookup(field, key)]
+        assert ids == [s['ID'] for s in systems if s.get(field) is not None
+                       and (key in s[field] if field == 'COMPOSITION'
+                            else s[field] == key)]
+    assert len(systems.lookup('COMPOSITION', 'nonExisting')) == 0
+    # lookup results don't rebuild inverted indexes until they are used
+    with mock.patch('DatabankLib.core._gen_secondary_indexes') as gen:
+        popc = systems.lookup('COMPOSITION', 'POPC')
+        gen.assert_not_called()
+    assert popc.lookup('SOFTWARE', 'gromacs')[0] in systems
+    for s in systems:
+        for path in s['EXPERIMENT']['ORDERPARAMETER'].get('POPC', {}).values():
+            key = os.path.join('OrderParameters', path)
+            assert s in systems.lookup('EXPERIMENT', key)
+    with pytest.raises(KeyError):
+        systems.lookup('TEMPERATURE', 298)
+    # indexes are persisted and reused; lazy collection builds the same ones
+    initialize_databank()
+    db = databank()
+    assert db.__read_index__()['secondary'] == systems.indexes
+    assert initialize_databank().indexes == systems.indexes
+    assert initialize_databank(lazy=True).indexes == systems.indexes
+
+
 @pytest.mark.parametrize("systemid, lipid, result",
                          [(281, ['POPC'], [1]),
                           (566, ['POPC', 'CHOL'], [.9375, .0625]),
@@ -244,6 +332,56 @@ def test_loadMappingFile(systems, systemid, lipid, result):
         i += 1
 
 
+def test_loadMappingFile_cache(tmp_path):
+    import yaml
+    from unittest import mock
+    import DatabankLib.databankLibrary as dl
+    fname = 'mappingPOPCcharmm.yaml'
+    mpf = dl.loadMappingFile(fname)
+    assert dl.loadMappingFile(fname) is mpf
+    with pytest.raises(TypeError):
+        mpf['M_G1_M'] = {}
+    with open(os.path.join(dl.MAPPING_DIR, fname)) as f:
+        assert yaml.safe_load(f) == {k: dict(v) for k, v in mpf.items()}
+    # precompiled store is used instead of YAML files
+    mdir = tmp_path / 'mapping_files'
+    mdir.mkdir()
+    (mdir / 'test.yaml').write_text("M_X_M:\n  ATOMNAME: X\n  FRAGMENT: f\n")
+    with mock.patch.multiple(dl, MAPPING_DIR=str(mdir), _mapping_cache={}):
+        spath = dl.compileMappingFiles(str(mdir))
+        assert spath == str(tmp_path / '.mapping_files_index.pkl')
+        with mock.patch.object(dl.yaml, 'load', side_effect=AssertionError):
+            assert dl.loadMappingFile('test.yaml')['M_X_M']['ATOMNAME'] == 'X'
+        # modified file is re-read
+        (mdir / 'test.yaml').write_text("M_X_M:\n  ATOMNAME: Y\n  FRAGMENT: ff\n")
+        assert dl.loadMappingFile('test.yaml')['M_X_M']['ATOMNAME'] == 'Y'
+    dl._mapping_store = None
+
+
+def test_loadMapping():
+    from DatabankLib.databankLibrary import loadMapping, loadMappingFile
+    from DatabankLib.databankop import parse_op_input
+    mpf = loadMappingFile('mappingPOPClipid17.yaml')
+    m = loadMapping('mappingPOPClipid17.yaml')
+    assert m is loadMapping('mappingPOPClipid17.yaml')
+    assert dict(m) == dict(mpf) and list(m) == list(mpf)
+    assert m.multiresidue and set(m.residues) == {'PC', 'PA', 'OL'}
+    for uname, entry in mpf.items():
+        assert m.atomname(uname) == entry['ATOMNAME']
+        assert uname in m.residue_names(entry['RESIDUE'])
+        assert entry['ATOMNAME'] in m.residue_atoms(entry['RESIDUE'])
+        assert uname in m.fragments[entry['FRAGMENT']]
+        # first universal name with this atom name (in the residue)
+        assert m.universal(entry['ATOMNAME'], entry['RESIDUE']) == next(
+            u for u, e in mpf.items() if e['ATOMNAME'] == entry['ATOMNAME']
+            and e['RESIDUE'] == entry['RESIDUE'])
+    assert m.universal('nonExisting') is None
+    ops = parse_op_input('mappingPOPClipid17.yaml', 'POPC')
+    assert [(op.M_atAname, op.M_atBname, op.resname) for op in ops] == \
+        [(p[0], p[1], p[4]) for p in m.ch_pairs]
+    assert ops[0].name == 'M_G1_M M_G1H1_M'
+
+
 @pytest.mark.xfail(reason="Improper file name", run=True,
                    raises=FileNotFoundError, strict=True)
 def test_raise_loadMappingFile():
@@ -392,3 +530,375 @@ def test_ShowEquilibrationTimes_fail(systems):
     sys0 = systems.loc(787)
     from DatabankLib.databankLibrary import ShowEquilibrationTimes
     ShowEquilibrationTimes(sys0)
+
+
+def test_FormFactor_fourier():
+    import numpy as np
+    from DatabankLib.form_factor import FormFactor
+    rng = np.random.default_rng(1)
+    nbin, d = 120, 0.05
+    dens = rng.uniform(300, 400, (3, nbin))
+    q = np.sort(rng.uniform(0, 1000, 77))  # arbitrary (non-uniform) q grid
+    fa, fb = FormFactor.fourier(dens, nbin*d, q, d)
+    assert fa.shape == fb.shape == (3, len(q))
+    # direct summation over bins; bulk density is averaged over 0.35 nm at ends
+    x = np.linspace(-nbin*d/2, nbin*d/2, nbin + 1)[:-1] + d/2
+    for i in range(3):
+        rho = dens[i] - (dens[i, :7].sum() + dens[i, -7:].sum()) / 14
+        ref_a = [np.sum(rho * np.cos(qj * x * 0.01)) * d for qj in q]
+        ref_b = [np.sum(rho * np.sin(qj * x * 0.01)) * d for qj in q]
+        np.testing.assert_allclose(fa[i], ref_a, rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(fb[i], ref_b, rtol=1e-10, atol=1e-10)
+        fa1, _ = FormFactor.fourier(dens[i], nbin*d, q, d)
+        np.testing.assert_allclose(fa1, fa[i], rtol=1e-12)
+
+
+def test_FormFactor_matchMappingName():
+    from DatabankLib.form_factor import FormFactor
+    match = FormFactor._FormFactor__matchMappingName
+    # the first atom name matching as a regular expression wins, even if an exact
+    # match comes later in the mapping
+    pairs = [['M_C1_M', 'C1'], ['M_C12_M', 'C12'], ['M_NA_M', 'NA+']]
+    assert match(pairs, 'POPC', 'C12') == 'M_C1_M'
+    assert match(pairs, 'POPC', 'C1') == 'M_C1_M'
+    assert match(pairs, 'NA', 'NA+') == 'M_NA_M'
+    with pytest.raises(ValueError):
+        match(pairs, 'POPC', 'O11')
+
+
+def test_weights_cache(tmp_path):
+    import numpy as np
+    from DatabankLib import form_factor as ffm
+    top = tmp_path / "conf.gro"
+    top.write_text("topology")
+    mp = tmp_path / "mapping.yaml"
+    mp.write_text("M_P_M: {ATOMNAME: P}")
+    key = ffm.weightsKey([str(top), str(mp)], {'UNITEDATOM_DICT': None})
+    assert ffm.loadWeights(str(tmp_path), key, 3) is None
+    w = np.array([15., 7., 8.])
+    ffm.saveWeights(str(tmp_path), key, w)
+    assert os.path.isfile(ffm.weightsCachePath(str(tmp_path)))
+    np.testing.assert_array_equal(ffm.loadWeights(str(tmp_path), key, 3), w)
+    assert ffm.loadWeights(str(tmp_path), key, 4) is None
+    # any change of the inputs invalidates the cache
+    assert key != ffm.weightsKey([str(top), str(mp)], {'UNITEDATOM_DICT': {}})
+    mp.write_text("M_P_M: {ATOMNAME: P8}")
+    key2 = ffm.weightsKey([str(top), str(mp)], {'UNITEDATOM_DICT': None})
+    assert key2 != key
+    assert ffm.loadWeights(str(tmp_path), key2, 3) is None
+
+
+def test_DensityHistograms(tmp_path):
+    import numpy as np
+    from DatabankLib.form_factor import (DensityKernel, DensityHistograms,
+                                         FormFactor, membraneThickness)
+    rng = np.random.default_rng(5)
+    n, nbin = 2000, 60
+    lip, wat = np.arange(0, n, 2), np.arange(1, n, 2)
+    k = DensityKernel(rng.integers(1, 9, n).astype(float), lip, wat,
+                      np.ones(len(lip)), nbin, 7.2)
+    for f in range(4):
+        pos = rng.uniform(0, 66, (n, 3)).astype(np.float32)
+        pos[lip, 2] = rng.normal(33, 8, len(lip))
+        k.add_frame(pos, np.array([50, 50, 66 + f, 90, 90, 90], dtype=np.float32))
+    fname = str(tmp_path / "hist.npz")
+    DensityHistograms.from_kernel(k).save(fname)
+    h = DensityHistograms.load(fname)
+    assert h.nframes == 4 and h.nbin == nbin and h.groups == DensityKernel.GROUPS
+    np.testing.assert_allclose(h.box_z, [6.6, 6.7, 6.8, 6.9], rtol=1e-6)
+    x, dens = h.profiles()
+    np.testing.assert_array_equal(dens, k.profiles())
+    # coarser bins are averages of the stored ones
+    x3, dens3 = h.profiles(20)
+    np.testing.assert_allclose(x3, x.reshape(20, 3).mean(axis=1))
+    np.testing.assert_allclose(dens3, dens.reshape(4, 20, 3).mean(axis=2))
+    with pytest.raises(ValueError):
+        h.profiles(7)
+    # cropped to the smallest box
+    start, end = h.crop()
+    assert -3.3 < x[start] < x[end] < 3.3 + 1e-6
+    wd = h.density('waters')
+    np.testing.assert_array_equal(wd[:, 1], dens[3, start+1:end-1])
+    assert h.thickness() == membraneThickness(wd, h.density('lipids'))
+    fa, fb = FormFactor.fourier(dens[0, start:end], x[end] - x[start],
+                                np.arange(10), x[1] - x[0])
+    np.testing.assert_allclose(h.formFactor(np.arange(10))[:, 1], np.hypot(fa, fb))
+
+
+def test_DensityHistograms_blocks(tmp_path):
+    import json
+    import numpy as np
+    from DatabankLib.form_factor import (DensityKernel, DensityHistograms,
+                                         NumpyArrayEncoder)
+    rng = np.random.default_rng(6)
+    n, nbin = 1000, 40
+    lip, wat = np.arange(0, n, 2), np.arange(1, n, 2)
+    w = rng.integers(1, 9, n).astype(float)
+    frames = []
+    for f in range(7):
+        pos = rng.uniform(0, 60, (n, 3)).astype(np.float32)
+        pos[lip, 2] = rng.normal(30, 6, len(lip))
+        frames.append((pos, np.array([40, 40, 60 + f % 3, 90, 90, 90], np.float32)))
+
+    def kernel(block_frames=None):
+        return DensityKernel(w, lip, wat, np.ones(len(lip)), nbin, 6.4, block_frames)
+
+    # two "chunks" merged in order, as in accumulate_density
+    k, kc = kernel(3), kernel(3)
+    for (start, stop) in [(0, 4), (4, 7)]:
+        kc.reset()
+        for i in range(start, stop):
+            kc.add_frame(*frames[i], i)
+        k.merge(kc.partial())
+    h = DensityHistograms.from_kernel(k)
+    h.save(str(tmp_path / "h.npz"))
+    h = DensityHistograms.load(str(tmp_path / "h.npz"))
+    assert h.nblocks == 3 and h.block_frames == 3
+    assert list(h.block_nframes) == [3, 3, 1]
+    np.testing.assert_allclose(h.block_hist.sum(axis=0), h.hist)
+    # every block is a form factor of its frames cropped to the global minimal box
+    for b, sl in enumerate([slice(0, 3), slice(3, 6), slice(6, 7)]):
+        kb = kernel()
+        for pos, dims in frames[sl]:
+            kb.add_frame(pos, dims)
+        hb = DensityHistograms.from_kernel(kb)
+        hb.box_z = h.box_z
+        np.testing.assert_allclose(h.block_profiles()[1][b], hb.profiles()[1])
+        np.testing.assert_allclose(h.blockFormFactors()[b], hb.formFactor()[:, 1])
+    conv = h.convergence()
+    assert conv['NBLOCKS'] == 3 and conv['FF_BLOCK_SE'].shape == (1000,)
+    assert conv['FF_BLOCK_DEVIATION'].shape == (3,)
+    assert conv['FF_CUMULATIVE_DEVIATION'][-1] < 1e-12
+    json.loads(json.dumps(conv, cls=NumpyArrayEncoder))
+    assert DensityHistograms.from_kernel(kernel()).convergence() == {}
+
+
+def _dummy_analysis(system, logger):
+    """ Dummy analysis for run_analysis tests (module-level to be picklable) """
+    from DatabankLib import RCODE_COMPUTED, RCODE_SKIPPED
+    if system['ID'] == 243:
+        raise RuntimeError("failed")
+    return RCODE_COMPUTED if system['ID'] > 500 else RCODE_SKIPPED
+
+
+def test_run_analysis(systems, logger, tmp_path, capsys):
+    import json
+    from DatabankLib import RCODE_COMPUTED, RCODE_SKIPPED, RCODE_ERROR
+    from DatabankLib.utils import (run_analysis, analysis_parser,
+                                   parse_analysis_args, _by_trajectory_size)
+    opts = analysis_parser().parse_args(['--jobs', '3', '--mem-limit', '8'])
+    assert vars(opts) == {'jobs': 3, 'mem_limit': 8.0, 'mem_budget': None,
+                          'report': None}
+    with mock.patch('os.cpu_count', return_value=8):
+        run_opts, opts = parse_analysis_args(
+            analysis_parser(frame_workers=True), ['-j', '2', '--frame-workers', '8'])
+    assert run_opts == {'jobs': 2, 'mem_limit': None, 'mem_budget': None,
+                        'report': None}
+    assert opts == {'n_workers': 4}
+    assert parse_analysis_args(analysis_parser(), [])[1] == {}
+    assert [s['ID'] for s in _by_trajectory_size(systems)] == [787, 281, 566, 86, 243]
+
+    report = str(tmp_path / "report.json")
+    res = run_analysis(_dummy_analysis, logger, jobs=2, mem_limit=None, report=report)
+    assert res == {RCODE_COMPUTED: 2, RCODE_SKIPPED: 2, RCODE_ERROR: 1}
+    with open(report) as f:
+        rep = json.load(f)
+    assert rep['RESULTS'] == {'COMPUTED': 2, 'SKIPPED': 2, 'ERROR': 1}
+    assert sorted(s['path'] for s in rep['SYSTEMS']) == \
+        sorted(s['path'] for s in systems)
+    out = capsys.readouterr().out
+    assert 'ERROR: 1' in out and 'TOTAL TIME' in out
+    # serial mode propagates exceptions
+    with pytest.raises(RuntimeError):
+        run_analysis(_dummy_analysis, logger)
+    # unless the memory limit is set: then jobs run in a worker process
+    with mock.patch.object(logger, 'warning') as warning:
+        res = run_analysis(_dummy_analysis, logger, mem_limit=64, mem_budget=1)
+    assert res == {RCODE_COMPUTED: 2, RCODE_SKIPPED: 2, RCODE_ERROR: 1}
+    warning.assert_called_once()
+    assert 'budget' in warning.call_args[0][0]
+
+
+def test_run_job_memory_errors():
+    import errno
+    import functools
+    from DatabankLib import utils
+    assert utils._is_memory_error(MemoryError())
+    assert utils._is_memory_error(OSError(errno.ENOMEM, "Cannot allocate memory"))
+    assert not utils._is_memory_error(OSError(errno.ENOENT, "No such file"))
+    assert utils._analysis_name(functools.partial(_dummy_analysis, x=1)) == \
+        '_dummy_analysis'
+    assert 'computeNMRPCA' in utils.MEMORY_LIMIT_EXEMPT
+
+
+def test_frame_workers():
+    from DatabankLib.utils import frame_workers
+    with mock.patch('os.cpu_count', return_value=8):
+        assert frame_workers(4) == 4
+        assert frame_workers(4, jobs=4) == 2
+        assert frame_workers(4, jobs=16) == 1
+        assert frame_workers(16, jobs=2) == 4
+
+
+def _killing_analysis(system, logger):
+    """ Dummy analysis killing its worker process for one system """
+    import time
+    from DatabankLib import RCODE_COMPUTED
+    if system['ID'] == 86:
+        os._exit(1)
+    time.sleep(0.2)
+    return RCODE_COMPUTED
+
+
+@pytest.mark.parametrize("mem_budget", [None, 1000.])
+def test_run_analysis_killed_worker(systems, logger, mem_budget):
+    import math
+    from DatabankLib import RCODE_COMPUTED, RCODE_ERROR
+    from DatabankLib.utils import run_analysis, _run_parallel
+    # only the job killing its worker fails
+    res = run_analysis(_killing_analysis, logger, jobs=2, mem_budget=mem_budget)
+    assert res[RCODE_COMPUTED] == 4 and res[RCODE_ERROR] == 1
+    # jobs running together with the killed one are rerun
+    run = {s['ID']: (r, t) for s, r, t in _run_parallel(
+        _killing_analysis, systems, logger, 3, None, math.inf)}
+    assert sorted(run) == sorted(s['ID'] for s in systems)
+    assert run[86][0] == RCODE_ERROR and math.isnan(run[86][1])
+    assert all(r == RCODE_COMPUTED for i, (r, t) in run.items() if i != 86)
+
+
+def test_estimate_memory_schedule(systems, logger):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from DatabankLib import utils
+    s787 = systems.loc(787)
+    base = utils.MEMORY_BASE
+    assert utils.estimate_memory(s787, 'computeTH') == base
+    assert utils.estimate_memory(s787, utils.estimate_memory) > base
+    ff = utils.estimate_memory(s787, 'computeFF')
+    assert ff == base + utils.MEMORY_MODEL['computeFF'][0] * s787['NUMBER_OF_ATOMS']
+    ua = dict(s787, UNITEDATOM_DICT={'POPC': 'POPC'}, TRAJECTORY_SIZE=30e9)
+    assert utils.estimate_memory(ua, 'computeOP') == \
+        utils.estimate_memory(s787, 'computeOP') + 10e9
+
+    # running jobs never exceed the budget (except a single oversized job)
+    lock = threading.Lock()
+    running, peaks = set(), []
+
+    def computeNMRPCA(system, logger):
+        with lock:
+            running.add(system['ID'])
+            peaks.append(sum(utils.estimate_memory(systems.loc(i), computeNMRPCA)
+                             for i in running))
+        time.sleep(0.05)
+        with lock:
+            running.discard(system['ID'])
+        return 1
+
+    mems = sorted(utils.estimate_memory(s, computeNMRPCA) for s in systems)
+    budget = mems[-1] + mems[0]
+    with ThreadPoolExecutor(4) as executor:
+        done = [s['ID'] for s, f in utils._schedule(
+            executor, computeNMRPCA, systems, logger, budget)]
+    assert sorted(done) == sorted(s['ID'] for s in systems)
+    assert max(peaks) <= budget and len(peaks) == len(systems)
+    # a budget smaller than any job runs jobs one by one
+    peaks.clear()
+    with ThreadPoolExecutor(4) as executor:
+        list(utils._schedule(executor, computeNMRPCA, systems, logger, 1))
+    assert max(peaks) == mems[-1]
+
+
+def test_nmrpca_streaming_PCA():
+    import numpy as np
+    import DatabankLib.analyze_nmrpca as nmrpca
+    rng = np.random.default_rng(11)
+    nfr, nat = 95, 4
+    traj = (rng.normal(0, 1, (nfr, nat, 3)) *
+            np.array([3, 1, 0.5])).astype(np.float32)
+    av_pos = traj.mean(axis=0).reshape(1, -1)
+    X = traj.reshape(nfr, -1).astype(np.float64) - av_pos
+    # accumulators of parts merge into the accumulator of the whole
+    whole = nmrpca.CovarianceAccumulator(3 * nat).add(X)
+    parts = nmrpca.CovarianceAccumulator(3 * nat).add(X[:40]).merge(
+        nmrpca.CovarianceAccumulator(3 * nat).add(X[40:]))
+    assert parts.n == whole.n == nfr
+    np.testing.assert_allclose(parts.covariance(), whole.covariance(), atol=1e-12)
+    np.testing.assert_allclose(whole.covariance(), np.cov(X.T), atol=1e-12)
+    np.testing.assert_allclose(whole.mean(), X.mean(axis=0), atol=1e-12)
+    with mock.patch.object(nmrpca, "PCA_CHUNK_FRAMES", 10):
+        pca = nmrpca.PCA(traj.reshape(-1, 3), av_pos, 5, nfr, 100.)
+        pca.PCA()
+        pca.get_proj()
+    vals, vecs = np.linalg.eigh(np.cov(X.T))
+    np.testing.assert_allclose(pca.eig_vals, vals[::-1], atol=1e-10)
+    ref = X @ vecs[:, -1]
+    np.testing.assert_allclose(np.abs(pca.proj), np.abs(ref), atol=1e-8)
+    assert pca.proj.shape == (nfr,)
+
+
+def test_nmrpca_autocorrelations():
+    import numpy as np
+    from scipy import signal
+    import DatabankLib.analyze_nmrpca as nmrpca
+    rng = np.random.default_rng(5)
+    n_lipid, nfr = 6, 37
+    proj = np.cumsum(rng.normal(size=n_lipid * nfr))
+    pca = nmrpca.PCA(None, None, n_lipid, n_lipid * nfr, 50.)
+    pca.proj = proj.copy()
+    pca.get_autocorrelations()
+    # reference: per-lipid FFT convolution
+    ref = []
+    for x in (proj - proj.mean()).reshape(n_lipid, nfr):
+        r = signal.fftconvolve(x, x[::-1], mode="full")[-nfr:]
+        ref.append(r / (proj.var() * np.arange(nfr, 0, -1)))
+    ref = np.mean(ref, axis=0)
+    assert pca.autocorrelation.shape == (nfr, 2)
+    np.testing.assert_allclose(pca.autocorrelation[:, 0], np.arange(nfr) * 50. / nfr)
+    np.testing.assert_allclose(pca.autocorrelation[:, 1], ref, atol=1e-12)
+    assert pca.autocorrelation[0, 1] == pytest.approx(1.0)
+    pca.get_autocorrelations(np.float32)
+    np.testing.assert_allclose(pca.autocorrelation[:, 1], ref, atol=1e-4)
+    np.testing.assert_array_equal(pca.proj, proj)
+
+
+def test_nmrpca_artifacts(systems, tmp_path):
+    import numpy as np
+    import DatabankLib
+    import DatabankLib.analyze_nmrpca as nmrpca
+    rng = np.random.default_rng(2)
+    n_lipid, nfr, nat = 4, 60, 5
+    traj = np.cumsum(rng.normal(0, 0.1, (n_lipid * nfr, nat, 3)), axis=0)
+    traj = traj.astype(np.float32).reshape(-1, 3)
+    av_pos = traj.reshape(n_lipid * nfr, -1).mean(axis=0).reshape(1, -1)
+    pca = nmrpca.PCA(traj, av_pos, n_lipid, n_lipid * nfr, 20.)
+    pca.PCA()
+    pca.get_proj()
+    pca.get_autocorrelations()
+    fname = str(tmp_path / "NMRPCA_POPC.npz")
+    pca.save(fname, "key", k=3)
+    assert nmrpca.PCA.load(fname, "other") is None
+    assert nmrpca.PCA.load(str(tmp_path / "none.npz"), "key") is None
+    cached = nmrpca.PCA.load(fname, "key")
+    assert cached.aligned_traj is None
+    assert (cached.n_lipid, cached.n_frames, cached.traj_time) == \
+        (n_lipid, n_lipid * nfr, 20.)
+    np.testing.assert_array_equal(cached.eig_vecs, pca.eig_vecs[:3])
+    np.testing.assert_array_equal(cached.eig_vals, pca.eig_vals[:3])
+    np.testing.assert_array_equal(cached.proj, pca.proj)
+    np.testing.assert_array_equal(cached.av_pos, av_pos)
+    assert nmrpca.TimeEstimator(cached.autocorrelation).calculate_time() == \
+        nmrpca.TimeEstimator(pca.autocorrelation).calculate_time()
+    # autocorrelations can be recomputed from cached projections
+    cached.get_autocorrelations()
+    np.testing.assert_allclose(cached.autocorrelation, pca.autocorrelation)
+    assert os.listdir(tmp_path) == ["NMRPCA_POPC.npz"]
+
+    s = systems.loc(787)
+    parser = nmrpca.Parser(DatabankLib.NMLDB_SIMU_PATH, s, v=False)
+    lipid = parser.pcaLipids()[0]
+    assert parser.artifactsPath(lipid).endswith(f"NMRPCA_{lipid}.npz")
+    assert parser.artifactsKey(lipid) == parser.artifactsKey(lipid)
+    parser.size += 1
+    assert parser.artifactsKey(lipid) != \
+        nmrpca.Parser(DatabankLib.NMLDB_SIMU_PATH, s, v=False).artifactsKey(lipid)
@@ -128,6 +128,10 @@ def compareJSONsBtwSD(jsfn: str):
     if type(j1) is dict:
         assert(set(j1.keys())==set(j2.keys()))
         for k1 in j1:
+            if type(j1[k1]) is list and type(j2[k1]) is list and \
+                    all(type(x) is dict for x in j1[k1][len(j2[k1]):]):
+                # computed entries may carry extra statistics (OP blocks)
+                j1[k1] = j1[k1][:len(j2[k1])]
             np.testing.assert_allclose(
                 np.array(j1[k1]),
                 np.array(j2[k1]),
@@ -124,3 +124,293 @@ def test_PJangle(systems, systemid, lipid, fvhash):
     assert c > 0
     # overall std
     assert d > 0
+
+
+@pytest.fixture(scope="module")
+def ch_trajectory():
+    """ Small synthetic trajectory of 16 residues with two C-H pairs each """
+    import numpy as np
+    import MDAnalysis as mda
+    nres, names, nfr = 16, ['C1', 'H1', 'C2', 'H2'], 10
+    n = nres * len(names)
+    u = mda.Universe.empty(
+        n, n_residues=nres, atom_resindex=np.repeat(np.arange(nres), len(names)),
+        trajectory=True)
+    u.add_TopologyAttr('name', names * nres)
+    u.add_TopologyAttr('resname', ['POPC'] * nres)
+    u.add_TopologyAttr('resid', np.arange(1, nres + 1))
+    rng = np.random.default_rng(42)
+    heavy = rng.uniform(5, 25, (nfr, n, 3))
+    bonds = rng.normal(0, 1, (nfr, n // 2, 3))
+    bonds *= 1.09 / np.linalg.norm(bonds, axis=2, keepdims=True)
+    heavy[:, 1::2] = heavy[:, 0::2] + bonds
+    u.load_new(heavy.astype(np.float32), order='fac')
+    with TemporaryDirectory() as tdir:
+        gro = os.path.join(tdir, 'conf.gro')
+        xtc = os.path.join(tdir, 'traj.xtc')
+        with mda.Writer(xtc, n) as w:
+            for ts in u.trajectory:
+                ts.dimensions = [30, 30, 30, 90, 90, 90]
+                w.write(u.atoms)
+        u.trajectory[0]
+        u.atoms.write(gro)
+        yield gro, xtc
+
+
+def test_read_trajs_calc_OPs(ch_trajectory):
+    import numpy as np
+    import MDAnalysis as mda
+    from DatabankLib.databankop import OrderParameter, read_trajs_calc_OPs
+    gro, xtc = ch_trajectory
+    ops = [OrderParameter('POPC', 'C1', 'H1', 'M_C1_M', 'M_C1H1_M'),
+           OrderParameter('POPC', 'C2', 'H2', 'M_C2_M', 'M_C2H1_M'),
+           OrderParameter('POPC', 'C2', 'HX', 'M_C2_M', 'M_C2HX_M')]
+    with pytest.warns(UserWarning):
+        read_trajs_calc_OPs(ops, gro, xtc)
+    assert [op.name for op in ops] == ['M_C1_M M_C1H1_M', 'M_C2_M M_C2H1_M']
+    # reference: per-residue per-frame evaluation
+    u = mda.Universe(gro, xtc)
+    for op in ops:
+        sel = u.select_atoms(f"name {op.atAname} {op.atBname}").split("residue")
+        ref = np.array([[OrderParameter.calc_OP(res) for res in sel]
+                        for _ in u.trajectory])
+        np.testing.assert_allclose(op.traj, ref.mean(axis=0), atol=1e-6)
+        np.testing.assert_allclose(op.traj_std, ref.std(axis=0), atol=1e-6)
+
+
+def test_select_OPs_improper(ch_trajectory):
+    import MDAnalysis as mda
+    import DatabankLib.databankop as dop
+    gro, _ = ch_trajectory
+    # the improper OP selects 3 atoms in each of 16 residues: it must be removed
+    # once, without removing the OP following it
+    ops = [dop.OrderParameter('POPC', 'C1', 'H1', 'M_C1_M', 'M_C1H1_M'),
+           dop.OrderParameter('POPC', 'C1', 'H*', 'M_C1_M', 'M_C1HX_M'),
+           dop.OrderParameter('POPC', 'C2', 'H2', 'M_C2_M', 'M_C2H1_M')]
+    with pytest.warns(UserWarning):
+        dop._select_OPs(mda.Universe(gro), ops)
+    assert [op.name for op in ops] == ['M_C1_M M_C1H1_M', 'M_C2_M M_C2H1_M']
+    assert all(len(op.selection) == 16 for op in ops)
+
+
+def test_parallel_read_trajs_calc_OPs(ch_trajectory):
+    import DatabankLib.databankop as dop
+    gro, xtc = ch_trajectory
+    res = []
+    with mock.patch.object(dop, "OP_CHUNK_FRAMES", 3):
+        for n_workers in [1, 2]:
+            ops = [dop.OrderParameter('POPC', 'C1', 'H1', 'M_C1_M', 'M_C1H1_M'),
+                   dop.OrderParameter('POPC', 'C2', 'H2', 'M_C2_M', 'M_C2H1_M')]
+            dop.read_trajs_calc_OPs(ops, gro, xtc, n_workers=n_workers)
+            res.append([(op.traj, op.traj_std) for op in ops])
+    assert res[0] == res[1]
+
+
+def test_OP_block_statistics(ch_trajectory):
+    import numpy as np
+    import MDAnalysis as mda
+    import DatabankLib.databankop as dop
+    gro, xtc = ch_trajectory
+    with mock.patch.object(dop, "OP_CHUNK_FRAMES", 3), \
+            mock.patch.object(dop, "OP_N_BLOCKS", 5):
+        op = dop.OrderParameter('POPC', 'C1', 'H1', 'M_C1_M', 'M_C1H1_M')
+        dop.read_trajs_calc_OPs([op], gro, xtc)
+    u = mda.Universe(gro, xtc)
+    sel = u.select_atoms("name C1 H1").split("residue")
+    ref = np.array([[dop.OrderParameter.calc_OP(res) for res in sel]
+                    for _ in u.trajectory])
+    # 10 frames in 5 blocks of 2 frames
+    blocks = ref.reshape(5, 2, -1).mean(axis=(1, 2))
+    np.testing.assert_allclose(op.blocks, blocks, atol=1e-6)
+    stats = op.get_block_stats
+    np.testing.assert_allclose(stats['BLOCK_SE'],
+                               np.std(blocks, ddof=1) / np.sqrt(5), atol=1e-6)
+    np.testing.assert_allclose(op.get_avg_std_stem_OP[0], ref.mean(), atol=1e-6)
+    op.blocks = op.blocks[:1]
+    assert op.get_block_stats['BLOCK_SE'] is None
+
+
+def test_DensityKernel():
+    import numpy as np
+    from DatabankLib.form_factor import DensityKernel
+    rng = np.random.default_rng(3)
+    n, nbin, boxH = 3000, 50, 7.0
+    lip, wat = np.arange(0, n, 2), np.arange(1, n, 2)
+    w = rng.integers(1, 9, n).astype(float)
+    m = rng.uniform(1, 16, len(lip))
+    k = DensityKernel(w, lip, wat, m, nbin, boxH)
+    ref = np.zeros((4, nbin))
+    for f in range(5):
+        dims = np.array([60, 61, 70 + f, 90, 90, 90], dtype=np.float32)
+        pos = rng.uniform(-10, 80, (n, 3)).astype(np.float32)
+        pos0 = pos.copy()
+        k.add_frame(pos, dims)
+        assert np.array_equal(pos, pos0)
+        z = pos[:, 2].astype(np.float64)
+        ctom = np.sum(z[lip] * m) / m.sum()
+        zc = z + dims[2]/2 - ctom
+        zc = (zc - np.floor(zc / dims[2]) * dims[2] - dims[2]/2) / 10
+        vbin = boxH / nbin * dims[0] * dims[1] / 100
+        rng_c = (-boxH/2, boxH/2)
+        ref[0] += np.histogram(zc, nbin, rng_c, weights=w)[0] / vbin
+        ref[1] += np.histogram(z[lip]/10, nbin, (0, boxH), weights=w[lip])[0] / vbin
+        ref[2] += np.histogram(zc[lip], nbin, rng_c, weights=w[lip])[0] / vbin
+        ref[3] += np.histogram(zc[wat], nbin, rng_c, weights=w[wat])[0] / vbin
+    assert k.nframes == 5 and k.min_z == 7.0
+    np.testing.assert_allclose(k.profiles(), ref / 5, rtol=1e-10)
+
+
+def test_electronWeights():
+    import numpy as np
+    import MDAnalysis as mda
+    from DatabankLib.form_factor import FormFactor
+    rnames = ['POPC', 'SOL', 'POPC', 'NA', 'SOL']
+    anames = [['N', 'P', 'C1'], ['OW', 'HW1', 'HW2'], ['N', 'P', 'C1'], ['NA'],
+              ['OW', 'HW1', 'HW2']]
+    u = mda.Universe.empty(sum(map(len, anames)), n_residues=len(rnames),
+                           atom_resindex=[i for i, a in enumerate(anames)
+                                          for _ in a],
+                           trajectory=True)
+    u.add_TopologyAttr('resname', rnames)
+    u.add_TopologyAttr('name', sum(anames, []))
+    enums = {'POPC': {'N': 7, 'P': 15, 'C1': 9}, 'SOL': {'OW': 8, 'HW1': 1}}
+    ff = FormFactor.__new__(FormFactor)
+    ff.u = u
+    ref = np.zeros(u.atoms.n_atoms)
+    for rname, a2e in enums.items():
+        for aname, enum in a2e.items():
+            ref[u.select_atoms(f"resname {rname} and name {aname}").indices] = enum
+    np.testing.assert_array_equal(ff.electronWeights(enums), ref)
+
+
+def test_parallel_accumulate_density(ch_trajectory):
+    import numpy as np
+    import MDAnalysis as mda
+    import DatabankLib.form_factor as ffm
+    gro, xtc = ch_trajectory
+    u = mda.Universe(gro, xtc)
+    n = u.atoms.n_atoms
+    res = []
+    with mock.patch.object(ffm, "FF_CHUNK_FRAMES", 3):
+        for n_workers in [1, 2]:
+            kernel = ffm.DensityKernel(np.arange(n) % 7 + 1., np.arange(0, n, 4),
+                                       np.arange(1, n, 4), np.ones(n // 4), 20, 3.0)
+            ffm.accumulate_density(kernel, u, gro, xtc, n_workers)
+            res.append(kernel)
+    assert res[0].nframes == res[1].nframes == len(u.trajectory)
+    assert res[0].min_z == res[1].min_z
+    assert res[0].hist.tobytes() == res[1].hist.tobytes()
+    assert res[0].hist.sum() > 0
+    assert res[0].box_z == res[1].box_z == \
+        [ts.dimensions[2] / 10 for ts in u.trajectory]
+
+
+def test_TrajectoryDriver(ch_trajectory):
+    import numpy as np
+    import MDAnalysis as mda
+    from DatabankLib.databankLibrary import calc_angle, read_trj_PN_angles
+    from DatabankLib.databankop import OrderParameter, OPKernel, read_trajs_calc_OPs
+    from DatabankLib.form_factor import DensityKernel
+    from DatabankLib.trajdriver import (
+        TrajectoryDriver, FrameKernel, APLKernel, PNAngleKernel)
+    gro, xtc = ch_trajectory
+    u = mda.Universe(gro, xtc)
+    n = u.atoms.n_atoms
+
+    def ops():
+        return [OrderParameter('POPC', 'C1', 'H1', 'M_C1_M', 'M_C1H1_M'),
+                OrderParameter('POPC', 'C2', 'H2', 'M_C2_M', 'M_C2H1_M')]
+
+    def dkernel():
+        return DensityKernel(np.arange(n) % 7 + 1., np.arange(0, n, 4),
+                             np.arange(1, n, 4), np.ones(n // 4), 20, 3.0)
+
+    opk = OPKernel(ops())
+    driver = TrajectoryDriver(u, [APLKernel(8, tmin=0), opk])
+    pn = driver.add(PNAngleKernel('POPC', 'C1', 'C2'))
+    dens = driver.add(dkernel())
+    assert driver.run(progress=False)[1] is opk
+
+    # every analysis gives the same results as separate passes
+    assert list(driver.kernels[0].apl.values()) == [30*30*2/8] * len(u.trajectory)
+    ref = ops()
+    read_trajs_calc_OPs(ref, gro, xtc)
+    for op, op0 in zip(opk.ordPars, ref):
+        np.testing.assert_allclose(op.traj, op0.traj, rtol=1e-12)
+    u.trajectory[0]
+    sel = u.select_atoms("name C1 C2").split("residue")
+    com = u.select_atoms("name C1 C2").center_of_mass()
+    ref_angles = np.array([[calc_angle(res, com[2]) for res in sel]
+                           for _ in u.trajectory]).T
+    np.testing.assert_allclose(pn.angles, ref_angles, rtol=1e-14)
+    assert read_trj_PN_angles('POPC', 'C1', 'C2', u)[0].shape == (16, 10)
+    ref_dens = dkernel()
+    for ts in u.trajectory:
+        ref_dens.add_frame(ts.positions, ts.dimensions)
+    assert ref_dens.hist.tobytes() == dens.hist.tobytes()
+    with pytest.raises(TypeError):
+        FrameKernel()
+
+
+@pytest.fixture(scope="function")
+def nmrpca_concatenator(ch_trajectory, tmp_path):
+    """ Concatenator of heavy atoms (C1, C2) of the synthetic trajectory """
+    import MDAnalysis as mda
+    import DatabankLib.analyze_nmrpca as nmrpca
+    gro, xtc = ch_trajectory
+    u = mda.Universe(gro, xtc)
+    top = nmrpca.Topology.__new__(nmrpca.Topology)
+    top.ff, top.lipid_resname, top.traj = None, 'POPC', u
+    top.mapping = {f'M_{a}_M': {'ATOMNAME': a} for a in ['C1', 'H1', 'C2', 'H2']}
+    return u, nmrpca.Concatenator(top, u, 'POPC', 'POPC', str(tmp_path))
+
+
+def test_concatenateTraj(nmrpca_concatenator):
+    import tempfile
+    import numpy as np
+    import DatabankLib.analyze_nmrpca as nmrpca
+    u, conc = nmrpca_concatenator
+    ref = np.array([u.select_atoms('name C1 C2').positions for _ in u.trajectory])
+    ref = ref.reshape(10, 16, 2, 3).swapaxes(0, 1).reshape(160, 2, 3)
+    with mock.patch.object(nmrpca, "CONCAT_CHUNK_FRAMES", 3), \
+            mock.patch.object(nmrpca.tempfile, "TemporaryFile",
+                              wraps=tempfile.TemporaryFile) as tmpfile:
+        coords, n_lipid, n_frames = conc.concatenateTraj()
+    # memory-mapped file is created in the scratch directory
+    assert tmpfile.call_args.kwargs['dir'] == conc.scratch_dir
+    assert (n_lipid, n_frames) == (16, 160)
+    assert isinstance(coords, np.memmap)
+    assert coords.tobytes() == ref.tobytes()
+    aligned, av_pos = conc.alignTraj(coords)
+    assert aligned.shape == (320, 3) and av_pos.shape == (1, 6)
+    # alignment is done in place
+    assert np.shares_memory(aligned, coords)
+
+
+def test_nmrpca_alignTraj():
+    import warnings
+    import numpy as np
+    import MDAnalysis as mda
+    from MDAnalysis.analysis import align
+    from scipy.spatial.transform import Rotation
+    import DatabankLib.analyze_nmrpca as nmrpca
+    rng = np.random.default_rng(7)
+    nfr, nat = 50, 12
+    lipid = rng.normal(0, 5, (nat, 3))
+    rot = Rotation.random(nfr, random_state=7).as_matrix()
+    coords = (np.einsum('fij,aj->fai', rot, lipid) + rng.normal(0, 0.5, (nfr, nat, 3))
+              + rng.uniform(-20, 20, (nfr, 1, 3))).astype(np.float32)
+    # reference: MDAnalysis alignment done by the previous implementation
+    u = mda.Universe.empty(nat, 1, atom_resindex=np.zeros(nat, dtype=int),
+                           trajectory=True)
+    u.load_new(coords.copy())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        av = align.AverageStructure(u, ref_frame=0).run()
+        align.AlignTraj(u, av.results.universe).run()
+    ref = u.trajectory.get_array()
+    with mock.patch.object(nmrpca, "ALIGN_CHUNK_FRAMES", 7):
+        aligned, av_pos = nmrpca.Concatenator.alignTraj(coords)
+    np.testing.assert_allclose(aligned.reshape(nfr, nat, 3), ref, atol=1e-4)
+    np.testing.assert_allclose(av_pos, ref.mean(axis=0).reshape(1, -1), atol=1e-4)
+    assert np.shares_memory(aligned, coords)